@@ -0,0 +1,267 @@
+import ast
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, List, Optional
+from vector_storage import atomic_write
+
+# Column kinds of the thread-details CSV; any other column is read as text
+COLUMN_KINDS = {
+    'thread_id': 'int',
+    'timestamp': 'datetime',
+    'to': 'list',
+}
+CSV_DTYPES = {'thread_id': 'Int64'}
+CACHE_VERSION = 1
+
+def decode_recipients(value) -> List[str]:
+    """Decode a stringified recipient list, as written by str(list)"""
+    if not isinstance(value, str):
+        return []
+    try:
+        decoded = ast.literal_eval(value)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return [value]
+    if isinstance(decoded, (list, tuple)):
+        return [str(recipient) for recipient in decoded]
+    return [str(decoded)]
+
+def _kind(column: str) -> str:
+    return COLUMN_KINDS.get(column, 'str')
+
+def _convert_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Parse timestamps and recipient lists of a freshly read CSV chunk"""
+    for column in chunk.columns:
+        kind = _kind(column)
+        if kind == 'datetime':
+            chunk[column] = pd.to_datetime(chunk[column], errors='coerce', format='ISO8601')
+        elif kind == 'list':
+            chunk[column] = chunk[column].map(decode_recipients).astype(object)
+    return chunk
+
+def _read_chunks(path: str, chunk_rows: int,
+                 columns: Optional[List[str]] = None) -> Iterable[pd.DataFrame]:
+    """Stream the CSV in converted chunks with explicit dtypes"""
+    header = pd.read_csv(path, nrows=0).columns
+    dtypes = {column: CSV_DTYPES.get(column, object) for column in header}
+    reader = pd.read_csv(path, dtype=dtypes, usecols=columns, chunksize=chunk_rows)
+    for chunk in reader:
+        yield _convert_chunk(chunk)
+
+class _TextWriter:
+    """Append strings to a UTF-8 blob with byte offsets and a null mask"""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.file = open(f"{prefix}.txt", 'wb')
+        self.lengths: List[np.ndarray] = []
+        self.nulls: List[np.ndarray] = []
+
+    def write(self, values: Iterable) -> None:
+        encoded, nulls = [], []
+        for value in values:
+            nulls.append(not isinstance(value, str))
+            encoded.append(value.encode('utf-8') if isinstance(value, str) else b'')
+        self.file.write(b''.join(encoded))
+        self.lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+        self.nulls.append(np.array(nulls, dtype=bool))
+
+    def close(self) -> int:
+        """Flush the blob and index files; returns the number of nulls"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        lengths = np.concatenate(self.lengths) if self.lengths else np.empty(0, dtype=np.int64)
+        np.save(f"{self.prefix}.offsets.npy", np.concatenate(([0], np.cumsum(lengths))))
+        nulls = np.concatenate(self.nulls) if self.nulls else np.empty(0, dtype=bool)
+        np.save(f"{self.prefix}.nulls.npy", nulls)
+        return int(nulls.sum())
+
+def _read_text(prefix: str, window_bytes: int = 1 << 24) -> np.ndarray:
+    """Strings written by `_TextWriter`, nulls as NaN"""
+    offsets = np.load(f"{prefix}.offsets.npy")
+    values = np.empty(len(offsets) - 1, dtype=object)
+    with open(f"{prefix}.txt", 'rb') as f:
+        # Decode a window of rows at a time; the blob is never held whole
+        start = 0
+        while start < len(values):
+            end = max(int(np.searchsorted(offsets, offsets[start] + window_bytes, 'right')) - 1,
+                      start + 1)
+            bounds = (offsets[start:end + 1] - offsets[start]).tolist()
+            block = f.read(bounds[-1])
+            values[start:end] = [block[a:b].decode('utf-8') for a, b in zip(bounds[:-1], bounds[1:])]
+            start = end
+    values[np.load(f"{prefix}.nulls.npy")] = np.nan
+    return values
+
+def _cache_dir(path: str) -> str:
+    return f"{path}.columns"
+
+def _source_signature(path: str) -> Dict:
+    info = os.stat(path)
+    return {'size': info.st_size, 'mtime_ns': info.st_mtime_ns}
+
+def cache_manifest(path: str) -> Optional[Dict]:
+    """
+    Manifest of the column cache of a CSV, if the cache is current
+
+    Returns:
+        Manifest dict (rows, columns, null_counts), or None when the cache is
+        missing or the CSV changed size or modification time since it was built
+    """
+    try:
+        with open(os.path.join(_cache_dir(path), 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != CACHE_VERSION or manifest.get('source') != _source_signature(path):
+        return None
+    return manifest
+
+def build_cache(path: str, chunk_rows: int = 50000) -> Dict:
+    """
+    Convert a CSV into a directory of per-column files next to it
+
+    The CSV is streamed in chunks, so memory use is bounded by the chunk
+    size. Integer and timestamp columns become .npy arrays that are
+    memory-mapped on load; text columns become a UTF-8 blob with byte
+    offsets; recipient lists are flattened with per-row offsets. The
+    manifest is written last, so an interrupted build is never used.
+
+    Args:
+        path: Path of the CSV file
+        chunk_rows: Rows parsed per chunk
+
+    Returns:
+        The cache manifest
+    """
+    directory = _cache_dir(path)
+    source = _source_signature(path)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    arrays, writers, counts = {}, {}, {}
+    for column in columns:
+        kind = _kind(column)
+        if kind in ('int', 'datetime'):
+            arrays[column] = []
+        elif kind == 'list':
+            writers[column] = _TextWriter(os.path.join(directory, f"{column}.items"))
+            counts[column] = []
+        else:
+            writers[column] = _TextWriter(os.path.join(directory, column))
+
+    null_counts: Dict[str, int] = {}
+    rows = 0
+    for chunk in _read_chunks(path, chunk_rows):
+        for column in columns:
+            kind = _kind(column)
+            if kind in ('int', 'datetime'):
+                arrays[column].append(chunk[column].array)
+            elif kind == 'list':
+                recipients = chunk[column].tolist()
+                writers[column].write(r for row in recipients for r in row)
+                counts[column].append(np.fromiter(map(len, recipients), dtype=np.int64,
+                                                  count=len(recipients)))
+            else:
+                writers[column].write(chunk[column].tolist())
+        rows += len(chunk)
+
+    for column in columns:
+        kind = _kind(column)
+        prefix = os.path.join(directory, column)
+        if kind == 'int':
+            parts = arrays[column]
+            values = np.concatenate([np.empty(0, dtype=np.int64)]
+                                    + [a.to_numpy(dtype=np.int64, na_value=0) for a in parts])
+            nulls = np.concatenate([np.empty(0, dtype=bool)] + [np.asarray(a.isna()) for a in parts])
+            np.save(f"{prefix}.npy", values)
+            np.save(f"{prefix}.nulls.npy", nulls)
+            null_counts[column] = int(nulls.sum())
+        elif kind == 'datetime':
+            values = (np.concatenate([a.to_numpy() for a in arrays[column]]) if arrays[column]
+                      else np.empty(0, dtype='datetime64[ns]'))
+            np.save(f"{prefix}.npy", values)
+            null_counts[column] = int(np.isnat(values).sum())
+        elif kind == 'list':
+            writers[column].close()
+            lengths = np.concatenate(counts[column]) if counts[column] else np.empty(0, dtype=np.int64)
+            np.save(f"{prefix}.offsets.npy", np.concatenate(([0], np.cumsum(lengths))))
+            null_counts[column] = 0
+        else:
+            null_counts[column] = writers[column].close()
+
+    manifest = {
+        'version': CACHE_VERSION,
+        'source': source,
+        'rows': rows,
+        'columns': columns,
+        'null_counts': null_counts
+    }
+    atomic_write(os.path.join(directory, 'manifest.json'), json.dumps(manifest).encode('utf-8'))
+    return manifest
+
+def _load_cache(path: str, manifest: Dict, columns: List[str]) -> pd.DataFrame:
+    """Load the requested columns from a current cache"""
+    directory = _cache_dir(path)
+    data = {}
+    for column in columns:
+        kind = _kind(column)
+        prefix = os.path.join(directory, column)
+        if kind == 'int':
+            values = np.load(f"{prefix}.npy", mmap_mode='r')
+            nulls = np.load(f"{prefix}.nulls.npy")
+            data[column] = pd.arrays.IntegerArray(np.asarray(values), nulls)
+        elif kind == 'datetime':
+            data[column] = np.load(f"{prefix}.npy", mmap_mode='r')
+        elif kind == 'list':
+            items = _read_text(os.path.join(directory, f"{column}.items")).tolist()
+            offsets = np.load(f"{prefix}.offsets.npy").tolist()
+            values = np.empty(manifest['rows'], dtype=object)
+            values[:] = [items[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+            data[column] = values
+        else:
+            data[column] = _read_text(prefix)
+    return pd.DataFrame(data, columns=columns)
+
+def load_email_csv(path: str, columns: Optional[List[str]] = None,
+                   use_cache: bool = True, chunk_rows: int = 50000) -> pd.DataFrame:
+    """
+    Load the email thread CSV with parsed timestamps and decoded recipients
+
+    Args:
+        path: Path of the CSV file
+        columns: Columns to load (None loads all); other columns are never read
+        use_cache: Load from the column cache next to the CSV, building it
+                   first when it is missing or stale
+        chunk_rows: Rows parsed per chunk when reading the CSV
+
+    Returns:
+        DataFrame with the requested columns in file order
+    """
+    if not use_cache:
+        chunks = list(_read_chunks(path, chunk_rows, columns))
+        if not chunks:
+            return pd.read_csv(path, usecols=columns)
+        return pd.concat(chunks, ignore_index=True)
+
+    manifest = cache_manifest(path)
+    if manifest is None:
+        try:
+            manifest = build_cache(path, chunk_rows)
+        except OSError as e:
+            # Read-only location: fall back to parsing the CSV directly
+            print(f"Could not build column cache for {path}: {str(e)}")
+            return load_email_csv(path, columns, use_cache=False, chunk_rows=chunk_rows)
+
+    if columns is None:
+        columns = manifest['columns']
+    else:
+        missing = [column for column in columns if column not in manifest['columns']]
+        if missing:
+            raise ValueError(f"Columns not in {path}: {missing}")
+        columns = [column for column in manifest['columns'] if column in columns]
+    return _load_cache(path, manifest, columns)
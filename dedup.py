@@ -0,0 +1,402 @@
+import io
+import os
+import re
+import threading
+import zlib
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from vector_storage import atomic_write
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Odd 64-bit multipliers combining consecutive token hashes into a shingle hash
+_SHINGLE_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+                                 0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD], dtype=np.uint64)
+# Change log targets marking a canonical email and a forgotten one
+_CANONICAL, _REMOVED = -1, -2
+
+class NearDuplicateIndex:
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, bands: int = 16,
+                 shingle_size: int = 3, seed: int = 1):
+        """
+        MinHash/LSH index of canonical emails for near-duplicate detection
+
+        Each text is reduced to a MinHash signature over its word shingles.
+        Signatures are split into `bands` bands; texts sharing any band land
+        in the same bucket and become candidates, so a lookup touches a few
+        buckets rather than every stored email. Candidates are confirmed by
+        the fraction of agreeing signature values, which estimates the
+        Jaccard similarity of the shingle sets.
+
+        Duplicates are recorded as aliases of a canonical email and are not
+        added to the buckets themselves.
+
+        Args:
+            threshold: Estimated Jaccard similarity at which texts are duplicates
+            num_perm: Signature length (number of hash permutations)
+            bands: LSH bands; num_perm must be divisible by it
+            shingle_size: Words per shingle (at most 5)
+            seed: Seed of the hash permutations
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        if not 1 <= shingle_size <= len(_SHINGLE_MULTIPLIERS):
+            raise ValueError(f"shingle_size must be between 1 and {len(_SHINGLE_MULTIPLIERS)}")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # a * x + b over uint64 with odd a is a permutation of the 64-bit hashes
+        self._a = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+        self._lock = threading.RLock()
+
+        self._signatures: Dict[int, np.ndarray] = {}  # Canonical id -> signature
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self.aliases: Dict[int, int] = {}             # Duplicate id -> canonical id
+        self._followers: Dict[int, List[int]] = {}    # Canonical id -> duplicate ids
+        # Ids whose state changed since the last save, and the snapshot that
+        # save appends them to
+        self._changed = set()
+        self._saved_path: Optional[str] = None
+        self._generation = 0
+        self._log_rows = 0
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def __contains__(self, item_id: int) -> bool:
+        """Whether an id is a canonical email"""
+        return item_id in self._signatures
+
+    def get_signature(self, item_id: int) -> Optional[np.ndarray]:
+        """Stored signature of a canonical email, or None"""
+        return self._signatures.get(item_id)
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash signature (uint64 array of length num_perm) of a text"""
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        hashes = np.fromiter((zlib.crc32(token.encode('utf-8')) for token in tokens),
+                             dtype=np.uint64, count=len(tokens))
+        if len(hashes) == 0:
+            hashes = np.zeros(1, dtype=np.uint64)
+        width = min(self.shingle_size, len(hashes))
+        count = len(hashes) - width + 1
+        shingles = np.zeros(count, dtype=np.uint64)
+        for offset in range(width):
+            shingles += hashes[offset:offset + count] * _SHINGLE_MULTIPLIERS[offset]
+        shingles = np.unique(shingles)
+        # Chunked so long threads do not materialize a num_perm x shingles matrix
+        signature = np.full(self.num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+        for start in range(0, len(shingles), 4096):
+            chunk = shingles[None, start:start + 4096]
+            np.minimum(signature, (chunk * self._a[:, None] + self._b[:, None]).min(axis=1),
+                       out=signature)
+        return signature
+
+    def _bands(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes()
+                for band in range(self.bands)]
+
+    def _insert(self, item_id: int, signature: np.ndarray) -> None:
+        self._changed.add(item_id)
+        self._signatures[item_id] = signature
+        for buckets, key in zip(self._buckets, self._bands(signature)):
+            buckets.setdefault(key, []).append(item_id)
+
+    def _unlink(self, item_id: int) -> None:
+        self._changed.add(item_id)
+        signature = self._signatures.pop(item_id)
+        for buckets, key in zip(self._buckets, self._bands(signature)):
+            members = buckets[key]
+            members.remove(item_id)
+            if not members:
+                del buckets[key]
+
+    def _alias(self, item_id: int, canonical: int) -> None:
+        self._unalias(item_id)
+        self._changed.add(item_id)
+        self.aliases[item_id] = canonical
+        self._followers.setdefault(canonical, []).append(item_id)
+
+    def _unalias(self, item_id: int) -> None:
+        canonical = self.aliases.pop(item_id, None)
+        if canonical is not None:
+            self._changed.add(item_id)
+            followers = self._followers[canonical]
+            followers.remove(item_id)
+            if not followers:
+                del self._followers[canonical]
+
+    def query(self, signature: np.ndarray, exclude: Optional[int] = None) -> Optional[int]:
+        """
+        Most similar canonical email at or above the threshold
+
+        Args:
+            signature: Signature from `signature`
+            exclude: Id to ignore (the email being checked)
+
+        Returns:
+            Canonical id, or None if the text is not a duplicate
+        """
+        with self._lock:
+            candidates = set()
+            for buckets, key in zip(self._buckets, self._bands(signature)):
+                candidates.update(buckets.get(key, ()))
+            candidates.discard(exclude)
+            if not candidates:
+                return None
+            ids = list(candidates)
+            matrix = np.stack([self._signatures[item_id] for item_id in ids])
+            similarity = (matrix == signature).mean(axis=1)
+            best = int(np.argmax(similarity))
+            return ids[best] if similarity[best] >= self.threshold else None
+
+    def assign(self, ids: Iterable[int], texts: Iterable[str], return_promoted: bool = False
+               ) -> Union[Dict[int, int], Tuple[Dict[int, int], Dict[int, int]]]:
+        """
+        Register emails, recording near-duplicates as aliases
+
+        Emails are checked in order, so duplicates within the batch alias the
+        first of them. An id that is already canonical stays canonical (its
+        signature is refreshed); an existing alias is checked again. When a
+        canonical email's text changed so much that its aliases no longer
+        duplicate it, the first alias takes over the old signature and the
+        others point to it, as in `remove`.
+
+        Args:
+            ids: Email ids
+            texts: Texts to compare, aligned with `ids`
+            return_promoted: Also return the aliases promoted this way
+
+        Returns:
+            {duplicate_id: canonical_id} for the emails of this batch that are
+            duplicates, plus {promoted_id: old_canonical_id} if
+            `return_promoted` is set; copy the old vector to the new id before
+            replacing it
+        """
+        duplicates, promoted = {}, {}
+        with self._lock:
+            for item_id, text in zip(ids, texts):
+                item_id = int(item_id)
+                signature = self.signature(text)
+                if item_id in self._signatures:
+                    old = self._signatures[item_id]
+                    self._unlink(item_id)
+                    self._insert(item_id, signature)
+                    if (item_id in self._followers
+                            and (old == signature).mean() < self.threshold):
+                        promoted[self._hand_over(item_id, old)] = item_id
+                    continue
+                canonical = self.query(signature, exclude=item_id)
+                if canonical is None:
+                    self._unalias(item_id)
+                    self._insert(item_id, signature)
+                else:
+                    self._alias(item_id, canonical)
+                    duplicates[item_id] = canonical
+            # A promoted alias re-sent later in the batch may have changed again
+            promoted = {heir: old for heir, old in promoted.items() if heir in self._signatures}
+        if return_promoted:
+            return duplicates, promoted
+        return duplicates
+
+    def _hand_over(self, item_id: int, signature: np.ndarray) -> Optional[int]:
+        """
+        Make the first alias of a canonical email canonical with `signature`
+        and point the other aliases to it
+
+        Returns:
+            Promoted id, or None without aliases
+        """
+        followers = self._followers.pop(item_id, [])
+        if not followers:
+            return None
+        heir = followers[0]
+        del self.aliases[heir]
+        for alias in followers[1:]:
+            self.aliases[alias] = heir
+        self._changed.update(followers)
+        if len(followers) > 1:
+            self._followers[heir] = followers[1:]
+        self._insert(heir, signature)
+        return heir
+
+    def discard(self, ids: Iterable[int]) -> List[int]:
+        """
+        Forget emails, dropping the aliases of forgotten canonical emails too
+
+        Used when registered emails could not be stored after all.
+
+        Returns:
+            Alias ids that were dropped along with their canonical email
+        """
+        dropped = []
+        with self._lock:
+            for item_id in ids:
+                item_id = int(item_id)
+                self._unalias(item_id)
+                if item_id in self._signatures:
+                    self._unlink(item_id)
+                    followers = self._followers.pop(item_id, [])
+                    for alias in followers:
+                        del self.aliases[alias]
+                    self._changed.update(followers)
+                    dropped.extend(followers)
+        return dropped
+
+    def remove(self, ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Delete emails; the first alias of a deleted canonical email takes its place
+
+        The promoted alias keeps the old canonical signature, which it was
+        near-identical to, and the remaining aliases point to it.
+
+        Returns:
+            {promoted_id: old_canonical_id}; copy the old vector to the new id
+        """
+        promoted = {}
+        with self._lock:
+            for item_id in ids:
+                item_id = int(item_id)
+                self._unalias(item_id)
+                if item_id not in self._signatures:
+                    continue
+                signature = self._signatures[item_id]
+                self._unlink(item_id)
+                heir = self._hand_over(item_id, signature)
+                if heir is not None:
+                    promoted[heir] = item_id
+        # A promoted id deleted later in the same call is not promoted
+        return {heir: old for heir, old in promoted.items() if heir in self._signatures}
+
+    def snapshot(self, ids: Iterable[int]) -> Dict[int, tuple]:
+        """
+        Current state of some emails, to undo an `assign` with `restore`
+
+        Returns:
+            {id: (signature or None, canonical id or None)}
+        """
+        with self._lock:
+            return {int(item_id): (self._signatures.get(int(item_id)),
+                                   self.aliases.get(int(item_id)))
+                    for item_id in ids}
+
+    def restore(self, states: Dict[int, tuple]) -> None:
+        """Put emails back in the state recorded by `snapshot`"""
+        with self._lock:
+            for item_id, (signature, canonical) in states.items():
+                self._unalias(item_id)
+                if item_id in self._signatures:
+                    self._unlink(item_id)
+                if signature is not None:
+                    self._insert(item_id, signature)
+                elif canonical is not None:
+                    self._alias(item_id, canonical)
+                self._changed.add(item_id)
+
+    def aliases_of(self, canonical_id: int) -> List[int]:
+        """Ids recorded as duplicates of a canonical email"""
+        with self._lock:
+            return list(self._followers.get(canonical_id, []))
+
+    def entries(self):
+        """Canonical (ids, signature matrix) for persistence"""
+        with self._lock:
+            ids = np.array(list(self._signatures), dtype=np.int64)
+            matrix = (np.stack(list(self._signatures.values())) if len(ids)
+                      else np.empty((0, self.num_perm), dtype=np.uint64))
+        return ids, matrix
+
+    def load_entries(self, ids, signatures: np.ndarray, aliases: Dict[int, int]) -> None:
+        """Restore canonical signatures and aliases saved with `entries`"""
+        with self._lock:
+            for item_id, signature in zip(np.asarray(ids).tolist(), signatures):
+                if item_id in self._signatures:
+                    self._unlink(item_id)
+                self._insert(item_id, np.asarray(signature, dtype=np.uint64))
+            for alias, canonical in aliases.items():
+                self._alias(int(alias), int(canonical))
+
+    def save(self, path: str) -> None:
+        """
+        Persist the index to an .npz snapshot plus an append-only change log
+
+        Only the emails that changed since the last save to the same path are
+        appended to `{path}.log`, so a save costs O(changes). Once the log
+        outgrows the snapshot, both are rewritten as a fresh snapshot.
+        """
+        with self._lock:
+            changed = sorted(self._changed)
+            self._changed = set()
+            if (path != self._saved_path or not os.path.exists(path)
+                    or self._log_rows + len(changed) > max(len(self._signatures) + len(self.aliases), 1024)):
+                self._write_snapshot(path)
+                return
+            rows = np.zeros((len(changed), self.num_perm + 2), dtype=np.uint64)
+            for row, item_id in zip(rows, changed):
+                if item_id in self._signatures:
+                    target, row[2:] = _CANONICAL, self._signatures[item_id]
+                else:
+                    target = self.aliases.get(item_id, _REMOVED)
+                row[:2] = np.array([item_id, target], dtype=np.int64).view(np.uint64)
+            self._log_rows += len(changed)
+            # Appended under the lock so rows never land in a newer generation's log
+            if len(rows):
+                with open(f"{path}.log", 'ab') as f:
+                    f.write(rows.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def _write_snapshot(self, path: str) -> None:
+        """
+        Rewrite the snapshot and start an empty log of the next generation;
+        caller holds the lock
+
+        The log starts with the generation of the snapshot it applies to, so
+        a crash between the two writes leaves a stale log that is ignored.
+        """
+        self._generation += 1
+        ids, signatures = self.entries()
+        alias_pairs = np.array(list(self.aliases.items()), dtype=np.int64).reshape(-1, 2)
+        buffer = io.BytesIO()
+        np.savez(buffer, ids=ids, signatures=signatures, aliases=alias_pairs,
+                 generation=np.int64(self._generation))
+        atomic_write(path, buffer.getvalue())
+        atomic_write(f"{path}.log", np.int64(self._generation).tobytes())
+        self._saved_path = path
+        self._log_rows = 0
+
+    def load(self, path: str) -> None:
+        """Load an index written by `save`, replaying its change log"""
+        with np.load(path) as data:
+            aliases = dict(map(tuple, data['aliases'].tolist()))
+            self.load_entries(data['ids'], data['signatures'], aliases)
+            generation = int(data['generation']) if 'generation' in data else 0
+        
+        rows = np.empty((0, self.num_perm + 2), dtype=np.uint64)
+        if os.path.exists(f"{path}.log"):
+            with open(f"{path}.log", 'rb') as f:
+                log = f.read()
+            if len(log) >= 8 and int(np.frombuffer(log[:8], dtype=np.int64)[0]) == generation:
+                row_bytes = (self.num_perm + 2) * 8
+                # A torn last row from an interrupted save is ignored
+                count = (len(log) - 8) // row_bytes
+                rows = np.frombuffer(log[8:8 + count * row_bytes],
+                                     dtype=np.uint64).reshape(count, self.num_perm + 2)
+        
+        with self._lock:
+            for row in rows:
+                item_id, target = row[:2].view(np.int64).tolist()
+                self._unalias(item_id)
+                if item_id in self._signatures:
+                    self._unlink(item_id)
+                if target == _CANONICAL:
+                    self._insert(item_id, row[2:].copy())
+                elif target != _REMOVED:
+                    self._alias(item_id, target)
+            self._changed = set()
+            self._saved_path = path
+            self._generation = generation
+            self._log_rows = len(rows)
@@ -1,26 +1,157 @@
 import pandas as pd
 import numpy as np
-from typing import Union, List
+import re
+from typing import Union, List, Optional
+from column_cache import COLUMN_KINDS, cache_manifest, load_email_csv
+
+# Characters that make str.contains treat a query as a real regular expression
+REGEX_METACHARACTERS = set('.^$*+?{}[]\\|()')
 
 class EmailAnalyzer:
-    def __init__(self, data_path: str):
-        """Initialize the EmailAnalyzer with a dataset path."""
-        self.df = pd.read_csv(data_path)
+    def __init__(self, data_path: str, columns: Optional[List[str]] = None, use_cache: bool = True):
+        """
+        Initialize the EmailAnalyzer with a dataset path.
         
+        Args:
+            data_path: Path of the email thread CSV
+            columns: Columns to load (None loads all); search only sees these
+            use_cache: Load through the column cache next to the CSV
+        """
+        self.data_path = data_path
+        self.use_cache = use_cache
+        self.df = load_email_csv(data_path, columns=columns, use_cache=use_cache)
+        self._build_search_index()
+    
+    @staticmethod
+    def _as_text(column: pd.Series) -> pd.Series:
+        """Column values as searched: recipient lists in their CSV form, nulls as NaN"""
+        if COLUMN_KINDS.get(column.name) == 'list':
+            return column.map(lambda value: str(value) if isinstance(value, list) else np.nan)
+        return column.astype(str).where(column.notna(), np.nan)
+    
+    def _row_texts(self) -> pd.Series:
+        """Lowercased searchable text of each row, columns separated by NUL"""
+        columns = [self._as_text(self.df[column]).fillna('').str.lower() for column in self.df.columns]
+        if not columns:
+            return pd.Series([''] * len(self.df))
+        return columns[0].str.cat(columns[1:], sep='\x00') if len(columns) > 1 else columns[0]
+    
+    def _build_search_index(self, chunk_rows: int = 10000):
+        """
+        Build the trigram and token inverted indexes used by `search`
+        
+        Trigrams are taken over the UTF-8 bytes of each row's lowercased
+        text; postings are sorted int32 row arrays grouped by trigram code.
+        """
+        texts = self._row_texts()
+        
+        keys = []
+        for start in range(0, len(texts), chunk_rows):
+            chunk = [text.encode('utf-8') for text in texts.iloc[start:start + chunk_rows]]
+            data = np.frombuffer(b'\x01'.join(chunk), dtype=np.uint8)
+            if len(data) < 3:
+                continue
+            lengths = np.fromiter((len(text) + 1 for text in chunk), dtype=np.int64, count=len(chunk))
+            rows = np.repeat(np.arange(start, start + len(chunk), dtype=np.int64), lengths)[:len(data)]
+            codes = (data[:-2].astype(np.int64) << 16) | (data[1:-1].astype(np.int64) << 8) | data[2:]
+            # Skip trigrams spanning a column (\x00) or row (\x01) boundary
+            boundary = data < 2
+            valid = ~(boundary[:-2] | boundary[1:-1] | boundary[2:])
+            keys.append(np.unique((codes[valid] << 32) | rows[:-2][valid]))
+        
+        keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+        keys.sort()
+        codes = keys >> 32
+        self._trigram_rows = (keys & 0xFFFFFFFF).astype(np.int32)
+        self._trigram_codes, self._trigram_starts = np.unique(codes, return_index=True)
+        self._trigram_starts = np.append(self._trigram_starts, len(codes))
+        
+        # Whole-token postings, built with vectorized pandas operations
+        tokens = texts.str.findall(r'\w+').explode().dropna()
+        pairs = pd.DataFrame({'token': tokens.to_numpy(), 'row': np.asarray(tokens.index, dtype=np.int32)})
+        pairs = pairs.drop_duplicates().sort_values(['token', 'row'], kind='stable')
+        token_rows = pairs['row'].to_numpy(dtype=np.int32)
+        vocabulary, starts = np.unique(pairs['token'].to_numpy(dtype=object), return_index=True)
+        bounds = np.append(starts, len(token_rows))
+        self._token_postings = {
+            token: token_rows[bounds[i]:bounds[i + 1]] for i, token in enumerate(vocabulary)
+        }
+    
+    def _trigram_postings(self, code: int) -> np.ndarray:
+        position = np.searchsorted(self._trigram_codes, code)
+        if position == len(self._trigram_codes) or self._trigram_codes[position] != code:
+            return np.empty(0, dtype=np.int32)
+        return self._trigram_rows[self._trigram_starts[position]:self._trigram_starts[position + 1]]
+    
+    def _candidate_rows(self, query: str) -> Optional[np.ndarray]:
+        """
+        Rows that may contain the query, from the inverted indexes
+        
+        Returns:
+            Sorted row positions, or None when the indexes cannot narrow the
+            query (regular expressions and queries under three bytes)
+        """
+        if REGEX_METACHARACTERS.intersection(query):
+            return None
+        lowered = query.lower()
+        encoded = lowered.encode('utf-8')
+        if len(encoded) < 3:
+            return None
+        
+        postings = []
+        # Tokens bounded on both sides inside the query must be whole tokens of a match
+        for match in re.finditer(r'\w+', lowered):
+            start, end = match.span()
+            if start > 0 and end < len(lowered):
+                postings.append(self._token_postings.get(match.group(), np.empty(0, dtype=np.int32)))
+        data = np.frombuffer(encoded, dtype=np.uint8).astype(np.int64)
+        codes = np.unique((data[:-2] << 16) | (data[1:-1] << 8) | data[2:])
+        postings.extend(self._trigram_postings(code) for code in codes)
+        
+        postings.sort(key=len)
+        candidates = postings[0]
+        for rows in postings[1:]:
+            if len(candidates) == 0:
+                break
+            candidates = np.intersect1d(candidates, rows, assume_unique=True)
+        return candidates
+    
+    def _contains(self, df: pd.DataFrame, query: str) -> np.ndarray:
+        """Boolean mask of rows where any column contains the query (case-insensitive)"""
+        # Column by column, so the frame is never copied as strings all at once
+        mask = np.zeros(len(df), dtype=bool)
+        for column in df.columns:
+            mask |= self._as_text(df[column]).str.contains(
+                query, case=False, na=False).to_numpy(dtype=bool)
+        return mask
+    
+    def _match(self, query: str) -> pd.DataFrame:
+        """Rows matching the query, narrowed by the inverted indexes when possible"""
+        candidates = self._candidate_rows(query)
+        if candidates is None:
+            return self.df[self._contains(self.df, query)]
+        
+        # Verify the candidates exactly; only they are converted to strings
+        subset = self.df.iloc[candidates]
+        return subset[self._contains(subset, query)]
+    
     def search(self, query: str) -> pd.DataFrame:
         """
         Search through the email dataset based on the query.
         Returns matching results as a DataFrame.
         """
-        # Convert all columns to string type for searching
-        df_str = self.df.astype(str)
-        
-        # Search across all columns
-        mask = df_str.apply(lambda x: x.str.contains(query, case=False, na=False)).any(axis=1)
-        return self.df[mask]
+        return self._match(query)
     
     def get_statistics(self) -> dict:
         """Return basic statistics about the email dataset."""
+        manifest = cache_manifest(self.data_path) if self.use_cache else None
+        if manifest is not None:
+            # Counted when the cache was built; covers columns that were not loaded
+            return {
+                'total_emails': manifest['rows'],
+                'columns': manifest['columns'],
+                'null_counts': manifest['null_counts']
+            }
         stats = {
             'total_emails': len(self.df),
             'columns': list(self.df.columns),
@@ -37,11 +168,7 @@ class EmailAnalyzer:
     
     def search_emails(self, query: str) -> pd.DataFrame:
         """Search for emails containing the query string."""
-        # Convert all columns to string type for searching
-        df_str = self.df.astype(str)
-        # Search across all columns
-        mask = df_str.apply(lambda x: x.str.contains(query, case=False, na=False)).any(axis=1)
-        results = self.df[mask]
+        results = self._match(query)
         # Save results to CSV
         results.to_csv('search_results.csv', index=False)
         return results
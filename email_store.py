@@ -1,85 +1,307 @@
 import numpy as np
 import pickle
 import os
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional
+from dedup import NearDuplicateIndex
 from embeddings import DataEmbedder
+from preprocessing import EmailPreprocessor
 from retrieval import SemanticRetriever
+from vector_storage import UNKNOWN_HASH, VectorSegmentStore, content_hash
 
 class EmailStore:
-    def __init__(self, storage_path: str = "email_embeddings.pkl"):
+    def __init__(self, storage_path: str = "email_embeddings",
+                 embedder: Optional[DataEmbedder] = None,
+                 dedup_threshold: Optional[float] = 0.85,
+                 quantization: Optional[str] = None,
+                 reduction: Optional[str] = None):
         """
         Initialize the email store
         
         Args:
-            storage_path: Path to store the embeddings
+            storage_path: Directory storing the embedding segments. A legacy
+                          `<storage_path>.pkl` pickle is migrated on first use.
+            embedder: Embedder to use (defaults to the configured provider, with
+                      quoted replies stripped before embedding)
+            dedup_threshold: Estimated Jaccard similarity above which an email
+                             is stored as an alias of an earlier one and not
+                             embedded (None disables duplicate detection)
+            quantization: Keep the in-memory index as 'fp16' or 'sq8' vectors;
+                          searches rerank its candidates against the float32
+                          segments, which stay memory-mapped on disk
+            reduction: Index 'pca' or 'rotation' projections of the vectors
+                       (see SemanticRetriever), reranked the same way
         """
+        if storage_path.endswith('.pkl'):
+            storage_path = storage_path[:-len('.pkl')]
         self.storage_path = storage_path
-        self.embedder = DataEmbedder()
-        self.retriever = SemanticRetriever()
-        self.email_embeddings: Dict[int, np.ndarray] = {}
+        self.embedder = embedder or DataEmbedder(preprocessor=EmailPreprocessor())
+        self.storage = VectorSegmentStore(storage_path, dimension=self.embedder.dimension)
+        self.quantization = quantization
+        self.reduction = reduction
+        self.retriever = self._new_retriever()
+        self.dedup = NearDuplicateIndex(dedup_threshold) if dedup_threshold is not None else None
+        self.dedup_path = os.path.join(storage_path, 'dedup.npz')
         self.load_embeddings()
     
+    def _new_retriever(self) -> SemanticRetriever:
+        return SemanticRetriever(
+            embedder=self.embedder, quantization=self.quantization, reduction=self.reduction,
+            rescore_vectors=self.storage if self.quantization or self.reduction else None)
+    
+    def train(self, sample_size: Optional[int] = None) -> None:
+        """
+        Rebuild the index trained on a random sample of the stored vectors
+        
+        Quantized and reduced indexes train themselves once `min_train_size`
+        vectors have been added; call this to train them sooner, or to refit
+        them once the corpus has outgrown the sample they were trained on.
+        
+        Args:
+            sample_size: Number of vectors to train on (defaults to the
+                         index's `train_size`)
+        """
+        ids = self.storage.ids()
+        if not ids:
+            return
+        sample_size = min(sample_size or self.retriever.index_params['train_size'], len(ids))
+        rng = np.random.default_rng(0)
+        sample, _ = self.storage.get_batch(rng.choice(ids, sample_size, replace=False))
+        retriever = self._new_retriever()
+        retriever.train(sample)
+        for segment_ids, vectors in self.storage.segments():
+            retriever.add_vectors(segment_ids, vectors)
+        # Searches use the old index until the new one is complete
+        self.retriever = retriever
+    
+    @property
+    def email_embeddings(self) -> Dict[int, np.ndarray]:
+        """Map email ids to their stored embeddings (memory-mapped views)"""
+        return self.storage.as_dict()
+    
+    def _migrate_pickle(self) -> None:
+        """Move embeddings from the old pickle format into the segment store"""
+        legacy_path = f"{self.storage_path}.pkl"
+        if len(self.storage) or not os.path.exists(legacy_path):
+            return
+        with open(legacy_path, 'rb') as f:
+            legacy = pickle.load(f)
+        if legacy:
+            self.storage.append(list(legacy.keys()), np.stack(list(legacy.values())))
+        os.replace(legacy_path, f"{legacy_path}.migrated")
+    
     def load_embeddings(self) -> None:
         """Load existing embeddings from disk if they exist"""
-        if os.path.exists(self.storage_path):
-            try:
-                with open(self.storage_path, 'rb') as f:
-                    self.email_embeddings = pickle.load(f)
-                # Initialize retriever with loaded embeddings
-                self.retriever.add_items([
-                    {'id': id, 'embedding': emb} 
-                    for id, emb in self.email_embeddings.items()
-                ])
-            except Exception as e:
-                print(f"Error loading embeddings: {e}")
-    
-    def save_embeddings(self) -> None:
-        """Save embeddings to disk"""
         try:
-            with open(self.storage_path, 'wb') as f:
-                pickle.dump(self.email_embeddings, f)
+            self._migrate_pickle()
+            # Feed the memory-mapped segments straight to the retriever, no re-embedding needed
+            for ids, vectors in self.storage.segments():
+                self.retriever.add_vectors(ids, vectors)
+            if self.dedup is not None and os.path.exists(self.dedup_path):
+                self.dedup.load(self.dedup_path)
         except Exception as e:
-            print(f"Error saving embeddings: {e}")
+            print(f"Error loading embeddings: {e}")
     
-    def create_embeddings(self, emails: List[dict]) -> None:
+    def save_embeddings(self) -> None:
+        """Flush pending background compaction; appends are already durable"""
+        self.storage.wait_for_compaction()
+    
+    def _save_dedup(self) -> None:
+        if self.dedup is not None:
+            self.dedup.save(self.dedup_path)
+    
+    def duplicates_of(self, email_id: int) -> List[int]:
+        """Ids of the emails stored as near-duplicates of an email"""
+        return self.dedup.aliases_of(email_id) if self.dedup is not None else []
+    
+    def create_embeddings(self, emails: List[dict]) -> List[dict]:
         """
         Create embeddings for new emails
         
+        Near-duplicates of stored (or earlier) emails are recorded as aliases
+        of that canonical email instead: they are not embedded, stored or
+        indexed, and searches return the canonical email for them.
+        
         Args:
             emails: List of email dictionaries
+            
+        Returns:
+            Dead letters for emails that could not be embedded after retries
         """
+        all_ids = [email.get('id', idx) for idx, email in enumerate(emails)]
+        duplicates = {}
+        if self.dedup is not None:
+            texts = [self.embedder.extract_text(email) for email in emails]
+            keyed = [(email_id, text) for email_id, text in zip(all_ids, texts)
+                     if text is not None and text.strip()]
+            duplicates, promoted = self.dedup.assign([email_id for email_id, _ in keyed],
+                                                     [text for _, text in keyed],
+                                                     return_promoted=True)
+            # Aliases of an email rewritten beyond recognition inherit its old vector
+            heirs = [heir for heir, old in promoted.items() if old in self.storage]
+            if heirs:
+                matrix, _ = self.storage.get_batch([promoted[heir] for heir in heirs])
+                self.storage.append(heirs, matrix, [UNKNOWN_HASH] * len(heirs))
+                self.retriever.add_vectors(heirs, matrix)
+            # Emails that turned into aliases drop the vectors they had of their own
+            replaced = [email_id for email_id in duplicates if email_id in self.storage]
+            if replaced:
+                self.storage.delete(replaced)
+                self.retriever.delete(replaced)
+        positions = [idx for idx, email_id in enumerate(all_ids) if email_id not in duplicates]
+        
         # Generate embeddings
-        new_embeddings = self.embedder.batch_embed(emails)
+        new_embeddings, dead_letters = self.embedder.batch_embed([emails[idx] for idx in positions],
+                                                                 return_dead_letters=True)
+        for letter in dead_letters:
+            letter['index'] = positions[letter['index']]
         
-        # Update storage
-        for idx, embedding in new_embeddings.items():
-            if embedding is not None:
-                self.email_embeddings[idx] = embedding
+        # Append to storage, keyed by email id rather than batch position
+        ids = [all_ids[positions[idx]] for idx in new_embeddings]
+        if ids:
+            vectors = np.stack(list(new_embeddings.values())).astype(np.float32)
+            hashes = [self._content_hash(emails[positions[idx]]) for idx in new_embeddings]
+            self.storage.append(ids, vectors, hashes)
+            
+            # Update retriever
+            self.retriever.add_vectors(ids, vectors)
         
-        # Update retriever
-        self.retriever.add_items([
-            {'id': id, 'embedding': emb} 
-            for id, emb in new_embeddings.items()
-        ])
+        if self.dedup is not None:
+            # New canonical emails that failed take their aliases down with them
+            failed = [all_ids[letter['index']] for letter in dead_letters]
+            dropped = set(self.dedup.discard(email_id for email_id in failed
+                                             if email_id not in self.storage))
+            for idx, email_id in enumerate(all_ids):
+                if email_id in dropped:
+                    dead_letters.append({
+                        'index': idx,
+                        'item': emails[idx],
+                        'error': f"canonical email {duplicates.get(email_id)} could not be embedded",
+                        'transient': True,
+                        'attempts': 0
+                    })
+            self._save_dedup()
         
-        # Save to disk
-        self.save_embeddings()
+        return dead_letters
+    
+    def _content_hash(self, email: dict) -> Optional[int]:
+        """Hash of the text the embedder would embed for an email"""
+        text = self.embedder.extract_text(email)
+        if text is None or not text.strip():
+            return None
+        return content_hash(text)
+    
+    def _alias_unchanged(self, email: dict) -> bool:
+        """An alias whose text still matches the same canonical email"""
+        canonical = self.dedup.aliases.get(email['id']) if self.dedup is not None else None
+        if canonical is None:
+            return False
+        text = self.embedder.extract_text(email)
+        if text is None or not text.strip():
+            return False
+        return self.dedup.query(self.dedup.signature(text), exclude=email['id']) == canonical
     
-    def update_embeddings(self, emails: List[dict]) -> None:
+    def _delete(self, ids: List[int], snapshot: Dict[int, dict]) -> None:
+        """
+        Delete emails; an alias of a deleted canonical email inherits its vector
+        
+        Args:
+            ids: Email ids to delete (stored or aliases)
+            snapshot: Current emails by id, for the content hash of promoted aliases
+        """
+        promoted = self.dedup.remove(ids) if self.dedup is not None else {}
+        # Copy the inherited vectors before the tombstones hide them
+        heirs = [heir for heir, old in promoted.items() if old in self.storage]
+        vectors = [np.array(self.storage.get(promoted[heir])) for heir in heirs]
+        
+        stored = [email_id for email_id in ids if email_id in self.storage]
+        if stored:
+            self.storage.delete(stored)
+            self.retriever.delete(stored)
+        if heirs:
+            hashes = [self._content_hash(snapshot[heir]) if heir in snapshot else None
+                      for heir in heirs]
+            hashes = [UNKNOWN_HASH if h is None else h for h in hashes]
+            matrix = np.stack(vectors)
+            self.storage.append(heirs, matrix, hashes)
+            self.retriever.add_vectors(heirs, matrix)
+        self._save_dedup()
+    
+    def sync(self, emails: List[dict], full_snapshot: bool = True,
+             scope_ids: Optional[Iterable[int]] = None) -> Dict[str, list]:
+        """
+        Incrementally bring the store in line with a mailbox snapshot
+        
+        Only emails whose text changed since they were embedded (or that are
+        new) are sent to the embedder; emails missing from the snapshot are
+        deleted from storage and from the index. Aliases count as unchanged
+        while they still duplicate the same canonical email, and when a
+        canonical email is deleted one of its aliases takes over its vector.
+        
+        Args:
+            emails: Current emails of the snapshot (dicts with an 'id')
+            full_snapshot: The snapshot covers the whole mailbox, so every
+                           stored id missing from it is deleted
+            scope_ids: For a partial snapshot, the ids it covers (e.g. one
+                       folder); those missing from `emails` are deleted
+            
+        Returns:
+            Dictionary with the 'added', 'changed', 'unchanged' and 'deleted'
+            email ids, plus the 'failed' dead letters
+        """
+        summary = {'added': [], 'changed': [], 'unchanged': [], 'deleted': [], 'failed': []}
+        
+        to_embed, seen = [], set()
+        for email in emails:
+            email_id = email['id']
+            seen.add(email_id)
+            stored = self.storage.get_hash(email_id)
+            if stored is not None and stored == self._content_hash(email):
+                summary['unchanged'].append(email_id)
+            elif stored is None and self._alias_unchanged(email):
+                summary['unchanged'].append(email_id)
+            else:
+                to_embed.append(email)
+        
+        aliases = self.dedup.aliases if self.dedup is not None else {}
+        if full_snapshot:
+            candidates = self.storage.ids() + list(aliases)
+        else:
+            candidates = scope_ids if scope_ids is not None else []
+        gone = [email_id for email_id in candidates
+                if email_id not in seen and (email_id in self.storage or email_id in aliases)]
+        if gone:
+            self._delete(gone, {email['id']: email for email in emails})
+            summary['deleted'] = gone
+        
+        if to_embed:
+            existed = {email['id'] for email in to_embed
+                       if email['id'] in self.storage or email['id'] in aliases}
+            summary['failed'] = self.create_embeddings(to_embed)
+            for email in to_embed:
+                email_id = email['id']
+                if email_id in aliases:
+                    summary['changed' if email_id in existed else 'added'].append(email_id)
+                    continue
+                # Failed and empty emails keep whatever vector they had before
+                if self.storage.get_hash(email_id) != self._content_hash(email):
+                    continue
+                summary['changed' if email_id in existed else 'added'].append(email_id)
+        
+        return summary
+    
+    def update_embeddings(self, emails: List[dict]) -> List[dict]:
         """
         Update embeddings for existing emails or add new ones
         
+        Emails whose text is unchanged since they were embedded are skipped.
+        
         Args:
             emails: List of email dictionaries
+            
+        Returns:
+            Dead letters for emails that could not be embedded after retries
         """
-        # Only process emails that don't have embeddings or need updates
-        emails_to_update = [
-            email for email in emails
-            if email['id'] not in self.email_embeddings
-        ]
-        
-        if emails_to_update:
-            self.create_embeddings(emails_to_update)
+        return self.sync(emails, full_snapshot=False)['failed']
     
     def search(self, query: str, k: int = 10) -> List[tuple]:
         """
@@ -0,0 +1,296 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+# Per-user cache file, so embedding never leaves a database in the working directory
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'askyourmail', 'embeddings.db'
+)
+
+class EmbeddingCache:
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 100000,
+                 touch_batch_size: int = 1000):
+        """
+        Persistent content-addressed embedding cache backed by SQLite
+
+        Args:
+            path: Path to the SQLite cache file
+            max_entries: Maximum number of vectors kept before LRU eviction
+            touch_batch_size: Number of hits whose recency is buffered in memory
+                              before being written out (also written on `put_many`
+                              and `close`)
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_batch_size = touch_batch_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched: Dict[str, int] = {}  # key -> last_used not yet written
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used INTEGER NOT NULL
+            )
+        ''')
+        self._conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_last_used
+            ON embeddings(last_used)
+        ''')
+        self._conn.commit()
+
+        row = self._conn.execute(
+            'SELECT COUNT(*), COALESCE(MAX(last_used), 0) FROM embeddings'
+        ).fetchone()
+        self._size, self._clock = row[0], row[1]
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        """Build the cache key for a text embedded with a given model"""
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"{model}:{digest}"
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def _flush_touches(self) -> None:
+        """Write buffered last_used stamps; caller holds the lock and commits"""
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE embeddings SET last_used = ? WHERE key = ?',
+                [(stamp, key) for key, stamp in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up several keys at once
+
+        Args:
+            keys: Cache keys to look up
+
+        Returns:
+            Dictionary mapping the keys that were found to their vectors
+        """
+        found: Dict[str, np.ndarray] = {}
+        unique_keys = list(dict.fromkeys(keys))
+
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})',
+                    chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).copy()
+
+            if found:
+                # Hits only refresh recency, so they are written in batches
+                stamp = self._tick()
+                self._touched.update((key, stamp) for key in found)
+                if len(self._touched) >= self.touch_batch_size:
+                    self._flush_touches()
+                    self._conn.commit()
+
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+
+        return found
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Look up a single key"""
+        return self.get_many([key]).get(key)
+
+    def put_many(self, entries: Dict[str, np.ndarray]) -> None:
+        """
+        Store several vectors, evicting least recently used entries if needed
+
+        Args:
+            entries: Dictionary mapping cache keys to vectors
+        """
+        if not entries:
+            return
+
+        with self._lock:
+            # Eviction must see the recency of recent hits
+            self._flush_touches()
+            stamp = self._tick()
+            before = self._conn.total_changes
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)',
+                [
+                    (key, np.asarray(vector, dtype=np.float32).tobytes(), stamp)
+                    for key, vector in entries.items()
+                ]
+            )
+            self._size += self._conn.total_changes - before
+
+            overflow = self._size - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    'DELETE FROM embeddings WHERE key IN '
+                    '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+                    (overflow,)
+                )
+                self._size -= overflow
+            self._conn.commit()
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        """Store a single vector"""
+        self.put_many({key: vector})
+
+    def stats(self) -> Dict:
+        """Get cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': self._size,
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def close(self) -> None:
+        """Write buffered recency updates and close the database connection"""
+        with self._lock:
+            self._flush_touches()
+            self._conn.commit()
+            self._conn.close()
+
+class QueryEmbeddingCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        """
+        In-process LRU cache for query embeddings with TTL and single-flight
+        coalescing of concurrent identical queries
+
+        Args:
+            max_entries: Maximum number of cached queries
+            ttl: Seconds a cached embedding stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, vector)
+        self._in_flight: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Fold case and collapse whitespace so trivially different queries share an entry"""
+        return " ".join(query.casefold().split())
+
+    def _lookup(self, key: str) -> Optional[np.ndarray]:
+        """Return a fresh cached vector or None; caller holds the lock"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _store(self, key: str, vector: np.ndarray) -> None:
+        """Insert a vector and evict the least recently used entries; caller holds the lock"""
+        self._entries[key] = (time.monotonic() + self.ttl, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, query: str) -> Optional[np.ndarray]:
+        """Look up a query, counting a hit or a miss"""
+        with self._lock:
+            vector = self._lookup(self.normalize(query))
+            if vector is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return vector
+
+    def put(self, query: str, vector: np.ndarray) -> None:
+        """Cache the embedding of a query"""
+        with self._lock:
+            self._store(self.normalize(query), vector)
+
+    def get_or_compute(self, query: str,
+                       compute: Callable[[], Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        """
+        Return the cached embedding of a query, computing it at most once
+        even when several threads ask for the same query concurrently
+
+        Args:
+            query: Query text
+            compute: Function producing the embedding (None on failure)
+
+        Returns:
+            Query embedding or None if it could not be computed
+        """
+        key = self.normalize(query)
+        with self._lock:
+            vector = self._lookup(key)
+            if vector is not None:
+                self.hits += 1
+                return vector
+
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'done': threading.Event(), 'vector': None}
+                self._in_flight[key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight['done'].wait()
+            return flight['vector']
+
+        try:
+            vector = compute()
+            flight['vector'] = vector
+            with self._lock:
+                if vector is not None:
+                    self._store(key, vector)
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight['done'].set()
+        return vector
+
+    def stats(self) -> Dict:
+        """Get cache statistics"""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0
+            }
+
+    def clear(self) -> None:
+        """Drop all cached queries"""
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,205 @@
+import asyncio
+import random
+import threading
+import time
+import numpy as np
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import openai
+    _TRANSIENT_API_ERRORS: Tuple[type, ...] = (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+except (ImportError, AttributeError):
+    _TRANSIENT_API_ERRORS = ()
+
+def is_transient_error(error: Exception) -> bool:
+    """Return True for errors worth retrying (rate limits, timeouts, 5xx)"""
+    if isinstance(error, _TRANSIENT_API_ERRORS + (TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, 'status_code', None) in (408, 409, 429, 500, 502, 503, 504)
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) used for rate limiting"""
+    return len(text) // 4 + 1
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        """
+        Token bucket refilled continuously, shared by any number of event
+        loops and threads
+
+        Callers reserve tokens up front, running the bucket into debt, and
+        sleep until the debt is repaid, so waiting requests are served in
+        arrival order.
+
+        Args:
+            rate_per_minute: Tokens added per minute
+            capacity: Maximum burst size (defaults to one minute of tokens)
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        """Take `amount` tokens and return the seconds to wait before using them"""
+        # A single request larger than the bucket can only ever wait for a full bucket
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    async def acquire(self, amount: float = 1) -> None:
+        """Wait until `amount` tokens are available and take them"""
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class AsyncEmbeddingEngine:
+    def __init__(self, embed_fn: Callable[[List[str]], List[np.ndarray]],
+                 max_in_flight: int = 4,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 5,
+                 backoff_base: float = 0.5,
+                 backoff_max: float = 30.0):
+        """
+        Concurrent embedding engine with rate limiting and retries
+
+        Args:
+            embed_fn: Blocking function embedding a list of texts in one request;
+                      it must raise on failure rather than return None
+            max_in_flight: Maximum number of concurrent requests
+            requests_per_minute: Request rate limit (None for unlimited)
+            tokens_per_minute: Token rate limit (None for unlimited)
+            max_retries: Retries per request for transient errors
+            backoff_base: Initial backoff delay in seconds
+            backoff_max: Maximum backoff delay in seconds
+        """
+        self.embed_fn = embed_fn
+        self.max_in_flight = max_in_flight
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Kept for the engine's lifetime so limits hold across `run` calls
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # Event loop on a background thread, started by the first `run` and
+        # reused by every later one instead of creating a loop per call
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._loop_lock = threading.Lock()
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        # Full jitter keeps concurrent retries from synchronizing
+        return random.uniform(0, delay)
+
+    async def _embed_batch(self, batch: List[Tuple[int, str]], semaphore: asyncio.Semaphore,
+                           results: Dict[int, np.ndarray], dead_letters: List[dict]) -> None:
+        texts = [text for _, text in batch]
+        attempt = 0
+        while True:
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(sum(estimate_tokens(text) for text in texts))
+
+            try:
+                async with semaphore:
+                    vectors = await asyncio.to_thread(self.embed_fn, texts)
+                if len(vectors) != len(texts):
+                    raise ValueError(f"Expected {len(texts)} embeddings, got {len(vectors)}")
+                for (position, _), vector in zip(batch, vectors):
+                    results[position] = vector
+                return
+
+            except Exception as e:
+                transient = is_transient_error(e)
+                if transient and attempt < self.max_retries:
+                    await asyncio.sleep(self._backoff(attempt))
+                    attempt += 1
+                    continue
+
+                if not transient and len(batch) > 1:
+                    # Isolate the offending input instead of failing the whole batch
+                    await asyncio.gather(*[
+                        self._embed_batch([item], semaphore, results, dead_letters)
+                        for item in batch
+                    ])
+                    return
+
+                for position, text in batch:
+                    dead_letters.append({
+                        'position': position,
+                        'text': text,
+                        'error': str(e),
+                        'transient': transient,
+                        'attempts': attempt + 1
+                    })
+                return
+
+    async def embed_batches(self, batches: Sequence[List[Tuple[int, str]]]
+                            ) -> Tuple[Dict[int, np.ndarray], List[dict]]:
+        """
+        Embed batches of (position, text) pairs concurrently
+
+        Args:
+            batches: Batches to send, one request per batch
+
+        Returns:
+            Tuple of (position -> embedding, dead letters for items that
+            exhausted their retries)
+        """
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        results: Dict[int, np.ndarray] = {}
+        dead_letters: List[dict] = []
+
+        await asyncio.gather(*[
+            self._embed_batch(list(batch), semaphore, results, dead_letters)
+            for batch in batches if batch
+        ])
+        dead_letters.sort(key=lambda item: item['position'])
+        return results, dead_letters
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the engine's event loop thread if it is not running yet"""
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="embedding-engine",
+                                          daemon=True)
+                thread.start()
+                self._loop, self._loop_thread = loop, thread
+            return self._loop
+
+    def run(self, batches: Sequence[List[Tuple[int, str]]]
+            ) -> Tuple[Dict[int, np.ndarray], List[dict]]:
+        """
+        Blocking wrapper around embed_batches, safe to call from any thread
+        other than the engine's own, including one running an event loop
+        """
+        future = asyncio.run_coroutine_threadsafe(self.embed_batches(batches), self._ensure_loop())
+        return future.result()
+
+    def close(self) -> None:
+        """Stop the event loop thread; a later `run` starts a new one"""
+        with self._loop_lock:
+            loop, thread = self._loop, self._loop_thread
+            self._loop = self._loop_thread = None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
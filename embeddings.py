@@ -1,24 +1,255 @@
 import openai
 import os
+import hashlib
+import re
+import time
+import threading
+import zlib
 import numpy as np
-from typing import Union, Dict, Any, Optional
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+from typing import Union, Dict, Any, Optional, List, Tuple
 from dotenv import load_dotenv
+from embedding_cache import DEFAULT_CACHE_PATH, EmbeddingCache
+from embedding_pipeline import AsyncEmbeddingEngine
+from preprocessing import EmailPreprocessor
 
-# Load environment variables
-load_dotenv('key.env')
-openai.api_key = os.getenv('OPENAI_API_KEY')
+class LocalEmbeddingClient:
+    """
+    Offline stand-in for the OpenAI client.
+
+    Exposes the same `client.embeddings.create(model=..., input=...)` call
+    shape and returns deterministic pseudo-random unit vectors derived from
+    a hash of each input, so batching can be exercised without network access.
+    Latency and transient failures can be injected to exercise the retry path.
+    """
+    def __init__(self, dimension: int = 1536, latency: float = 0.0,
+                 failure_rate: float = 0.0, fail_texts: Optional[set] = None, seed: int = 0):
+        """
+        Args:
+            dimension: Dimension of the returned vectors
+            latency: Seconds each request sleeps before answering
+            failure_rate: Probability that a request raises a TimeoutError
+            fail_texts: Inputs that always make the request fail with a ValueError
+            seed: Seed for the failure injection
+        """
+        self.dimension = dimension
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.fail_texts = fail_texts or set()
+        self.calls = 0
+        self.embeddings = self
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.dimension)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def create(self, model: str, input: Union[str, List[str]]):
+        """Mimic openai.embeddings.create for a single string or a list of strings"""
+        with self._lock:
+            self.calls += 1
+            fail = bool(self.failure_rate) and self._rng.random() < self.failure_rate
+        texts = [input] if isinstance(input, str) else list(input)
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise TimeoutError("Simulated request timeout")
+        if self.fail_texts.intersection(texts):
+            raise ValueError("Simulated invalid input")
+        data = [
+            SimpleNamespace(index=i, embedding=self._vector(text))
+            for i, text in enumerate(texts)
+        ]
+        return SimpleNamespace(data=data, model=model)
+
+class EmbeddingProvider(ABC):
+    """
+    Base class for embedding backends.
+
+    Subclasses declare the dimension of the vectors they produce, the
+    largest number of inputs accepted per request and the largest input
+    (in tokens) they can embed, and implement `embed`.
+    """
+    name: str = "provider"
+    dimension: int = 0
+    max_batch_size: int = 1
+    max_tokens: int = 0
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        Embed several texts in one request
+        
+        Args:
+            texts: Non-empty texts to embed
+            
+        Returns:
+            List of float32 vectors aligned with `texts`; raises on failure
+        """
+
+class OpenAIProvider(EmbeddingProvider):
+    def __init__(self, model: str = "text-embedding-ada-002", client=None,
+                 dimension: int = 1536, max_batch_size: int = 2048, max_tokens: int = 8191):
+        """
+        Embeddings served by the OpenAI API
+        
+        Args:
+            model: Embedding model name
+            client: Client exposing `embeddings.create` (defaults to the openai module,
+                    configured from key.env)
+            dimension: Dimension of the model's vectors
+            max_batch_size: Maximum number of inputs per request
+            max_tokens: Maximum tokens per input
+        """
+        if client is None:
+            # Load environment variables
+            load_dotenv('key.env')
+            if os.getenv('OPENAI_API_KEY'):
+                openai.api_key = os.getenv('OPENAI_API_KEY')
+            client = openai
+        self.client = client
+        self.name = model
+        self.dimension = dimension
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+
+    def embed(self, texts: List[str]) -> List[np.ndarray]:
+        response = self.client.embeddings.create(
+            model=self.name,
+            input=texts
+        )
+        results: List[Optional[np.ndarray]] = [None] * len(texts)
+        for position, item in enumerate(response.data):
+            # The API echoes each input's position; fall back to response order
+            idx = getattr(item, 'index', position)
+            results[idx] = np.array(item.embedding, dtype=np.float32)
+        return results
+
+class LocalHashingProvider(EmbeddingProvider):
+    _token_pattern = re.compile(r"\w+")
+
+    def __init__(self, dimension: int = 384, n_features: int = 2 ** 13, seed: int = 0):
+        """
+        CPU-only offline embeddings: a signed hashing vectorizer over word
+        unigrams and bigrams followed by a fixed random projection
+        
+        Args:
+            dimension: Dimension of the projected vectors
+            n_features: Number of hashing buckets
+            seed: Seed of the projection matrix
+        """
+        self.name = f"local-hashing-{n_features}-{dimension}-{seed}"
+        self.dimension = dimension
+        self.n_features = n_features
+        self.max_batch_size = 1024
+        self.max_tokens = 8192
+        rng = np.random.default_rng(seed)
+        self.projection = (
+            rng.standard_normal((n_features, dimension)) / np.sqrt(dimension)
+        ).astype(np.float32)
+
+    def _features(self, text: str) -> Dict[int, float]:
+        tokens = self._token_pattern.findall(text.lower())
+        counts: Dict[int, float] = {}
+        for term in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+            h = zlib.crc32(term.encode('utf-8'))
+            bucket = h % self.n_features
+            sign = 1.0 if (h >> 31) & 1 else -1.0
+            counts[bucket] = counts.get(bucket, 0.0) + sign
+        return counts
+
+    def embed(self, texts: List[str]) -> List[np.ndarray]:
+        features = np.zeros((len(texts), self.n_features), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = self._features(text)
+            if not counts:
+                continue
+            buckets = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            # Sublinear term frequency keeps long emails from dominating
+            features[row, buckets] = np.sign(values) * (1.0 + np.log(np.maximum(np.abs(values), 1.0)))
+        
+        vectors = features @ self.projection
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return list(vectors / norms)
+
+def get_provider(name: str) -> EmbeddingProvider:
+    """
+    Build a provider by name
+    
+    Args:
+        name: 'openai' or 'local'
+        
+    Returns:
+        Embedding provider instance
+    """
+    name = name.lower()
+    if name == 'local':
+        return LocalHashingProvider()
+    if name == 'openai':
+        return OpenAIProvider()
+    raise ValueError(f"Unknown embedding provider: {name}")
+
+def default_provider(default: str = 'openai') -> EmbeddingProvider:
+    """Provider selected by the EMBEDDING_PROVIDER environment variable (else `default`)"""
+    return get_provider(os.getenv('EMBEDDING_PROVIDER', default))
 
 class DataEmbedder:
-    def __init__(self, content_field: str = 'content', batch_size: int = 100):
+    def __init__(self, content_field: str = 'content', batch_size: int = 100,
+                 provider: Optional[EmbeddingProvider] = None,
+                 client=None, model: Optional[str] = None,
+                 cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+                 cache_size: int = 100000,
+                 max_in_flight: int = 4,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 5,
+                 preprocessor: Optional[EmailPreprocessor] = None):
         """
         Initialize the embedder
         
         Args:
             content_field: Field name containing the text to embed
-            batch_size: Number of items to embed in one batch
+            batch_size: Number of items to embed in one batch (capped by the provider)
+            provider: Embedding backend (defaults to `default_provider()`, or to an
+                      OpenAIProvider when `client` is given)
+            client: Embeddings client exposing `embeddings.create`, for the OpenAI provider
+            model: Embedding model name, for the OpenAI provider (defaults to ada-002)
+            cache_path: Path of the persistent embedding cache (defaults to
+                        ~/.cache/askyourmail/embeddings.db; None disables caching)
+            cache_size: Maximum number of cached vectors before LRU eviction
+            max_in_flight: Maximum number of concurrent embedding requests
+            requests_per_minute: Request rate limit (None for unlimited)
+            tokens_per_minute: Token rate limit (None for unlimited)
+            max_retries: Retries per request for transient errors (429s, timeouts)
+            preprocessor: Email preprocessor applied to dict items with a content
+                          field, embedding a subject/participant header and the
+                          new content only (None embeds the field verbatim)
         """
         self.content_field = content_field
-        self.batch_size = batch_size
+        if provider is None:
+            if client is not None or model is not None:
+                provider = OpenAIProvider(model=model or "text-embedding-ada-002", client=client)
+            else:
+                provider = default_provider()
+        self.provider = provider
+        self.model = provider.name
+        self.dimension = provider.dimension
+        self.batch_size = min(batch_size, provider.max_batch_size)
+        self.cache = EmbeddingCache(cache_path, cache_size) if cache_path else None
+        self.engine = AsyncEmbeddingEngine(
+            self.provider.embed,
+            max_in_flight=max_in_flight,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_retries=max_retries
+        )
+        self.dead_letters: List[dict] = []
+        self.preprocessor = preprocessor
         
     def extract_text(self, data: Union[str, Dict[str, Any]]) -> Optional[str]:
         """
@@ -36,6 +267,8 @@ class DataEmbedder:
             elif isinstance(data, dict):
                 # Try to get text from specified field
                 if self.content_field in data:
+                    if self.preprocessor is not None:
+                        return self.preprocessor.prepare(data, self.content_field)
                     return str(data[self.content_field])
                 
                 # Fallback: concatenate all string/number values
@@ -51,59 +284,154 @@ class DataEmbedder:
             print(f"Error extracting text: {str(e)}")
             return None
 
+    def _cache_key(self, text: str) -> str:
+        return EmbeddingCache.make_key(self.model, text)
+
+    def _truncate(self, text: str) -> str:
+        """Clip text to roughly the provider's token limit (~4 characters per token)"""
+        limit = self.provider.max_tokens * 4
+        return text[:limit] if len(text) > limit else text
+
     def generate_embedding(self, text: str) -> Optional[np.ndarray]:
         """
         Generate embedding for a single text
         
+        The request goes through the same engine as batches, so it is rate
+        limited and retried alike. A failure is recorded in `self.dead_letters`.
+        
         Args:
             text: Text to embed
             
         Returns:
             Numpy array of embeddings or None if failed
         """
-        try:
-            if not text.strip():
-                return None
-                
-            response = openai.embeddings.create(
-                model="text-embedding-ada-002",
-                input=text
-            )
-            return np.array(response.data[0].embedding)
-            
-        except Exception as e:
-            print(f"Error generating embedding: {str(e)}")
+        if not text.strip():
             return None
+        
+        (embedding,), failures = self._embed_texts([text])
+        self.dead_letters = []
+        for failure in failures:
+            print(f"Failed to embed text after {failure['attempts']} attempts: {failure['error']}")
+            self.dead_letters.append({
+                'index': 0,
+                'item': text,
+                'error': failure['error'],
+                'transient': failure['transient'],
+                'attempts': failure['attempts']
+            })
+        return embedding
+
+    def _embed_texts(self, texts: List[str]) -> Tuple[List[Optional[np.ndarray]], List[dict]]:
+        """
+        Embed texts through the cache and the concurrent embedding engine
+        
+        Args:
+            texts: Non-empty texts to embed
+            
+        Returns:
+            Tuple of (embeddings aligned with `texts`, dead letters whose
+            'position' refers to `texts`)
+        """
+        if not texts:
+            return [], []
+        
+        texts = [self._truncate(text) for text in texts]
+        keys = [self._cache_key(text) for text in texts]
+        found = self.cache.get_many(keys) if self.cache is not None else {}
+        
+        # Repeated texts are only sent once
+        missing: Dict[str, List[int]] = {}
+        for position, key in enumerate(keys):
+            if key not in found:
+                missing.setdefault(key, []).append(position)
+        
+        dead_letters = []
+        if missing:
+            unique_keys = list(missing)
+            pending = [(i, texts[missing[key][0]]) for i, key in enumerate(unique_keys)]
+            batches = [
+                pending[i:i + self.batch_size]
+                for i in range(0, len(pending), self.batch_size)
+            ]
+            if len(pending) > 1:
+                print(f"Embedding {len(pending)} texts in {len(batches)} batches")
+            
+            vectors, failures = self.engine.run(batches)
+            fresh = {unique_keys[i]: vector for i, vector in vectors.items()}
+            if self.cache is not None:
+                self.cache.put_many(fresh)
+            found.update(fresh)
+            
+            for failure in failures:
+                for position in missing[unique_keys[failure['position']]]:
+                    dead_letters.append(dict(failure, position=position))
+        
+        return [found.get(key) for key in keys], dead_letters
 
-    def batch_embed(self, data_list: list) -> Dict[int, np.ndarray]:
+    def generate_embeddings(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Generate embeddings for several texts with multi-input requests
+        
+        Cached texts are served from the cache and repeated texts are only
+        sent once.
+        
+        Args:
+            texts: Non-empty texts to embed
+            
+        Returns:
+            List of embeddings aligned with `texts` (None where embedding failed)
+        """
+        return self._embed_texts(texts)[0]
+
+    def batch_embed(self, data_list: list, return_dead_letters: bool = False
+                    ) -> Union[Dict[int, np.ndarray], Tuple[Dict[int, np.ndarray], List[dict]]]:
         """
         Generate embeddings for a list of data items in batches
         
+        Batches are sent concurrently, rate limited and retried with
+        exponential backoff. Items that still fail are recorded as dead
+        letters in `self.dead_letters`.
+        
         Args:
             data_list: List of items to embed
+            return_dead_letters: Also return the dead letters
             
         Returns:
-            Dictionary mapping indices to embeddings
+            Dictionary mapping indices to embeddings, plus the list of dead
+            letters (dicts with 'index', 'item', 'error', 'transient' and
+            'attempts') if `return_dead_letters` is set
         """
         embeddings = {}
         
-        for i in range(0, len(data_list), self.batch_size):
-            batch = data_list[i:i + self.batch_size]
-            print(f"Processing batch {i//self.batch_size + 1}/{(len(data_list)-1)//self.batch_size + 1}")
-            
-            for j, item in enumerate(batch):
-                idx = i + j
-                
-                # Extract text
-                text = self.extract_text(item)
-                if text is None:
-                    continue
-                
-                # Generate embedding
-                embedding = self.generate_embedding(text)
-                if embedding is not None:
-                    embeddings[idx] = embedding
+        indices, texts = [], []
+        for idx, item in enumerate(data_list):
+            # Extract text
+            text = self.extract_text(item)
+            if text is None or not text.strip():
+                print(f"Skipping item {idx}: no text to embed")
+                continue
+            indices.append(idx)
+            texts.append(text)
+        
+        vectors, failures = self._embed_texts(texts)
+        for idx, embedding in zip(indices, vectors):
+            if embedding is not None:
+                embeddings[idx] = embedding
+        
+        self.dead_letters = []
+        for failure in failures:
+            idx = indices[failure['position']]
+            print(f"Failed to embed item {idx} after {failure['attempts']} attempts: {failure['error']}")
+            self.dead_letters.append({
+                'index': idx,
+                'item': data_list[idx],
+                'error': failure['error'],
+                'transient': failure['transient'],
+                'attempts': failure['attempts']
+            })
         
+        if return_dead_letters:
+            return embeddings, self.dead_letters
         return embeddings
 
     def embed_single(self, data: Union[str, Dict[str, Any]]) -> Optional[np.ndarray]:
@@ -123,9 +451,9 @@ class DataEmbedder:
         return self.generate_embedding(text)
 
 # For backward compatibility
-def generate_email_embeddings(input_data):
+def generate_email_embeddings(input_data, embedder: Optional[DataEmbedder] = None):
     """Legacy function for backward compatibility"""
-    embedder = DataEmbedder()
+    embedder = embedder or DataEmbedder()
     if isinstance(input_data, list):
         return embedder.batch_embed(input_data)
     else:
@@ -1,9 +1,14 @@
 import json
+import sys
+import tempfile
+import time
 import numpy as np
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence
 import math
-from embeddings import generate_email_embeddings
-from retrieval import retrieve_emails
+import faiss
+from embeddings import DataEmbedder, LocalHashingProvider, default_provider, get_provider, generate_email_embeddings
+from retrieval import SemanticRetriever, retrieve_emails
+from vector_storage import VectorSegmentStore
 
 # Example function to validate an email
 def validate_email(email):
@@ -51,18 +56,26 @@ def recall_at_k(relevances: List[float], total_relevant: int, k: int) -> float:
     return sum(relevances) / total_relevant
 
 class EmailEvaluator:
-    def __init__(self, emails: List[Dict[str, Any]]):
+    def __init__(self, emails: List[Dict[str, Any]], embedder: Optional[DataEmbedder] = None,
+                 provider: Optional[str] = None):
         """
         Initialize evaluator with email dataset
         
         Args:
             emails: List of email dictionaries
+            embedder: Embedder to evaluate (defaults to one built from `provider`)
+            provider: 'local' or 'openai'; without it EMBEDDING_PROVIDER is used,
+                      and the offline hashing provider if that is unset too
         """
         self.emails = emails
+        if embedder is None:
+            backend = get_provider(provider) if provider else default_provider('local')
+            embedder = DataEmbedder(provider=backend, cache_path=None)
+        self.embedder = embedder
         # Generate embeddings for all emails
         self.email_embeddings = {}
         for email in emails:
-            embedding = generate_email_embeddings(email)
+            embedding = generate_email_embeddings(email, embedder=self.embedder)
             if embedding is not None:
                 self.email_embeddings[email['thread_id']] = embedding
         
@@ -211,7 +224,7 @@ class EmailEvaluator:
     
     def retrieve(self, query: str) -> List[int]:
         """Wrapper around the retrieval function"""
-        return retrieve_emails(query, self.email_embeddings, top_k=10)
+        return retrieve_emails(query, self.email_embeddings, top_k=10, embedder=self.embedder)
     
     def evaluate_query(self, query: str, relevant_ids: List[int], 
                       relevance_scores: Dict[int, float], k: int = 10) -> Dict[str, float]:
@@ -253,6 +266,124 @@ class EmailEvaluator:
             
         return avg_metrics
 
+def compare_indexes(vectors: np.ndarray, queries: np.ndarray, configs: Dict[str, dict],
+                    k: int = 10, index_type: str = 'cosine') -> Dict[str, Dict[str, float]]:
+    """
+    Measure recall@k of index configurations against exact float32 search
+    
+    Args:
+        vectors: (n, d) database vectors
+        queries: (q, d) query vectors
+        configs: Name -> SemanticRetriever keyword arguments; `rescore: True`
+                 reranks against the full-precision vectors, kept in a
+                 temporary VectorSegmentStore as the stores keep them
+        k: Results per query
+        index_type: SemanticRetriever index type ('cosine', 'l2', 'hnsw', ...)
+        
+    Returns:
+        Dictionary keyed like `configs`, each with recall@k, index bytes per
+        vector, index dimension and milliseconds per query
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    ids = np.arange(len(vectors))
+    dimension = vectors.shape[1]
+    embedder = DataEmbedder(provider=LocalHashingProvider(dimension=dimension), cache_path=None)
+    
+    def measure(retriever: SemanticRetriever) -> Dict[str, Any]:
+        retriever.add_vectors(ids, vectors)
+        started = time.perf_counter()
+        hits = retriever.search_vectors(queries, k)
+        elapsed = time.perf_counter() - started
+        return {
+            'hits': [[item_id for item_id, _ in row] for row in hits],
+            'bytes_per_vector': len(faiss.serialize_index(retriever.index)) / len(vectors),
+            'dimension': retriever.index_dimension,
+            'ms_per_query': 1000 * elapsed / len(queries)
+        }
+    
+    exact = measure(SemanticRetriever(dimension=dimension, embedder=embedder,
+                                      index_type='cosine' if index_type == 'cosine' else 'l2'))
+    runs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        storage = VectorSegmentStore(directory, dimension=dimension)
+        storage.append(ids, vectors)
+        for name, config in configs.items():
+            config = dict(config)
+            rescore = config.pop('rescore', False)
+            runs[name] = measure(SemanticRetriever(
+                dimension=dimension, embedder=embedder, index_type=index_type,
+                rescore_vectors=storage if rescore else None, **config))
+    
+    results = {}
+    for name, run in runs.items():
+        recall = np.mean([len(set(found) & set(truth)) / len(truth) if truth else 1.0
+                          for found, truth in zip(run['hits'], exact['hits'])])
+        results[name] = {f"recall@{k}": float(recall),
+                         'bytes_per_vector': run['bytes_per_vector'],
+                         'dimension': run['dimension'],
+                         'ms_per_query': run['ms_per_query']}
+    return results
+
+def evaluate_quantization(vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+                          index_type: str = 'cosine',
+                          quantizations: Sequence[str] = ('fp16', 'sq8')) -> Dict[str, Dict[str, float]]:
+    """
+    Measure recall@k of quantized indexes against exact float32 search
+    
+    Each quantization is measured from the compressed index alone and with
+    exact rescoring against the full-precision vectors.
+    
+    Returns:
+        `compare_indexes` results keyed by 'float32', '<quantization>' and
+        '<quantization>+rescore'
+    """
+    configs = {'float32': {}}
+    for quantization in quantizations:
+        configs[quantization] = {'quantization': quantization}
+        configs[f"{quantization}+rescore"] = {'quantization': quantization, 'rescore': True}
+    return compare_indexes(vectors, queries, configs, k, index_type)
+
+def evaluate_reduction(vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+                       index_type: str = 'cosine',
+                       explained_variances: Sequence[float] = (0.8, 0.9, 0.95)) -> Dict[str, Dict[str, float]]:
+    """
+    Measure recall@k of PCA-reduced indexes against exact float32 search
+    
+    Returns:
+        `compare_indexes` results keyed by 'float32', 'pca<variance>' and
+        'pca<variance>+rescore'
+    """
+    configs = {'float32': {}}
+    for variance in explained_variances:
+        config = {'reduction': 'pca', 'index_params': {'explained_variance': variance}}
+        configs[f"pca{variance:g}"] = config
+        configs[f"pca{variance:g}+rescore"] = dict(config, rescore=True)
+    return compare_indexes(vectors, queries, configs, k, index_type)
+
+def _print_comparison(results: Dict[str, Dict[str, float]]):
+    print(f"{'index':<16}{'dims':>6}{'recall@10':>10}{'bytes/vector':>14}{'ms/query':>10}")
+    for name, metrics in results.items():
+        print(f"{name:<16}{metrics['dimension']:>6}{metrics['recall@10']:>10.3f}"
+              f"{metrics['bytes_per_vector']:>14.0f}{metrics['ms_per_query']:>10.2f}")
+
+def quantization_main(n: int = 20000, dimension: int = 1536, n_queries: int = 200):
+    """Compare quantizations on clustered synthetic vectors of the ada-002 dimension"""
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((n // 100, dimension))
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, dimension))
+    queries = vectors[rng.integers(0, n, n_queries)] + 0.3 * rng.standard_normal((n_queries, dimension))
+    _print_comparison(evaluate_quantization(vectors.astype(np.float32), queries.astype(np.float32)))
+
+def reduction_main(n: int = 20000, dimension: int = 1536, n_queries: int = 200):
+    """Compare PCA reductions on synthetic vectors whose variance decays like embedding spectra"""
+    rng = np.random.default_rng(0)
+    scales = np.arange(1, dimension + 1) ** -0.8
+    basis, _ = np.linalg.qr(rng.standard_normal((dimension, dimension)))
+    vectors = (rng.standard_normal((n, dimension)) * scales) @ basis.T
+    picked = rng.integers(0, n, n_queries)
+    queries = vectors[picked] + ((0.1 * rng.standard_normal((n_queries, dimension)) * scales) @ basis.T)
+    _print_comparison(evaluate_reduction(vectors.astype(np.float32), queries.astype(np.float32)))
+
 def main():
     # Load emails
     with open('dataset1.json', 'r') as f:
@@ -291,4 +422,9 @@ def main():
         print(f"{metric}: {avg_metrics[f'avg_{metric}']:.3f}")
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ['quantization']:
+        quantization_main()
+    elif sys.argv[1:] == ['reduction']:
+        reduction_main()
+    else:
+        main()
@@ -5,6 +5,7 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from embeddings import DataEmbedder, get_provider
 from retrieval import SemanticRetriever
 
 def main():
@@ -46,7 +47,11 @@ def main():
     ]
 
     # Initialize retriever
-    retriever = SemanticRetriever(content_field="content")
+    # The offline hashing backend needs no API key; set EMBEDDING_PROVIDER=openai for real embeddings
+    embedder = DataEmbedder(content_field="content",
+                            provider=get_provider(os.getenv('EMBEDDING_PROVIDER', 'local')),
+                            cache_path=None)
+    retriever = SemanticRetriever(embedder=embedder)
     
     # Add documents to the index
     print("Adding documents to index...")
@@ -61,6 +66,9 @@ def main():
         "data cleaning techniques"
     ]
     
+    # Results are keyed by each item's 'id'
+    by_id = {doc['id']: doc for doc in documents}
+    
     # Search and display results
     print("\nSearching documents...")
     for query in queries:
@@ -68,7 +76,7 @@ def main():
         results = retriever.search(query, k=2)
         
         for doc_id, score in results:
-            doc = documents[doc_id]
+            doc = by_id[doc_id]
             print(f"- {doc['title']} (Score: {score:.3f})")
             print(f"  Author: {doc['author']}")
             print(f"  Date: {doc['date']}")
@@ -5,6 +5,7 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from embeddings import DataEmbedder, get_provider
 from retrieval import SemanticRetriever
 
 def main():
@@ -34,7 +35,11 @@ def main():
     ]
 
     # Initialize retriever with description as the main content field
-    retriever = SemanticRetriever(content_field="description")
+    # The offline hashing backend needs no API key; set EMBEDDING_PROVIDER=openai for real embeddings
+    embedder = DataEmbedder(content_field="description",
+                            provider=get_provider(os.getenv('EMBEDDING_PROVIDER', 'local')),
+                            cache_path=None)
+    retriever = SemanticRetriever(embedder=embedder)
     
     # Add products to the index
     print("Adding products to index...")
@@ -49,6 +54,9 @@ def main():
         "wallet with card storage"
     ]
     
+    # Results are keyed by each item's 'id'
+    by_id = {product['id']: product for product in products}
+    
     # Search and display results
     print("\nSearching products...")
     for query in queries:
@@ -56,7 +64,7 @@ def main():
         results = retriever.search(query, k=2)
         
         for doc_id, score in results:
-            product = products[doc_id]
+            product = by_id[doc_id]
             print(f"- {product['name']} (Score: {score:.3f})")
             print(f"  Price: ${product['price']}")
             print(f"  Category: {product['category']}")
@@ -0,0 +1,237 @@
+import json
+import sqlite3
+import threading
+import time
+from queue import Full
+from typing import Dict, List, Optional, Tuple
+
+class DurableQueue:
+    def __init__(self, conn: sqlite3.Connection, lock: threading.RLock,
+                 high_water_mark: int = 100000, max_attempts: Optional[int] = 5):
+        """
+        Persistent FIFO of pending emails stored in a SQLite table
+
+        Items stay in the table until they are acknowledged, so everything
+        not yet acknowledged is delivered again after a restart
+        (at-least-once). Acknowledgements can join the caller's transaction
+        so they commit atomically with the processed results.
+
+        Args:
+            conn: Connection shared with the owning store
+            lock: Re-entrant lock serializing use of `conn`
+            high_water_mark: Maximum number of pending items before producers
+                             block or are rejected
+            max_attempts: Deliveries after which a requeued item is moved to
+                          the `ingest_dead_letters` table instead (None
+                          retries forever)
+        """
+        self.high_water_mark = high_water_mark
+        self.max_attempts = max_attempts
+        self._conn = conn
+        self._lock = lock
+        self._changed = threading.Condition(lock)
+
+        with self._lock, self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS ingest_queue (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(ingest_queue)')}
+            if 'attempts' not in columns:
+                self._conn.execute(
+                    'ALTER TABLE ingest_queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS ingest_dead_letters (
+                    seq INTEGER PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    failed_at REAL NOT NULL
+                )
+            ''')
+            self._depth = self._conn.execute('SELECT COUNT(*) FROM ingest_queue').fetchone()[0]
+        # Items up to the cursor have been handed out but not acknowledged yet
+        self._cursor = 0
+        self._available = self._depth
+
+    def __len__(self) -> int:
+        return self._depth
+
+    def _insert(self, payloads: List[str], enqueued_at: float) -> None:
+        """Insert serialized items; caller holds the lock and commits"""
+        self._conn.executemany(
+            'INSERT INTO ingest_queue (payload, enqueued_at) VALUES (?, ?)',
+            [(payload, enqueued_at) for payload in payloads]
+        )
+
+    def put(self, items: List[dict], block: bool = True, timeout: Optional[float] = None) -> None:
+        """
+        Append items, waiting while the queue is at its high-water mark
+
+        Args:
+            items: Items to queue (JSON-serializable dicts)
+            block: Wait for room instead of raising when the queue is full
+            timeout: Maximum seconds to wait for room (None waits forever)
+
+        Raises:
+            queue.Full: If the items do not fit and `block` is False, or the
+                        timeout expired (items queued before that are kept)
+        """
+        payloads = [json.dumps(item, default=str) for item in items]
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._changed:
+            if not block and self._depth + len(payloads) > self.high_water_mark:
+                raise Full(f"Ingest queue is at its high-water mark ({self.high_water_mark})")
+
+            while payloads:
+                while self._depth >= self.high_water_mark:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Full(f"Timed out waiting for room in the ingest queue "
+                                   f"({len(payloads)} items not queued)")
+                    self._changed.wait(remaining)
+
+                # Large imports are admitted in chunks as room frees up
+                room = self.high_water_mark - self._depth
+                chunk, payloads = payloads[:room], payloads[room:]
+                with self._conn:
+                    self._insert(chunk, time.time())
+                self._depth += len(chunk)
+                self._available += len(chunk)
+                self._changed.notify_all()
+
+    def get(self, max_items: int, timeout: Optional[float] = None
+            ) -> List[Tuple[int, float, dict]]:
+        """
+        Take up to `max_items` items not yet handed out, in FIFO order
+
+        Args:
+            max_items: Maximum number of items to return
+            timeout: Seconds to wait for a first item (None waits forever)
+
+        Returns:
+            List of (seq, enqueued_at, item) tuples, empty on timeout; pass
+            the seqs to `ack` or `requeue` once processed
+        """
+        with self._changed:
+            if not self._changed.wait_for(lambda: self._available > 0, timeout):
+                return []
+            rows = self._conn.execute(
+                'SELECT seq, enqueued_at, payload FROM ingest_queue '
+                'WHERE seq > ? ORDER BY seq LIMIT ?',
+                (self._cursor, max_items)
+            ).fetchall()
+            if rows:
+                self._cursor = rows[-1][0]
+            self._available -= len(rows)
+            return [(seq, enqueued_at, json.loads(payload)) for seq, enqueued_at, payload in rows]
+
+    def _delete(self, seqs: List[int]) -> int:
+        """Delete items; caller holds the lock and commits"""
+        before = self._conn.total_changes
+        self._conn.executemany('DELETE FROM ingest_queue WHERE seq = ?', [(seq,) for seq in seqs])
+        return self._conn.total_changes - before
+
+    def ack(self, seqs: List[int], commit: bool = True) -> int:
+        """
+        Acknowledge processed items, removing them from the queue
+
+        Args:
+            seqs: Sequence numbers returned by `get`
+            commit: Commit right away. With False the delete joins the
+                    caller's open transaction (the caller holds the lock) and
+                    the caller must pass the result to `acknowledged` once
+                    that transaction has committed.
+
+        Returns:
+            Number of items removed
+        """
+        with self._changed:
+            if not commit:
+                return self._delete(seqs)
+            with self._conn:
+                removed = self._delete(seqs)
+            self.acknowledged(removed)
+            return removed
+
+    def acknowledged(self, removed: int) -> None:
+        """Account for items removed by a committed `ack(..., commit=False)`"""
+        with self._changed:
+            self._depth -= removed
+            self._changed.notify_all()
+
+    def requeue(self, seqs: List[int]) -> int:
+        """
+        Put handed-out items back at the tail of the queue for another attempt
+
+        Items that have used up `max_attempts` deliveries are moved to the
+        `ingest_dead_letters` table instead, so a permanently failing item
+        cannot keep the queue from draining.
+
+        Returns:
+            Number of items dead-lettered
+        """
+        seqs = list(dict.fromkeys(seqs))
+        # Deliveries an item may already have had and still be requeued
+        limit = (1 << 62) if self.max_attempts is None else self.max_attempts - 1
+        with self._changed:
+            now = time.time()
+            with self._conn:
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    'INSERT INTO ingest_dead_letters (seq, payload, enqueued_at, attempts, failed_at) '
+                    'SELECT seq, payload, enqueued_at, attempts + 1, ? FROM ingest_queue '
+                    'WHERE seq = ? AND attempts >= ?',
+                    [(now, seq, limit) for seq in seqs]
+                )
+                dead = self._conn.total_changes - before
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    'INSERT INTO ingest_queue (payload, enqueued_at, attempts) '
+                    'SELECT payload, ?, attempts + 1 FROM ingest_queue '
+                    'WHERE seq = ? AND attempts < ?',
+                    [(now, seq, limit) for seq in seqs]
+                )
+                requeued = self._conn.total_changes - before
+                self._delete(seqs)
+            self._depth -= dead
+            self._available += requeued
+            self._changed.notify_all()
+        return dead
+
+    def dead_letters(self) -> List[Tuple[int, int, dict]]:
+        """Items given up on, as (seq, attempts, item) tuples in queue order"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT seq, attempts, payload FROM ingest_dead_letters ORDER BY seq'
+            ).fetchall()
+        return [(seq, attempts, json.loads(payload)) for seq, attempts, payload in rows]
+
+    def wait_until_empty(self, timeout: Optional[float] = None) -> bool:
+        """Block until every item has been acknowledged; False on timeout"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._depth == 0, timeout)
+
+    def oldest_age(self) -> float:
+        """Seconds since the oldest pending item was queued (0 when empty)"""
+        if self._depth == 0:
+            return 0.0
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT enqueued_at FROM ingest_queue ORDER BY seq LIMIT 1'
+            ).fetchone()
+        return max(0.0, time.time() - row[0]) if row else 0.0
+
+    def stats(self) -> Dict:
+        """Get queue statistics"""
+        return {
+            'depth': self._depth,
+            'in_flight': self._depth - self._available,
+            'oldest_age': self.oldest_age(),
+            'high_water_mark': self.high_water_mark
+        }
@@ -0,0 +1,269 @@
+import re
+import threading
+import numpy as np
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase alphanumeric tokens; deal numbers and tickers survive intact"""
+    return TOKEN_PATTERN.findall(text.casefold())
+
+class BM25Index:
+    def __init__(self, fields: Sequence[str] = ('subject', 'from', 'content'),
+                 k1: float = 1.2, b: float = 0.75, block_size: int = 128):
+        """
+        Incremental BM25 inverted index with block-max top-k pruning
+
+        Postings are append-only arrays of internal document numbers and
+        term frequencies. Each block of `block_size` postings keeps its
+        largest term frequency and shortest document, which bound the BM25
+        contribution of any document in the block; blocks that cannot lift
+        a document into the current top k are never scored.
+
+        Args:
+            fields: Item fields concatenated into the indexed text
+            k1: BM25 term frequency saturation
+            b: BM25 document length normalization
+            block_size: Postings per block for the block-max bounds
+        """
+        self.fields = tuple(fields)
+        self.k1 = k1
+        self.b = b
+        self.block_size = block_size
+        self._lock = threading.Lock()
+
+        self._term_ids: Dict[str, int] = {}
+        self._postings: List[Tuple[array, array]] = []  # Per term: (internal docs, frequencies)
+        self._df: List[int] = []                        # Live documents per term
+        self._blocks: Dict[int, Tuple[int, np.ndarray, np.ndarray]] = {}
+
+        # Per internal document; an updated item gets a new internal number
+        self._doc_ids = array('q')
+        self._doc_lengths = array('f')
+        self._doc_terms: List[Optional[List[int]]] = []
+        self._live = bytearray()
+        self._internal_of: Dict[int, int] = {}
+        self._total_length = 0.0
+
+    def __len__(self) -> int:
+        return len(self._internal_of)
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self._internal_of
+
+    def extract_text(self, item) -> str:
+        """Text indexed for an item (a string or a dict with the configured fields)"""
+        if isinstance(item, str):
+            return item
+        parts = []
+        for field in self.fields:
+            value = item.get(field)
+            if isinstance(value, (list, tuple)):
+                parts.extend(str(v) for v in value)
+            elif value is not None:
+                parts.append(str(value))
+        return " ".join(parts)
+
+    def _remove(self, item_id: int) -> bool:
+        """Retire the current document of an id; caller holds the lock"""
+        internal = self._internal_of.pop(item_id, None)
+        if internal is None:
+            return False
+        for term_id in self._doc_terms[internal]:
+            self._df[term_id] -= 1
+        self._doc_terms[internal] = None
+        self._live[internal] = 0
+        self._total_length -= self._doc_lengths[internal]
+        return True
+
+    def add(self, item_ids: Iterable[int], items: Iterable) -> None:
+        """
+        Index items, replacing any earlier version of the same ids
+
+        Args:
+            item_ids: External item ids
+            items: Strings or dicts, aligned with `item_ids`
+        """
+        with self._lock:
+            for item_id, item in zip(item_ids, items):
+                item_id = int(item_id)
+                self._remove(item_id)
+                counts = Counter(tokenize(self.extract_text(item)))
+                internal = len(self._doc_ids)
+                self._doc_ids.append(item_id)
+                self._doc_lengths.append(sum(counts.values()))
+                self._total_length += sum(counts.values())
+
+                term_ids = []
+                for term, frequency in counts.items():
+                    term_id = self._term_ids.get(term)
+                    if term_id is None:
+                        term_id = self._term_ids[term] = len(self._postings)
+                        self._postings.append((array('i'), array('i')))
+                        self._df.append(0)
+                    docs, frequencies = self._postings[term_id]
+                    docs.append(internal)
+                    frequencies.append(frequency)
+                    self._df[term_id] += 1
+                    term_ids.append(term_id)
+                self._doc_terms.append(term_ids)
+                self._live.append(1)
+                self._internal_of[item_id] = internal
+
+    def delete(self, item_ids: Iterable[int]) -> int:
+        """
+        Remove items; their postings are skipped until `compact`
+
+        Returns:
+            Number of items removed
+        """
+        with self._lock:
+            return sum(self._remove(int(item_id)) for item_id in item_ids)
+
+    def compact(self) -> None:
+        """Rebuild the postings without retired documents"""
+        with self._lock:
+            live = sorted(self._internal_of.items(), key=lambda pair: pair[1])
+            renumber = {internal: new for new, (_, internal) in enumerate(live)}
+            postings = []
+            for docs, frequencies in self._postings:
+                kept = [(renumber[d], f) for d, f in zip(docs, frequencies) if d in renumber]
+                postings.append((array('i', [d for d, _ in kept]), array('i', [f for _, f in kept])))
+            self._postings = postings
+            self._doc_ids = array('q', [item_id for item_id, _ in live])
+            self._doc_lengths = array('f', [self._doc_lengths[internal] for _, internal in live])
+            self._doc_terms = [self._doc_terms[internal] for _, internal in live]
+            self._live = bytearray(b'\x01' * len(live))
+            self._internal_of = {item_id: new for new, (item_id, _) in enumerate(live)}
+            self._blocks.clear()
+
+    def _block_stats(self, term_id: int, docs: np.ndarray, frequencies: np.ndarray,
+                     lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Max frequency and min document length per block, cached until the postings grow"""
+        cached = self._blocks.get(term_id)
+        if cached is not None and cached[0] == len(docs):
+            return cached[1], cached[2]
+        starts = np.arange(0, len(docs), self.block_size)
+        max_tf = np.maximum.reduceat(frequencies, starts).astype(np.float32)
+        min_dl = np.minimum.reduceat(lengths[docs], starts)
+        self._blocks[term_id] = (len(docs), max_tf, min_dl)
+        return max_tf, min_dl
+
+    def search(self, query: str, k: int = 10,
+               allowed_ids: Optional[Iterable[int]] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k BM25 search
+
+        Args:
+            query: Query text
+            k: Number of results
+            allowed_ids: Optional ids to restrict the search to
+
+        Returns:
+            List of (item_id, bm25_score) tuples, best first
+        """
+        with self._lock:
+            term_ids = list(dict.fromkeys(
+                self._term_ids[t] for t in tokenize(query) if t in self._term_ids
+            ))
+            n_docs = len(self._internal_of)
+            if not term_ids or n_docs == 0 or k <= 0:
+                return []
+
+            lengths = np.frombuffer(self._doc_lengths, dtype=np.float32)
+            if allowed_ids is None:
+                live = np.frombuffer(self._live, dtype=bool)
+            else:
+                live = np.zeros(len(lengths), dtype=bool)
+                live[[self._internal_of[i] for i in allowed_ids if i in self._internal_of]] = True
+            avgdl = self._total_length / n_docs
+
+            def norm(internal):
+                return self.k1 * (1 - self.b + self.b * lengths[internal] / avgdl)
+
+            def impact(idf, frequencies, dl_norm):
+                return idf * frequencies * (self.k1 + 1) / (frequencies + dl_norm)
+
+            terms = []
+            for term_id in term_ids:
+                docs_buffer, frequencies_buffer = self._postings[term_id]
+                docs = np.frombuffer(docs_buffer, dtype=np.int32)
+                frequencies = np.frombuffer(frequencies_buffer, dtype=np.int32).astype(np.float32)
+                if len(docs) == 0:
+                    continue
+                df = max(self._df[term_id], 1)
+                idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                max_tf, min_dl = self._block_stats(term_id, docs, frequencies, lengths)
+                min_norm = self.k1 * (1 - self.b + self.b * min_dl / avgdl)
+                bounds = impact(idf, max_tf, min_norm)
+                terms.append((docs, frequencies, idf, bounds))
+            if not terms:
+                return []
+
+            # Lower bound for the k-th best score: the k-th best single-term
+            # impact, taken from the most promising blocks of the strongest term
+            docs, frequencies, idf, bounds = max(terms, key=lambda term: term[3].max())
+            threshold, seen = 0.0, []
+            for block in np.argsort(-bounds, kind='stable'):
+                span = slice(block * self.block_size, (block + 1) * self.block_size)
+                in_block = docs[span][live[docs[span]]]
+                seen.append(impact(idf, frequencies[span][live[docs[span]]], norm(in_block)))
+                if sum(len(scores) for scores in seen) >= k:
+                    found = np.concatenate(seen)
+                    threshold = np.partition(found, len(found) - k)[len(found) - k]
+                    break
+
+            # A document can reach the threshold only through a block whose
+            # bound plus every other term's best contribution reaches it
+            total_bound = sum(term[3].max() for term in terms)
+            marked = np.zeros(len(lengths), dtype=bool)
+            for docs, _, _, bounds in terms:
+                # Small slack absorbs float rounding between the bounds and the exact scores
+                keep = np.flatnonzero(bounds + (total_bound - bounds.max()) >= threshold * (1 - 1e-5))
+                if len(keep):
+                    offsets = (keep[:, None] * self.block_size
+                               + np.arange(self.block_size)[None, :]).ravel()
+                    marked[docs[offsets[offsets < len(docs)]]] = True
+            candidates = np.flatnonzero(marked & live)
+            if len(candidates) == 0:
+                return []
+
+            # Exact scores of the surviving candidates
+            dense = np.zeros(len(lengths), dtype=np.float32)
+            for docs, frequencies, idf, _ in terms:
+                if len(candidates) * 16 < len(docs):
+                    # Few candidates: look them up in the long postings list
+                    positions = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+                    present = positions[docs[positions] == candidates]
+                else:
+                    present = np.flatnonzero(marked[docs] & live[docs])
+                dense[docs[present]] += impact(idf, frequencies[present], norm(docs[present]))
+            scores = dense[candidates]
+
+            top = min(k, len(candidates))
+            order = np.argpartition(-scores, top - 1)[:top]
+            order = order[np.argsort(-scores[order], kind='stable')]
+            item_ids = np.frombuffer(self._doc_ids, dtype=np.int64)[candidates[order]]
+            return list(zip(item_ids.tolist(), scores[order].tolist()))
+
+def reciprocal_rank_fusion(rankings: Iterable[List[Tuple[int, float]]], k: int = 10,
+                           rrf_k: int = 60) -> List[Tuple[int, float]]:
+    """
+    Fuse ranked result lists with reciprocal rank fusion
+
+    Args:
+        rankings: Ranked (item_id, score) lists, best first
+        k: Number of fused results
+        rrf_k: Rank smoothing constant
+
+    Returns:
+        List of (item_id, fused_score) tuples, best first
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (item_id, _) in enumerate(ranking, 1):
+            fused[item_id] = fused.get(item_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda pair: -pair[1])[:k]
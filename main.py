@@ -1,22 +1,38 @@
 import json
+import os
 from datetime import datetime
 from dateutil import parser
 from colorama import init, Fore, Style
 from retrieval import SemanticRetriever
+from embeddings import DataEmbedder
+from preprocessing import EmailPreprocessor
+from lexical import BM25Index
 import re
 
 # Initialize colorama for colored output
 init()
 
 class EmailSearchSystem:
-    def __init__(self, data_file="dataset1.json"):
-        """Initialize the email search system"""
+    def __init__(self, data_file="dataset1.json", search_mode="semantic"):
+        """
+        Initialize the email search system
+        
+        Args:
+            data_file: JSON file with the emails
+            search_mode: 'semantic' (similarity scores) or 'hybrid' (semantic
+                         and BM25 rankings fused by reciprocal rank)
+        """
+        if search_mode not in ('semantic', 'hybrid'):
+            raise ValueError(f"Unknown search mode: {search_mode}")
+        self.search_mode = search_mode
         # Load emails
         with open(data_file, "r") as file:
             self.emails = json.load(file)
             
-        # Initialize retriever
-        self.retriever = SemanticRetriever(content_field="content")
+        # Initialize retriever; emails are embedded without their quoted history,
+        # and the BM25 index catches exact names, numbers and tickers
+        embedder = DataEmbedder(content_field="content", preprocessor=EmailPreprocessor())
+        self.retriever = SemanticRetriever(embedder=embedder, lexical_index=BM25Index())
         self.retriever.add_items(self.emails)
         
         # Create email index by various fields
@@ -46,6 +62,34 @@ class EmailSearchSystem:
             except (KeyError, ValueError):
                 pass
 
+    def _candidate_ids(self, sender=None, recipient=None, date=None):
+        """
+        Turn the metadata filters of a query into the set of matching email ids
+        
+        Args:
+            sender: Substring of the sender address
+            recipient: Substring of a recipient address
+            date: Date the email was sent on
+            
+        Returns:
+            Set of matching email ids, or None if the query has no filter
+        """
+        candidates = None
+        
+        def narrow(ids):
+            return ids if candidates is None else candidates & ids
+        
+        if sender:
+            # Substring matches are resolved against the distinct addresses, not every email
+            candidates = narrow({idx for address, ids in self.sender_index.items()
+                                 if sender in address for idx in ids})
+        if recipient:
+            candidates = narrow({idx for address, ids in self.recipient_index.items()
+                                 if recipient in address for idx in ids})
+        if date:
+            candidates = narrow(set(self.date_index.get(date.strftime('%Y-%m-%d'), [])))
+        return candidates
+
     def _format_email(self, email, highlight_terms=None):
         """Format email for display with optional term highlighting"""
         # Format basic info
@@ -72,6 +116,10 @@ class EmailSearchSystem:
 
     def _parse_date_query(self, query):
         """Extract date information from query"""
+        return self._match_date(query)[0]
+
+    def _match_date(self, query):
+        """Parsed date of the query and its (start, end) span, or (None, None)"""
         # Common date formats and keywords
         date_patterns = [
             r'\b\d{4}-\d{1,2}-\d{1,2}\b',  # YYYY-MM-DD
@@ -85,10 +133,10 @@ class EmailSearchSystem:
             match = re.search(pattern, query, re.IGNORECASE)
             if match:
                 try:
-                    return parser.parse(match.group())
+                    return parser.parse(match.group()), match.span()
                 except ValueError:
                     continue
-        return None
+        return None, None
 
     def search(self, query, max_results=5):
         """
@@ -111,38 +159,27 @@ class EmailSearchSystem:
         recipient_match = re.search(r'to\s+(\S+@\S+|\S+)', query_lower)
         
         # Check for date-specific queries
-        date = self._parse_date_query(query)
+        date, date_span = self._match_date(query)
         
-        # Get semantic search results
-        semantic_results = self.retriever.search(query, k=max_results*2)
-        result_ids = set()
-        
-        # Filter results based on specific criteria
-        filtered_results = []
-        for doc_id, score in semantic_results:
-            email = self.emails[doc_id]
-            
-            # Apply sender filter
-            if sender_match:
-                sender = sender_match.group(1)
-                if sender not in email.get('from', '').lower():
-                    continue
-                    
-            # Apply recipient filter
-            if recipient_match:
-                recipient = recipient_match.group(1)
-                if not any(recipient in r.lower() for r in email.get('to', [])):
-                    continue
-                    
-            # Apply date filter
-            if date:
-                email_date = datetime.fromtimestamp(email['timestamp'] / 1000)
-                if email_date.date() != date.date():
-                    continue
-            
-            filtered_results.append((doc_id, score))
-            if len(filtered_results) >= max_results:
-                break
+        # Resolve the filters to candidate emails and search only among those
+        candidates = self._candidate_ids(
+            sender=sender_match.group(1) if sender_match else None,
+            recipient=recipient_match.group(1) if recipient_match else None,
+            date=date
+        )
+        if candidates is not None and not candidates:
+            filtered_results = []
+        elif self.search_mode == 'hybrid':
+            # Clauses already applied as filters would only add noise to BM25
+            spans = [match.span() for match in (sender_match, recipient_match) if match]
+            spans += [date_span] if date_span else []
+            lexical_query = query
+            for start, end in sorted(spans, reverse=True):
+                lexical_query = lexical_query[:start] + ' ' + lexical_query[end:]
+            filtered_results = self.retriever.search(query, k=max_results, allowed_ids=candidates,
+                                                     mode='hybrid', lexical_query=lexical_query)
+        else:
+            filtered_results = self.retriever.search(query, k=max_results, allowed_ids=candidates)
         
         # Display results
         if not filtered_results:
@@ -157,7 +194,10 @@ class EmailSearchSystem:
             print(f"From: {email.get('from', 'Unknown')}")
             print(f"Subject: {email.get('subject', 'No Subject')}")
             print(f"Date: {datetime.fromtimestamp(email['timestamp'] / 1000).strftime('%Y-%m-%d')}")
-            print(f"Relevance Score: {score:.3f}")
+            if self.search_mode == 'hybrid':
+                print(f"Fused Rank Score: {score:.4f}")
+            else:
+                print(f"Relevance Score: {score:.3f}")
         
         # Interactive viewing
         while True:
@@ -191,7 +231,8 @@ def main():
     print("- 'Find emails sent to bob.jones in October'")
     print(f"{'='*60}{Style.RESET_ALL}\n")
     
-    search_system = EmailSearchSystem()
+    # SEARCH_MODE=hybrid adds BM25 matching of exact names, numbers and tickers
+    search_system = EmailSearchSystem(search_mode=os.getenv('SEARCH_MODE', 'semantic'))
     
     while True:
         try:
@@ -1,46 +1,188 @@
+import json
+from contextlib import nullcontext
 import numpy as np
 import sqlite3
 import os
-from typing import Dict, List, Optional, Iterator
+from typing import Dict, List, Optional, Iterator, Tuple
+from dedup import NearDuplicateIndex
 from embeddings import DataEmbedder
+from preprocessing import EmailPreprocessor
 from retrieval import SemanticRetriever
 from datetime import datetime
 import faiss
-from queue import Queue
-from threading import Thread, Lock
+from threading import Condition, Event, Thread, Lock, RLock
+from ingest_queue import DurableQueue
+from vector_storage import atomic_write
 import time
 
+# Statement texts are kept constant so sqlite3's statement cache reuses the prepared statements
+_UPSERT_SQL = (
+    'INSERT OR REPLACE INTO embeddings '
+    '(email_id, embedding, created_at, processed, batch_seq, text_length) '
+    'VALUES (?, ?, ?, ?, ?, ?)'
+)
+_SET_STAT_SQL = 'INSERT OR REPLACE INTO store_stats (name, value) VALUES (?, ?)'
+_SET_ALIAS_SQL = 'INSERT OR REPLACE INTO email_aliases (email_id, canonical_id) VALUES (?, ?)'
+_SET_SIGNATURE_SQL = 'INSERT OR REPLACE INTO minhash_signatures (email_id, signature) VALUES (?, ?)'
+
+class _StoredVectors:
+    def __init__(self, db_path: str, dimension: int, mmap_bytes: int = 1 << 30):
+        """
+        Full-precision vectors read back from the embeddings table, for
+        reranking the candidates of a quantized index
+        
+        Uses its own connection, so rescoring never waits for the writers'
+        lock; with WAL it reads the last committed state.
+        
+        Args:
+            db_path: Path to SQLite database
+            dimension: Vector dimension
+            mmap_bytes: SQLite memory-mapped I/O size, so candidate rows are
+                        read straight from the mapped file
+        """
+        self.db_path = db_path
+        self.dimension = dimension
+        self.mmap_bytes = mmap_bytes
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = Lock()
+    
+    def get_batch(self, ids) -> Tuple[np.ndarray, np.ndarray]:
+        """Vectors of the given ids (zero rows where missing) and a found mask"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1).tolist()
+        matrix = np.zeros((len(ids), self.dimension), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        position = {item_id: i for i, item_id in enumerate(ids)}
+        with self._lock:
+            if self._conn is None:
+                self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+                self._conn.execute(f'PRAGMA mmap_size={int(self.mmap_bytes)}')
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for email_id, blob in self._conn.execute(
+                        f'SELECT email_id, embedding FROM embeddings WHERE email_id IN ({placeholders})',
+                        chunk):
+                    matrix[position[email_id]] = np.frombuffer(blob, dtype=np.float32)
+                    found[position[email_id]] = True
+        return matrix, found
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
 class OptimizedEmailStore:
     def __init__(self, db_path: str = "email_store.db", 
                  index_path: str = "faiss_index",
                  batch_size: int = 100,
-                 processing_interval: int = 300):  # 5 minutes
+                 processing_interval: float = 2.0,
+                 embedder: Optional[DataEmbedder] = None,
+                 index_type: str = 'l2',
+                 index_params: Optional[dict] = None,
+                 num_workers: int = 2,
+                 max_batch_size: Optional[int] = None,
+                 index_save_interval: float = 60.0,
+                 queue_high_water_mark: int = 100000,
+                 block_when_full: bool = True,
+                 dedup_threshold: Optional[float] = 0.85,
+                 quantization: Optional[str] = None,
+                 reduction: Optional[str] = None,
+                 max_attempts: Optional[int] = 5):
         """
         Initialize optimized email store
         
         Args:
             db_path: Path to SQLite database
             index_path: Directory to store FAISS index
-            batch_size: Number of emails to process at once
-            processing_interval: Seconds between processing batches
+            batch_size: Initial (and smallest) number of emails flushed at once
+            processing_interval: Maximum seconds a queued email waits before its
+                                 batch is flushed, even if the batch is not full
+            embedder: Embedder to use (defaults to the configured provider, with
+                      quoted replies stripped before embedding)
+            index_type: FAISS index type (see SemanticRetriever); trained IVF/HNSW
+                        indexes are persisted with the store
+            index_params: Overrides for SemanticRetriever.DEFAULT_INDEX_PARAMS
+            num_workers: Number of concurrent flush workers
+            max_batch_size: Largest batch the adaptive sizing grows to under a
+                            backlog (defaults to 16 x batch_size)
+            index_save_interval: Minimum seconds between index snapshots
+            queue_high_water_mark: Maximum number of pending emails in the
+                                   persistent ingest queue
+            block_when_full: Make `queue_emails` wait for room at the high-water
+                             mark instead of raising queue.Full
+            dedup_threshold: Estimated Jaccard similarity above which an email
+                             is stored as an alias of an earlier one and not
+                             embedded (None disables duplicate detection)
+            quantization: Keep the in-memory index as 'fp16' or 'sq8' vectors;
+                          searches rerank its candidates against the float32
+                          rows of the database
+            reduction: Index 'pca' or 'rotation' projections of the vectors
+                       (see SemanticRetriever), reranked the same way; the
+                       fitted projection is saved inside the index snapshot
+            max_attempts: Times a transiently failing email is processed
+                          before it is moved to the queue's dead letters
         """
         self.db_path = db_path
         self.index_path = index_path
         self.batch_size = batch_size
         self.processing_interval = processing_interval
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size or batch_size * 16
+        self.index_save_interval = index_save_interval
+        self.block_when_full = block_when_full
         
-        self.embedder = DataEmbedder()
-        self.retriever = SemanticRetriever()
-        self.processing_queue = Queue()
+        self.embedder = embedder or DataEmbedder(preprocessor=EmailPreprocessor())
+        self.index_type = index_type
+        self.index_params = index_params
+        self.quantization = quantization
+        self.reduction = reduction
+        self._stored_vectors = (_StoredVectors(db_path, self.embedder.dimension)
+                                if quantization or reduction else None)
+        self.retriever = self._new_retriever()
+        self.dedup = NearDuplicateIndex(dedup_threshold) if dedup_threshold is not None else None
         self.lock = Lock()
+        self._db_lock = RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._counters = {'total_emails': 0, 'processed_emails': 0, 'write_seq': 0, 'text_chars': 0}
+        self._current_batch_size = batch_size
+        self._size_lock = Lock()
+        self._last_save = time.monotonic()
+        # Batch sequence numbers committed to the database but not yet in the index
+        self._unindexed_seqs = set()
+        self._max_seq = 0
+        # Last batch applied to the index; batches are indexed in commit order
+        self._indexed_seq = 0
+        self._index_turn = Condition(self.lock)
+        # Serializes batches from duplicate assignment to commit
+        self._assign_lock = Lock()
+        # Batches taken off the queue whose index update has not finished yet
+        self._in_flight = 0
+        self._batches_done = Condition()
+        self._flush_requested = Event()
+        self._stopping = Event()
+        self._workers: List[Thread] = []
         
         self._init_database()
+        # Pending emails live in the same database, so acknowledgements commit with the vectors
+        self.processing_queue = DurableQueue(self._conn, self._db_lock, queue_high_water_mark,
+                                             max_attempts)
         self._init_index()
         self._start_background_processor()
     
     def _init_database(self):
         """Initialize SQLite database with necessary tables"""
-        with sqlite3.connect(self.db_path) as conn:
+        # One long-lived connection shared by the workers, serialized by _db_lock
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30,
+                               cached_statements=256)
+        # Page size only takes effect before the database is first written
+        conn.execute('PRAGMA page_size=8192')
+        conn.execute('PRAGMA journal_mode=WAL')
+        # WAL with synchronous=NORMAL stays consistent and only risks the last commits on power loss
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')
+        with conn:
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS embeddings (
                     email_id INTEGER PRIMARY KEY,
@@ -53,78 +195,549 @@ class OptimizedEmailStore:
                 CREATE INDEX IF NOT EXISTS idx_processed 
                 ON embeddings(processed)
             ''')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(embeddings)')}
+            if 'batch_seq' not in columns:
+                # Sequence number of the batch that last wrote each row, used to
+                # find what an index snapshot is missing
+                conn.execute('ALTER TABLE embeddings ADD COLUMN batch_seq INTEGER NOT NULL DEFAULT 0')
+            if 'text_length' not in columns:
+                # Characters actually embedded per email, after preprocessing
+                conn.execute('ALTER TABLE embeddings ADD COLUMN text_length INTEGER')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_batch_seq
+                ON embeddings(batch_seq)
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS store_stats (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
+            # Near-duplicates point at the canonical email whose vector they share
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS email_aliases (
+                    email_id INTEGER PRIMARY KEY,
+                    canonical_id INTEGER NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS minhash_signatures (
+                    email_id INTEGER PRIMARY KEY,
+                    signature BLOB NOT NULL
+                )
+            ''')
+        self._conn = conn
+        self._load_counters()
+        self._load_dedup()
+    
+    def _load_dedup(self):
+        """Restore the near-duplicate index from its tables"""
+        if self.dedup is None:
+            return
+        rows = self._conn.execute('SELECT email_id, signature FROM minhash_signatures').fetchall()
+        signatures = (np.stack([np.frombuffer(blob, dtype=np.uint64) for _, blob in rows]) if rows
+                      else np.empty((0, self.dedup.num_perm), dtype=np.uint64))
+        aliases = dict(self._conn.execute('SELECT email_id, canonical_id FROM email_aliases'))
+        self.dedup.load_entries([email_id for email_id, _ in rows], signatures, aliases)
+    
+    def _load_counters(self):
+        """Load the maintained row counters, counting once if they were never stored"""
+        stored = dict(self._conn.execute('SELECT name, value FROM store_stats').fetchall())
+        if set(self._counters) <= set(stored):
+            self._counters = {name: stored[name] for name in self._counters}
+            return
+        
+        # Databases created before the counters existed: one full count, then kept up to date
+        self._counters['total_emails'] = self._conn.execute(
+            'SELECT COUNT(*) FROM embeddings'
+        ).fetchone()[0]
+        self._counters['processed_emails'] = self._conn.execute(
+            'SELECT COUNT(*) FROM embeddings WHERE processed = 1'
+        ).fetchone()[0]
+        self._counters['write_seq'] = self._conn.execute(
+            'SELECT COALESCE(MAX(batch_seq), 0) FROM embeddings'
+        ).fetchone()[0]
+        self._counters['text_chars'] = self._conn.execute(
+            'SELECT COALESCE(SUM(text_length), 0) FROM embeddings'
+        ).fetchone()[0]
+        with self._conn:
+            self._conn.executemany(_SET_STAT_SQL, self._counters.items())
+    
+    def _existing_rows(self, ids: List[int]) -> Dict[int, Tuple[bool, Optional[int]]]:
+        """Map the ids that have a row to (processed, text_length); caller holds _db_lock"""
+        existing = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            existing.update(
+                (email_id, (processed, length)) for email_id, processed, length in
+                self._conn.execute(
+                    f'SELECT email_id, processed, text_length FROM embeddings '
+                    f'WHERE email_id IN ({placeholders})',
+                    chunk
+                )
+            )
+        return existing
+    
+    def _delete_rows(self, table: str, ids: List[int]):
+        """Delete rows by email id; caller holds _db_lock"""
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            self._conn.execute(f'DELETE FROM {table} WHERE email_id IN ({placeholders})', chunk)
+    
+    def _write_aliases(self, canonical_ids: List[int], aliases: Dict[int, int],
+                       signatures: Dict[int, bytes], dropped: List[int]):
+        """
+        Record near-duplicate aliases and canonical signatures; caller holds
+        _db_lock inside the transaction of `_write_embeddings`
+        
+        Args:
+            canonical_ids: Emails stored with their own vector (no longer aliases)
+            aliases: {alias_id: canonical_id} found in the batch
+            signatures: MinHash signature bytes of the canonical emails
+            dropped: Aliases forgotten because their canonical email failed
+        """
+        self._delete_rows('email_aliases', canonical_ids + dropped)
+        self._conn.executemany(_SET_ALIAS_SQL, aliases.items())
+        self._conn.executemany(_SET_SIGNATURE_SQL, signatures.items())
+    
+    def _write_embeddings(self, ids: List[int], embeddings: List[np.ndarray],
+                          acks: Optional[List[int]] = None,
+                          text_lengths: Optional[List[int]] = None,
+                          aliases: Optional[Dict[int, int]] = None,
+                          signatures: Optional[Dict[int, bytes]] = None,
+                          dropped: Optional[List[int]] = None):
+        """
+        Bulk upsert processed embeddings in a single transaction, keeping the
+        counters exact and acknowledging the queue items they came from
+        
+        Args:
+            ids: Email ids
+            embeddings: Vectors aligned with `ids`
+            acks: Ingest queue sequence numbers to acknowledge in the same transaction
+            text_lengths: Length of the embedded text of each email
+            aliases: {alias_id: canonical_id} of near-duplicates that share a
+                     canonical vector instead of having a row
+            signatures: MinHash signature bytes of the canonical emails
+            dropped: Aliases forgotten because their canonical email failed
+        
+        Returns:
+            Sequence number of the batch; pass it to the index update
+        """
+        created_at = datetime.now().isoformat(' ')
+        
+        with self._db_lock, self._conn:
+            seq = self._counters['write_seq'] + 1
+            if text_lengths is None:
+                text_lengths = [None] * len(ids)
+            rows = [
+                (email_id, np.asarray(embedding, dtype=np.float32).tobytes(), created_at, True, seq,
+                 length)
+                for email_id, embedding, length in zip(ids, embeddings, text_lengths)
+            ]
+
+            # Rows being replaced determine how the counters move
+            unique_ids = list(dict.fromkeys(ids))
+            previous = self._existing_rows(unique_ids)
+            
+            self._conn.executemany(_UPSERT_SQL, rows)
+            # Emails that became aliases give up the rows they had of their own
+            replaced = self._existing_rows(list(aliases or {}))
+            self._delete_rows('embeddings', list(replaced))
+            
+            counters = dict(self._counters)
+            counters['write_seq'] = seq
+            counters['total_emails'] += len(unique_ids) - len(previous)
+            counters['processed_emails'] += len(unique_ids) - sum(
+                1 for processed, _ in previous.values() if processed
+            )
+            # Later duplicates of an id in the batch win, as in the upsert
+            latest = dict(zip(ids, text_lengths))
+            counters['text_chars'] += sum(length or 0 for length in latest.values()) - sum(
+                length or 0 for _, length in previous.values()
+            )
+            counters['total_emails'] -= len(replaced)
+            counters['processed_emails'] -= sum(1 for processed, _ in replaced.values() if processed)
+            counters['text_chars'] -= sum(length or 0 for _, length in replaced.values())
+            self._write_aliases(unique_ids, aliases or {}, signatures or {}, dropped or [])
+            self._conn.executemany(_SET_STAT_SQL, counters.items())
+            removed = self.processing_queue.ack(acks, commit=False) if acks else 0
+            with self.lock:
+                self._unindexed_seqs.add(seq)
+                self._max_seq = seq
+        
+        self._counters = counters
+        if removed:
+            self.processing_queue.acknowledged(removed)
+        return seq
+    
+    def _new_retriever(self) -> SemanticRetriever:
+        return SemanticRetriever(embedder=self.embedder, index_type=self.index_type,
+                                 index_params=self.index_params, quantization=self.quantization,
+                                 reduction=self.reduction, rescore_vectors=self._stored_vectors)
+    
+    @property
+    def _state_path(self) -> str:
+        return f"{self.index_path}.state.json"
     
     def _init_index(self):
-        """Initialize or load FAISS index"""
-        if os.path.exists(f"{self.index_path}.index"):
-            self.retriever.index = faiss.read_index(f"{self.index_path}.index")
-            # Load ID mapping
-            with open(f"{self.index_path}.map", 'rb') as f:
-                self.retriever.id_map = np.load(f)
-        else:
-            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        """
+        Load the FAISS snapshot, verify it against the database and index
+        only the rows written after it; the index is rebuilt from the
+        database if the snapshot is missing or does not match
+        """
+        directory = os.path.dirname(self.index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        snapshot_seq = self._load_snapshot()
+        if snapshot_seq is None:
+            snapshot_seq = -1
+        indexed = self._index_rows_after(snapshot_seq)
+        
+        if self.retriever.size != self._counters['total_emails']:
+            print(f"Index holds {self.retriever.size} vectors but the database has "
+                  f"{self._counters['total_emails']}; rebuilding from the database")
+            self.retriever = self._new_retriever()
+            indexed = self._index_rows_after(-1)
+        
+        self._max_seq = self._indexed_seq = self._counters['write_seq']
+        if indexed:
+            self._save_index()
+    
+    def _load_snapshot(self) -> Optional[int]:
+        """
+        Load the index snapshot if it is consistent with the database
+        
+        Returns:
+            Batch sequence number the snapshot covers, or None without a usable snapshot
+        """
+        if not os.path.exists(f"{self.index_path}.index"):
+            return None
+        try:
+            self.retriever.load(self.index_path)
+        except Exception as e:
+            print(f"Discarding unreadable index snapshot: {e}")
+            self.retriever = self._new_retriever()
+            return None
+        
+        if os.path.exists(self._state_path):
+            with open(self._state_path) as f:
+                state = json.load(f)
+            if (state.get('rows') == self.retriever.size
+                    and state.get('write_seq', -1) <= self._counters['write_seq']):
+                return state['write_seq']
+        elif self.retriever.size == self._counters['total_emails']:
+            # Snapshot written before the state file existed; trust a matching row count
+            return self._counters['write_seq']
+        
+        print("Index snapshot does not match the database; rebuilding it")
+        self.retriever = self._new_retriever()
+        return None
+    
+    def _index_rows_after(self, seq: int, chunk_rows: int = 50000,
+                          retriever: Optional[SemanticRetriever] = None) -> int:
+        """
+        Add the database rows written by batches after `seq` to the index
+        
+        Args:
+            seq: Last batch sequence number already in the index (-1 for all rows)
+            chunk_rows: Rows decoded and indexed at a time
+            retriever: Retriever to add them to (defaults to the store's)
+            
+        Returns:
+            Number of rows indexed
+        """
+        retriever = retriever or self.retriever
+        indexed = 0
+        with self._db_lock:
+            cursor = self._conn.execute(
+                'SELECT email_id, embedding FROM embeddings WHERE batch_seq > ? ORDER BY batch_seq',
+                (seq,)
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+                matrix = np.empty((len(rows), len(rows[0][1]) // 4), dtype=np.float32)
+                for i, (_, blob) in enumerate(rows):
+                    matrix[i] = np.frombuffer(blob, dtype=np.float32)
+                retriever.add_vectors(ids, matrix, copy=False)
+                indexed += len(rows)
+        return indexed
+    
+    def train(self, sample_size: Optional[int] = None) -> None:
+        """
+        Rebuild the index trained on a random sample of the stored vectors
+        
+        Quantized, reduced and IVF indexes train themselves once
+        `min_train_size` vectors have been added; call this to train them
+        sooner, or to refit them once the corpus has outgrown the sample they
+        were trained on. Searches keep using the old index meanwhile.
+        
+        Args:
+            sample_size: Number of vectors to train on (defaults to the
+                         index's `train_size`)
+        """
+        sample_size = sample_size or self.retriever.index_params['train_size']
+        with self._db_lock:
+            rows = self._conn.execute(
+                'SELECT embedding FROM embeddings ORDER BY RANDOM() LIMIT ?', (sample_size,)
+            ).fetchall()
+        if not rows:
+            return
+        sample = np.stack([np.frombuffer(blob, dtype=np.float32) for blob, in rows])
+        
+        # Holding the lock keeps batches from indexing into the old retriever
+        # meanwhile; rows they committed already are re-read, which is harmless
+        with self.lock:
+            retriever = self._new_retriever()
+            retriever.train(sample)
+            self._index_rows_after(-1, retriever=retriever)
+            self.retriever = retriever
+        self._save_index()
     
     def _save_index(self):
-        """Save FAISS index to disk"""
+        """Save FAISS index to disk along with the database position it covers"""
         with self.lock:
-            faiss.write_index(self.retriever.index, f"{self.index_path}.index")
-            with open(f"{self.index_path}.map", 'wb') as f:
-                np.save(f, self.retriever.id_map)
+            # Batches still being indexed are not covered by this snapshot
+            covered = min(self._unindexed_seqs) - 1 if self._unindexed_seqs else self._max_seq
+            rows = self.retriever.size
+            self.retriever.save(self.index_path)
+            atomic_write(self._state_path,
+                         json.dumps({'write_seq': covered, 'rows': rows}).encode('utf-8'))
+            self._last_save = time.monotonic()
     
     def _start_background_processor(self):
-        """Start background thread for processing email queue"""
-        def process_queue():
-            while True:
-                batch = []
-                while len(batch) < self.batch_size:
-                    try:
-                        email = self.processing_queue.get_nowait()
-                        batch.append(email)
-                    except Queue.Empty:
-                        break
-                
-                if batch:
-                    self._process_batch(batch)
-                
-                time.sleep(self.processing_interval)
-        
-        thread = Thread(target=process_queue, daemon=True)
-        thread.start()
-    
-    def _process_batch(self, emails: List[dict]):
-        """Process a batch of emails"""
-        # Generate embeddings
-        embeddings = self.embedder.batch_embed(emails)
-        
-        # Store in database
-        with sqlite3.connect(self.db_path) as conn:
-            for idx, embedding in embeddings.items():
-                if embedding is not None:
-                    conn.execute(
-                        'INSERT OR REPLACE INTO embeddings (email_id, embedding, created_at, processed) '
-                        'VALUES (?, ?, ?, ?)',
-                        (idx, embedding.tobytes(), datetime.now(), True)
-                    )
+        """Start the flush workers draining the email queue"""
+        for i in range(self.num_workers):
+            thread = Thread(target=self._flush_worker, name=f"email-flush-{i}", daemon=True)
+            thread.start()
+            self._workers.append(thread)
+    
+    def _next_batch(self) -> Tuple[List[int], List[dict]]:
+        """
+        Collect the next batch: wait for a first email, then keep adding until
+        the batch is full or the oldest email reaches its latency deadline
+        
+        Returns:
+            Queue sequence numbers and emails to process (empty when nothing arrived yet)
+        """
+        size = self._current_batch_size
+        items = self.processing_queue.get(size, timeout=0.1)
+        if not items:
+            return [], []
+        deadline = items[0][1] + self.processing_interval
+        
+        while len(items) < size:
+            if self._flush_requested.is_set() or self._stopping.is_set():
+                remaining = 0.0
+            else:
+                remaining = deadline - time.time()
+            # Short waits keep flush() and close() responsive
+            more = self.processing_queue.get(size - len(items), timeout=min(max(remaining, 0), 0.1))
+            if not more and remaining <= 0:
+                break
+            items.extend(more)
+        return [seq for seq, _, _ in items], [email for _, _, email in items]
+    
+    def _adapt_batch_size(self, batch_len: int):
+        """Grow the batch size while a backlog builds up, shrink it back when idle"""
+        with self._size_lock:
+            size = self._current_batch_size
+            if batch_len >= size and len(self.processing_queue) >= size:
+                self._current_batch_size = min(self.max_batch_size, size * 2)
+            elif batch_len < size // 2:
+                self._current_batch_size = max(self.batch_size, size // 2)
+    
+    def _flush_worker(self):
+        """Worker loop flushing batches until the store is closed and the queue drained"""
+        while True:
+            seqs, batch = self._next_batch()
+            if not batch:
+                if self._stopping.is_set():
+                    return
+                continue
+            
+            with self._batches_done:
+                self._in_flight += 1
+            try:
+                self._process_batch(batch, seqs)
+            except Exception as e:
+                print(f"Error processing batch of {len(batch)} emails: {e}")
+                # Unacknowledged emails go back to the queue for another attempt
+                self._requeue(seqs)
+            finally:
+                with self._batches_done:
+                    self._in_flight -= 1
+                    self._batches_done.notify_all()
+            self._adapt_batch_size(len(batch))
+    
+    def _requeue(self, seqs: List[int]):
+        """Requeue emails for another attempt, reporting those given up on"""
+        dead = self.processing_queue.requeue(seqs)
+        if dead:
+            print(f"Gave up on {dead} emails after {self.processing_queue.max_attempts} attempts; "
+                  f"they are kept in the ingest_dead_letters table")
+    
+    def _read_vectors(self, ids: List[int]) -> Dict[int, np.ndarray]:
+        """Stored vectors of the given email ids (ids without a row are left out)"""
+        vectors = {}
+        with self._db_lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for email_id, blob in self._conn.execute(
+                        f'SELECT email_id, embedding FROM embeddings WHERE email_id IN ({placeholders})',
+                        chunk):
+                    vectors[email_id] = np.frombuffer(blob, dtype=np.float32)
+        return vectors
+    
+    def _store_batch(self, texts: List[str], all_ids: List[int], seqs: Optional[List[int]]):
+        """
+        Record near-duplicates, embed the other emails and commit the batch;
+        the dedup state is rolled back if nothing could be committed
+        
+        Near-duplicates of stored or earlier emails become aliases and are
+        not embedded. Caller holds `_assign_lock` when dedup is enabled.
+        
+        Returns:
+            (batch sequence number or None, stored ids, their vectors,
+             {alias_id: canonical_id} found in the batch)
+        """
+        duplicates, known, states, promoted = {}, set(), {}, {}
+        if self.dedup is not None:
+            keyed = [idx for idx, text in enumerate(texts) if text.strip()]
+            keyed_ids = [all_ids[idx] for idx in keyed]
+            known = {email_id for email_id in keyed_ids if email_id in self.dedup}
+            # Aliases of the batch's emails may get promoted, so their state is kept too
+            states = self.dedup.snapshot(keyed_ids + [alias for email_id in keyed_ids
+                                                      for alias in self.dedup.aliases_of(email_id)])
+            duplicates, promoted = self.dedup.assign(keyed_ids, [texts[idx] for idx in keyed],
+                                                     return_promoted=True)
+        try:
+            positions = [idx for idx, email_id in enumerate(all_ids) if email_id not in duplicates]
+            embeddings, dead_letters = self.embedder.batch_embed([texts[idx] for idx in positions],
+                                                                 return_dead_letters=True)
+            failures = {positions[failure['index']]: failure for failure in dead_letters}
+        
+            dropped = []
+            if self.dedup is not None and failures:
+                # New canonical emails that failed take their aliases down with them,
+                # and those aliases are retried or given up together with them
+                by_id = {all_ids[idx]: failure for idx, failure in failures.items()}
+                dropped = self.dedup.discard(email_id for email_id in by_id if email_id not in known)
+                dropped_ids = set(dropped)
+                for idx, email_id in enumerate(all_ids):
+                    if email_id in dropped_ids and duplicates.get(email_id) in by_id:
+                        failures[idx] = by_id[duplicates.pop(email_id)]
+        
+            acks = list(seqs or [])
+            if seqs:
+                # Requeue emails that hit transient errors so they are retried next cycle;
+                # the others (stored, aliased, empty or permanently failing) are acknowledged
+                retry = {idx for idx, failure in failures.items() if failure['transient']}
+                acks = [seq for idx, seq in enumerate(seqs) if idx not in retry]
+                if retry:
+                    self._requeue([seqs[idx] for idx in sorted(retry)])
+        
+            ids = [all_ids[positions[idx]] for idx in embeddings]
+            vectors = list(embeddings.values())
+            lengths = [len(texts[positions[idx]]) for idx in embeddings]
+            aliases = dict(duplicates)
+            # Aliases of an email rewritten beyond recognition inherit its old vector
+            # (read before this batch replaces it) unless they were re-sent themselves
+            embedded = set(ids)
+            heirs = [heir for heir in promoted if heir not in embedded]
+            inherited = self._read_vectors([promoted[heir] for heir in heirs])
+            heirs = [heir for heir in heirs if promoted[heir] in inherited]
+            if heirs:
+                ids = heirs + ids
+                vectors = [inherited[promoted[heir]] for heir in heirs] + vectors
+                lengths = [None] * len(heirs) + lengths
+            for heir in promoted:
+                aliases.update((alias, heir) for alias in self.dedup.aliases_of(heir))
+            signatures = {}
+            if self.dedup is not None:
+                for email_id in ids:
+                    signature = self.dedup.get_signature(email_id)
+                    if signature is not None:
+                        signatures[email_id] = signature.tobytes()
+        
+            # Store in database
+            seq = None
+            if ids or aliases or dropped:
+                seq = self._write_embeddings(ids, vectors, acks, lengths, aliases, signatures,
+                                             dropped)
+            elif acks:
+                self.processing_queue.ack(acks)
+        except Exception:
+            # Nothing of the batch was stored; a retry must find the same duplicates
+            if states:
+                self.dedup.restore(states)
+            raise
+        return seq, ids, vectors, duplicates
+    
+    def _process_batch(self, emails: List[dict], seqs: Optional[List[int]] = None):
+        """
+        Process a batch of emails
+        
+        Args:
+            emails: Emails to embed and store
+            seqs: Ingest queue sequence numbers of the emails, acknowledged
+                  once their vectors are committed
+        """
+        # Preprocess once: the same text is embedded and its length recorded
+        texts = [self.embedder.extract_text(email) or '' for email in emails]
+        all_ids = [email.get('id', idx) for idx, email in enumerate(emails)]
+        
+        # From assigning duplicates to committing, batches take turns: no batch may
+        # alias a canonical email that another batch could still roll back
+        with self._assign_lock if self.dedup is not None else nullcontext():
+            seq, ids, vectors, duplicates = self._store_batch(texts, all_ids, seqs)
         
         # Update FAISS index
-        with self.lock:
-            self.retriever.add_items([
-                {'id': id, 'embedding': emb} 
-                for id, emb in embeddings.items()
-            ])
+        if seq is not None:
+            with self._index_turn:
+                # Committed batches are numbered consecutively; applying them in that
+                # order keeps the newest vector of an id re-sent by two workers
+                self._index_turn.wait_for(lambda: self._indexed_seq >= seq - 1)
+                try:
+                    if duplicates:
+                        self.retriever.delete(list(duplicates))
+                    if ids:
+                        self.retriever.add_vectors(ids, np.stack(vectors))
+                finally:
+                    # A failed update must not hold back every later snapshot and
+                    # batch; the row count check on the next start rebuilds the
+                    # index if needed
+                    self._unindexed_seqs.discard(seq)
+                    self._indexed_seq = max(self._indexed_seq, seq)
+                    self._index_turn.notify_all()
         
         # Periodically save index
-        self._save_index()
+        if time.monotonic() - self._last_save >= self.index_save_interval:
+            self._save_index()
     
-    def queue_emails(self, emails: List[dict]):
+    def queue_emails(self, emails: List[dict], timeout: Optional[float] = None):
         """
         Queue emails for processing
         
+        Emails are persisted before this returns, so they survive a restart.
+        
         Args:
             emails: List of email dictionaries
+            timeout: Maximum seconds to wait for room in a full queue
+            
+        Raises:
+            queue.Full: If the queue is at its high-water mark and either
+                        `block_when_full` is off or the timeout expired
         """
-        for email in emails:
-            self.processing_queue.put(email)
+        if self._stopping.is_set():
+            raise RuntimeError("Cannot queue emails on a closed store")
+        self.processing_queue.put(emails, block=self.block_when_full, timeout=timeout)
     
     def search(self, query: str, k: int = 10) -> List[tuple]:
         """
@@ -139,20 +752,84 @@ class OptimizedEmailStore:
         """
         return self.retriever.search(query, k)
     
+    def duplicates_of(self, email_id: int) -> List[int]:
+        """Ids of the emails stored as near-duplicates of an email"""
+        return self.dedup.aliases_of(email_id) if self.dedup is not None else []
+    
     def get_queue_size(self) -> int:
         """Get number of emails waiting to be processed"""
-        return self.processing_queue.qsize()
+        return len(self.processing_queue)
     
     def get_processing_stats(self) -> Dict:
-        """Get processing statistics"""
-        with sqlite3.connect(self.db_path) as conn:
-            total = conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
-            processed = conn.execute(
-                'SELECT COUNT(*) FROM embeddings WHERE processed = 1'
-            ).fetchone()[0]
-            
+        """Get processing statistics from the maintained counters"""
+        counters = self._counters
         return {
-            'total_emails': total,
-            'processed_emails': processed,
-            'queue_size': self.get_queue_size()
+            'total_emails': counters['total_emails'],
+            'processed_emails': counters['processed_emails'],
+            'queue_size': self.get_queue_size(),
+            'queue_oldest_age': self.processing_queue.oldest_age(),
+            'avg_text_length': (counters['text_chars'] / counters['total_emails']
+                                if counters['total_emails'] else 0.0),
+            'duplicate_emails': len(self.dedup.aliases) if self.dedup is not None else 0,
+            'batch_size': self._current_batch_size
         }
+    
+    def _drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Process everything queued so far without waiting for batch deadlines
+        and wait until it is searchable
+        
+        Returns:
+            True if the queue was drained and every batch is in the index
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._flush_requested.set()
+        try:
+            if not self.processing_queue.wait_until_empty(timeout):
+                return False
+        finally:
+            self._flush_requested.clear()
+        
+        # Acknowledged batches may still be on their way into the index
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        with self._batches_done:
+            return self._batches_done.wait_for(lambda: self._in_flight == 0, remaining)
+    
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Process everything queued so far without waiting for batch deadlines,
+        then save the index
+        
+        Args:
+            timeout: Maximum seconds to wait (None waits until drained)
+            
+        Returns:
+            True if the queue was fully drained and indexed
+        """
+        if not self._drain(timeout):
+            return False
+        self._save_index()
+        return True
+    
+    def close(self, timeout: Optional[float] = None):
+        """
+        Drain the queue, stop the workers, save the index and close the database
+        
+        Args:
+            timeout: Maximum seconds to wait for the queue to drain
+        """
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._drain(timeout)
+        for thread in self._workers:
+            thread.join(timeout)
+        # Saved after the workers stopped, so it covers every batch they indexed
+        self._save_index()
+        
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        if self._stored_vectors is not None:
+            self._stored_vectors.close()
@@ -0,0 +1,238 @@
+import re
+import threading
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from retrieval import SemanticRetriever
+
+WORD_PATTERN = re.compile(r"\S+")
+
+def chunk_spans(text: str, window: int = 200, overlap: int = 50) -> List[Tuple[int, int]]:
+    """
+    Split text into overlapping windows of whitespace-separated tokens
+
+    Args:
+        text: Text to split
+        window: Tokens per window
+        overlap: Tokens shared by consecutive windows
+
+    Returns:
+        List of (start, end) character offsets, covering the whole text
+    """
+    if overlap >= window:
+        raise ValueError("overlap must be smaller than window")
+    spans = np.array([match.span() for match in WORD_PATTERN.finditer(text)],
+                     dtype=np.int64).reshape(-1, 2)
+    if len(spans) == 0:
+        return []
+    stride = window - overlap
+    # The last window ends at the final token instead of overhanging it
+    firsts = np.arange(0, max(len(spans) - overlap, 1), stride)
+    lasts = np.minimum(firsts + window, len(spans)) - 1
+    return list(zip(spans[firsts, 0].tolist(), spans[lasts, 1].tolist()))
+
+class PassageRetriever:
+    def __init__(self, retriever: Optional[SemanticRetriever] = None,
+                 content_field: str = 'content', window: int = 200, overlap: int = 50,
+                 overfetch: int = 4):
+        """
+        Multi-vector retrieval: every document is indexed as overlapping passages
+
+        Each passage is a vector in the wrapped retriever under its own chunk
+        id; the chunk's parent document id and character offsets are kept in
+        parallel arrays. Searches over-fetch passages and collapse them to
+        documents, so long threads are neither truncated nor blurred into
+        one vector.
+
+        Args:
+            retriever: Retriever holding the passage vectors (created if not given)
+            content_field: Field containing the text to split
+            window: Tokens per passage
+            overlap: Tokens shared by consecutive passages
+            overfetch: Passages fetched per requested document
+        """
+        self.retriever = retriever or SemanticRetriever(content_field=content_field)
+        self.embedder = self.retriever.embedder
+        self.content_field = content_field
+        self.window = window
+        self.overlap = overlap
+        self.overfetch = overfetch
+        self._lock = threading.Lock()
+
+        # Per chunk id: parent document id and character offsets in its text,
+        # grown by doubling so ingest stays linear
+        self._parents = np.empty(0, dtype=np.int64)
+        self._offsets = np.empty((0, 2), dtype=np.int64)
+        self._next_chunk = 0
+        self._chunks_of: Dict[int, List[int]] = {}  # Live chunk ids of each document
+
+    @property
+    def size(self) -> int:
+        """Number of indexed documents"""
+        return len(self._chunks_of)
+
+    def _text(self, item) -> str:
+        """Text the passages are cut from, prepared by the embedder (e.g. quoted replies stripped)"""
+        if isinstance(item, dict) and self.embedder.content_field not in item:
+            return ''
+        return self.embedder.extract_text(item) or ''
+
+    def _grow(self, count: int) -> None:
+        """Make room for `count` more chunks; caller holds the lock"""
+        needed = self._next_chunk + count
+        if needed <= len(self._parents):
+            return
+        capacity = max(needed, 2 * len(self._parents), 1024)
+        parents = np.full(capacity, -1, dtype=np.int64)
+        offsets = np.zeros((capacity, 2), dtype=np.int64)
+        parents[:self._next_chunk] = self._parents[:self._next_chunk]
+        offsets[:self._next_chunk] = self._offsets[:self._next_chunk]
+        self._parents, self._offsets = parents, offsets
+
+    def add_items(self, items: List, ids: Optional[List[int]] = None) -> int:
+        """
+        Split, embed and index documents, replacing earlier versions
+
+        Args:
+            items: Dicts with the content field, or strings
+            ids: Document ids (defaults to each item's 'id', then its position)
+
+        Returns:
+            Number of passages indexed
+        """
+        if ids is None:
+            ids = [item.get('id', idx) if isinstance(item, dict) else idx
+                   for idx, item in enumerate(items)]
+
+        parents, offsets, texts = [], [], []
+        for item_id, item in zip(ids, items):
+            text = self._text(item)
+            for start, end in chunk_spans(text, self.window, self.overlap):
+                parents.append(int(item_id))
+                offsets.append((start, end))
+                texts.append(text[start:end])
+
+        vectors = self.embedder.generate_embeddings(texts) if texts else []
+        embedded = [i for i, vector in enumerate(vectors) if vector is not None]
+
+        with self._lock:
+            replaced = self._forget_chunks(ids)
+            self._grow(len(embedded))
+            chunk_ids = np.arange(self._next_chunk, self._next_chunk + len(embedded), dtype=np.int64)
+            self._next_chunk += len(embedded)
+            if embedded:
+                self._parents[chunk_ids] = np.array(parents, dtype=np.int64)[embedded]
+                self._offsets[chunk_ids] = np.array(offsets, dtype=np.int64)[embedded]
+                for chunk_id, i in zip(chunk_ids.tolist(), embedded):
+                    self._chunks_of.setdefault(parents[i], []).append(chunk_id)
+            
+            # Old passages leave the index in the same write that adds the new
+            # ones, so a replaced document never drops out of searches
+            matrix = (np.stack([vectors[i] for i in embedded]) if embedded
+                      else np.empty((0, self.retriever.dimension), dtype=np.float32))
+            self.retriever.upsert(chunk_ids, matrix, copy=False, replaces=replaced)
+        return len(embedded)
+
+    def _forget_chunks(self, ids) -> List[int]:
+        """Drop the chunk bookkeeping of documents; caller holds the lock"""
+        removed = []
+        for item_id in ids:
+            removed.extend(self._chunks_of.pop(int(item_id), []))
+        return removed
+
+    def delete(self, ids) -> int:
+        """
+        Delete documents and all their passages
+
+        Returns:
+            Number of documents deleted
+        """
+        with self._lock:
+            before = len(self._chunks_of)
+            removed = self._forget_chunks(ids)
+            if removed:
+                self.retriever.delete(removed)
+            return before - len(self._chunks_of)
+
+    def collapse(self, chunk_ids: np.ndarray, scores: np.ndarray, k: int,
+                 aggregation: str = 'max') -> List[Tuple[int, float, Tuple[int, int]]]:
+        """
+        Collapse passage hits to documents
+
+        Args:
+            chunk_ids: Chunk ids of the passage hits
+            scores: Similarity of each hit (higher is better)
+            k: Number of documents to return
+            aggregation: 'max' (best passage) or 'sum' (all retrieved passages;
+                         negative similarities count as zero, so unrelated
+                         passages of long documents do not penalize them)
+
+        Returns:
+            List of (document_id, score, (start, end)) tuples, best first, with
+            the offsets of each document's best passage
+        """
+        if aggregation not in ('max', 'sum'):
+            raise ValueError(f"Unknown aggregation: {aggregation}")
+        if len(chunk_ids) == 0:
+            return []
+        # Best hit first, so each document's first occurrence is its best passage
+        order = np.argsort(-scores, kind='stable')
+        chunk_ids, scores = chunk_ids[order], scores[order]
+        parents = self._parents[chunk_ids]
+        documents, first, inverse = np.unique(parents, return_index=True, return_inverse=True)
+        if aggregation == 'max':
+            totals = scores[first]
+        else:
+            totals = np.bincount(inverse, weights=np.maximum(scores, 0.0), minlength=len(documents))
+
+        top = np.argsort(-totals, kind='stable')[:k]
+        best = self._offsets[chunk_ids[first[top]]]
+        return [
+            (item_id, float(score), (start, end))
+            for item_id, score, (start, end)
+            in zip(documents[top].tolist(), totals[top].tolist(), best.tolist())
+        ]
+
+    def search(self, query: str, k: int = 10, aggregation: str = 'max',
+               allowed_ids=None, **search_kwargs) -> List[Tuple[int, float, Tuple[int, int]]]:
+        """
+        Search documents by their best (or combined) passages
+
+        Passages are over-fetched; if they cover fewer than k documents the
+        fetch is widened until k documents are found or every passage was seen.
+
+        Args:
+            query: Search query
+            k: Number of documents to return
+            aggregation: 'max' or 'sum' over each document's retrieved passages
+            allowed_ids: Optional document ids to restrict the search to
+            **search_kwargs: Passed to SemanticRetriever.search (threshold,
+                             nprobe, ef_search)
+
+        Returns:
+            List of (document_id, score, (start, end)) tuples, best first
+        """
+        with self._lock:
+            allowed_chunks = None
+            if allowed_ids is not None:
+                allowed_chunks = [chunk for item_id in allowed_ids
+                                  for chunk in self._chunks_of.get(int(item_id), [])]
+                if not allowed_chunks:
+                    return []
+            total = len(allowed_chunks) if allowed_chunks is not None else self.retriever.size
+
+        fetch = max(k * self.overfetch, k)
+        while True:
+            hits = self.retriever.search(query, k=min(fetch, total), allowed_ids=allowed_chunks,
+                                         **search_kwargs)
+            chunk_ids = np.array([chunk_id for chunk_id, _ in hits], dtype=np.int64)
+            scores = np.array([score for _, score in hits], dtype=np.float64)
+            with self._lock:
+                results = self.collapse(chunk_ids, scores, k, aggregation)
+            if len(results) >= k or fetch >= total or len(hits) < min(fetch, total):
+                return results
+            fetch *= 2
+
+    def passage(self, item, offsets: Tuple[int, int]) -> str:
+        """Text of a passage returned by `search`, for display"""
+        start, end = offsets
+        return self._text(item)[start:end]
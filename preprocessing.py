@@ -0,0 +1,200 @@
+import re
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Sequence
+from column_cache import decode_recipients
+
+# Start of a quoted or forwarded message, in the formats found in our mail.
+# Every alternative begins with a cheap literal test so non-matching lines fail fast.
+LINE_MARKERS = re.compile(r'''^(?:
+      [ \t]*-{2,}[ \t]*(?:Original[ \t]+Message|Forwarded[ \t]+by\b)   # Outlook reply, Notes forward
+    | [ \t]*_{10,}[ \t]*\n[ \t]*From:                                  # Outlook separator line
+    | [ \t]*From:[^\n]*\n[ \t]*(?:Sent|Date):                          # Outlook header block
+    | [ \t]*On\b[^\n]{0,200}\bwrote:[ \t]*$                            # "On <date>, <name> wrote:"
+)''', re.MULTILINE | re.IGNORECASE | re.VERBOSE)
+
+# Lotus Notes headers are found by their date stamp; the marker starts at the
+# beginning of the line holding the sender's name
+NOTES_DATE = r'\d{1,2}/\d{1,2}/\d{2,4}[ \t]+\d{1,2}:\d{2}(?::\d{2})?[ \t]*[AP]M[ \t]*'
+DATE_MARKERS = re.compile(
+    r'[ \t]on[ \t]+' + NOTES_DATE + r'$'                         # "Name on date" line
+    r'|\n[ \t]*' + NOTES_DATE + r'\n(?:[ \t]*\n)*[ \t]*To:',        # name line, then date, then To:
+    re.MULTILINE | re.IGNORECASE
+)
+
+def _next_marker(text: str, pos: int = 0) -> int:
+    """Offset where the next quoted or forwarded message begins, or len(text)"""
+    found = len(text)
+    match = LINE_MARKERS.search(text, pos)
+    if match:
+        found = match.start()
+    match = DATE_MARKERS.search(text, pos, found)
+    if match:
+        # The date stamp sits on the name line or on the line after it
+        end = match.start() if match.group().startswith('\n') else match.start() + 1
+        found = min(found, max(text.rfind('\n', 0, end) + 1, pos))
+    return found
+
+# Signature delimiter; everything after it is dropped
+SIGNATURE = re.compile(r'^--[ \t]*$', re.MULTILINE)
+
+# Lines that carry no content of their own: '>' quotes and Notes attachment stubs
+NOISE_LINES = re.compile(r'^[ \t]*(?:>[^\n]*|-?[ \t]*\S+[ \t]*<<[ \t]*File:[^\n]*>>[ \t]*)(?:\n|$)',
+                         re.MULTILINE)
+
+SUBJECT_LINE = re.compile(r'^[ \t]*Subject:', re.MULTILINE | re.IGNORECASE)
+BLANK_LINE = re.compile(r'\n[ \t]*\n')
+SPACES = re.compile(r'[ \t]+')
+BLANK_RUNS = re.compile(r'\n(?:[ \t]*\n)+')
+
+def _clean(text: str) -> str:
+    """Drop quote and attachment lines and the signature, and squeeze whitespace"""
+    signature = SIGNATURE.search(text)
+    if signature:
+        text = text[:signature.start()]
+    text = NOISE_LINES.sub('', text)
+    text = SPACES.sub(' ', text)
+    return BLANK_RUNS.sub('\n\n', text).strip()
+
+def _skip_header(segment: str, header_window: int = 3000) -> str:
+    """Body of a quoted message: the text after its header block"""
+    subject = SUBJECT_LINE.search(segment, 0, header_window)
+    blank = BLANK_LINE.search(segment, subject.end() if subject else 0)
+    return segment[blank.end():] if blank else ''
+
+def strip_quoted(text: str) -> str:
+    """
+    New content of an email, without quoted history or signature
+
+    A forward with no text of its own yields the body of the first quoted
+    message instead, so it is not reduced to nothing.
+
+    Args:
+        text: Raw email body
+
+    Returns:
+        Cleaned new content (empty if there is none)
+    """
+    # Most replies have text of their own, so only the first marker is looked for
+    end = _next_marker(text)
+    content = _clean(text[:end])
+    while not content and end < len(text):
+        start = end
+        end = _next_marker(text, text.find('\n', start) + 1 or len(text))
+        content = _clean(_skip_header(text[start:end]))
+    return content
+
+class EmailPreprocessor:
+    def __init__(self, header_fields: Sequence[str] = ('subject', 'from', 'to'),
+                 max_recipients: int = 5):
+        """
+        Turn emails into the compact text that is embedded
+
+        The text is a short header of the subject and participants followed
+        by the email's new content only, so quoted reply chains are not
+        embedded (and paid for) once per message of a thread.
+
+        Args:
+            header_fields: Email fields rendered into the header
+            max_recipients: Recipients listed in the header before the rest
+                            are summarized as a count
+        """
+        self.header_fields = tuple(header_fields)
+        self.max_recipients = max_recipients
+        self._lock = threading.Lock()
+        self._stats = {'emails': 0, 'input_chars': 0, 'output_chars': 0, 'seconds': 0.0}
+
+    def _header(self, email: dict) -> str:
+        lines = []
+        for field in self.header_fields:
+            value = email.get(field)
+            if not value:
+                continue
+            if isinstance(value, str) and value.startswith('['):
+                # Recipient lists read from CSV are still stringified
+                value = decode_recipients(value)
+            if isinstance(value, (list, tuple)):
+                shown = ', '.join(str(v) for v in value[:self.max_recipients])
+                if len(value) > self.max_recipients:
+                    shown += f" (+{len(value) - self.max_recipients} more)"
+                value = shown
+            lines.append(f"{field.capitalize()}: {SPACES.sub(' ', str(value)).strip()}")
+        return '\n'.join(lines)
+
+    def prepare(self, email: dict, content_field: str = 'content') -> str:
+        """
+        Text to embed for an email
+
+        Args:
+            email: Email dictionary
+            content_field: Field holding the raw body
+
+        Returns:
+            Header plus stripped new content
+        """
+        started = time.perf_counter()
+        raw = email.get(content_field)
+        raw = raw if isinstance(raw, str) else ('' if raw is None else str(raw))
+        content = strip_quoted(raw)
+        header = self._header(email)
+        text = f"{header}\n\n{content}" if header and content else header or content
+
+        with self._lock:
+            self._stats['emails'] += 1
+            self._stats['input_chars'] += len(raw)
+            self._stats['output_chars'] += len(content)
+            self._stats['seconds'] += time.perf_counter() - started
+        return text
+
+    def prepare_stream(self, emails: Iterable[dict],
+                       content_field: str = 'content') -> Iterator[str]:
+        """Prepare emails lazily, one at a time, for streaming ingestion"""
+        for email in emails:
+            yield self.prepare(email, content_field)
+
+    def stats(self) -> Dict:
+        """Get preprocessing statistics"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['kept_ratio'] = stats['output_chars'] / stats['input_chars'] if stats['input_chars'] else 1.0
+        stats['mb_per_second'] = (stats['input_chars'] / 1e6 / stats['seconds']
+                                  if stats['seconds'] else 0.0)
+        return stats
+
+def benchmark(emails: List[dict], content_field: str = 'content',
+              repeat: int = 100) -> Dict:
+    """
+    Measure preprocessing throughput
+
+    Args:
+        emails: Sample emails
+        content_field: Field holding the raw body
+        repeat: Passes over the sample
+
+    Returns:
+        Dictionary with emails per second, megabytes per second and the
+        fraction of body characters kept
+    """
+    preprocessor = EmailPreprocessor()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for _ in preprocessor.prepare_stream(emails, content_field):
+            pass
+    elapsed = time.perf_counter() - started
+    stats = preprocessor.stats()
+    return {
+        'emails_per_second': stats['emails'] / elapsed,
+        'mb_per_second': stats['input_chars'] / 1e6 / elapsed,
+        'kept_ratio': stats['kept_ratio']
+    }
+
+def main():
+    import pandas as pd
+    emails = pd.read_csv('selected_emails.csv').to_dict('records')
+    results = benchmark(emails, content_field='body')
+    print(f"Emails/second: {results['emails_per_second']:.0f}")
+    print(f"MB/second: {results['mb_per_second']:.1f}")
+    print(f"Body characters kept: {results['kept_ratio']:.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -3,123 +3,929 @@ import numpy as np
 from embeddings import generate_email_embeddings
 from typing import Dict, List, Tuple, Optional
 from embeddings import DataEmbedder
+from embedding_cache import QueryEmbeddingCache
+from lexical import BM25Index, reciprocal_rank_fusion
+from vector_storage import VectorSegmentStore
 import faiss
+import os
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+class ReadWriteLock:
+    """
+    Writer-preferring reader-writer lock.
+
+    Any number of readers may hold the lock at once; a writer waits for
+    active readers to finish and blocks new readers while it waits, so a
+    steady stream of searches cannot starve ingestion.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
 
 class SemanticRetriever:
-    def __init__(self, dimension: int = 1536, index_type: str = 'l2'):
+    DEFAULT_INDEX_PARAMS = {
+        'nlist': 1024,           # IVF inverted lists
+        'nprobe': 16,            # IVF lists scanned per query
+        'pq_m': 64,              # IVF-PQ sub-quantizers
+        'pq_nbits': 8,           # IVF-PQ bits per sub-quantizer code
+        'hnsw_m': 32,            # HNSW neighbours per node
+        'ef_construction': 200,  # HNSW build-time candidate list size
+        'ef_search': 64,         # HNSW query-time candidate list size
+        'train_size': 100000,    # Maximum number of vectors used for training
+        'min_train_size': 1000,  # Vectors buffered in an exact index before training quantizers,
+                                 # centroids or projections (at least 39 x nlist for IVF)
+        'exact_filter_size': 4096,  # Filtered searches over fewer candidates are scored exactly
+        'rescore_factor': 4,     # Candidates fetched per result when rescoring compressed vectors
+        'reduced_dimension': None,   # Dimension kept by `reduction` (None: chosen from the sample)
+        'explained_variance': 0.95,  # Variance of the sample the kept components must explain
+        'target_recall': None    # Or: recall@10 on the sample the kept components must reach
+    }
+    # FAISS scalar quantizers by `quantization` name
+    QUANTIZERS = {
+        'fp16': faiss.ScalarQuantizer.QT_fp16,  # 2 bytes per dimension
+        'sq8': faiss.ScalarQuantizer.QT_8bit    # 1 byte per dimension, trained per-dimension range
+    }
+
+    def __init__(self, dimension: Optional[int] = None, index_type: str = 'l2',
+                 embedder: Optional[DataEmbedder] = None, content_field: str = 'content',
+                 metric: Optional[str] = None, index_params: Optional[dict] = None,
+                 query_cache_size: int = 1024, query_cache_ttl: float = 3600.0,
+                 lexical_index: Optional[BM25Index] = None,
+                 quantization: Optional[str] = None,
+                 rescore_vectors: Optional[VectorSegmentStore] = None,
+                 reduction: Optional[str] = None):
         """
         Initialize the retriever
         
         Args:
-            dimension: Dimension of embeddings (1536 for text-embedding-ada-002)
-            index_type: Type of FAISS index ('l2' or 'cosine')
+            dimension: Dimension of embeddings (defaults to the embedder's provider dimension)
+            index_type: Type of FAISS index: 'l2' or 'cosine' for exact search, or
+                        'flat', 'ivf_flat', 'ivf_pq' or 'hnsw' combined with `metric`
+            embedder: Embedder used for items and queries (created if not given)
+            content_field: Field containing the text to embed when creating an embedder
+            metric: 'l2' or 'cosine' (implied by index_type 'l2'/'cosine', default 'l2')
+            index_params: Overrides for DEFAULT_INDEX_PARAMS
+            query_cache_size: Number of query embeddings kept in memory (0 disables)
+            query_cache_ttl: Seconds a cached query embedding stays valid
+            lexical_index: Optional BM25 index kept in sync by `add_items`,
+                           enabling the 'lexical' and 'hybrid' search modes
+            quantization: Store indexed vectors as 'fp16' or 'sq8' (int8 with
+                          per-dimension ranges trained on a sample) instead
+                          of float32; not for 'ivf_pq'
+            rescore_vectors: Full-precision vectors by id (a VectorSegmentStore
+                             or anything with its `get_batch`); searches of a
+                             quantized or PQ index over-fetch candidates and
+                             rerank them exactly against these
+            reduction: Project vectors onto fewer dimensions before indexing:
+                       'pca' (principal components) or 'rotation' (random
+                       orthogonal rotation), fitted once `min_train_size`
+                       vectors have arrived and saved inside the index; the dimension comes from
+                       `reduced_dimension`, `target_recall` or
+                       `explained_variance` in index_params
         """
-        self.dimension = dimension
-        self.embedder = DataEmbedder()
+        if index_type not in ('l2', 'cosine', 'flat', 'ivf_flat', 'ivf_pq', 'hnsw'):
+            raise ValueError(f"Unknown index type: {index_type}")
+        if quantization is not None and quantization not in self.QUANTIZERS:
+            raise ValueError(f"Unknown quantization: {quantization}")
+        if reduction not in (None, 'pca', 'rotation'):
+            raise ValueError(f"Unknown reduction: {reduction}")
+        if quantization is not None and index_type == 'ivf_pq':
+            raise ValueError("ivf_pq vectors are already compressed; use quantization with "
+                             "flat, ivf_flat or hnsw indexes")
+        self.embedder = embedder or DataEmbedder(content_field=content_field)
+        self.dimension = dimension or self.embedder.dimension
         self.index_type = index_type
+        self.metric = index_type if index_type in ('l2', 'cosine') else (metric or 'l2')
+        self.index_params = dict(self.DEFAULT_INDEX_PARAMS, **(index_params or {}))
+        self.query_cache = (
+            QueryEmbeddingCache(query_cache_size, query_cache_ttl) if query_cache_size > 0 else None
+        )
+        self.lexical_index = lexical_index
+        self.quantization = quantization
+        self.rescore_vectors = rescore_vectors
+        self.reduction = reduction
+        self.index = None
+        # External id of each FAISS slot (-1 once the slot is deleted or superseded)
+        self._slot_ids = np.empty(0, dtype=np.int64)
+        self._slot_of: Dict[int, int] = {}  # Maps external ids to their live FAISS slot
+        self._next_slot = 0
+        self._dead_slots: List[int] = []
+        self._search_selector = None
+        self._next_auto_id = 0
+        # Until `min_train_size` vectors have arrived, indexes that need training
+        # hold them in an exact float32 index and are trained on all of them
+        self._staging = False
+        # Searches share the lock; only index mutations take it exclusively,
+        # and embedding always happens before the lock is taken
+        self._index_lock = ReadWriteLock()
+        
+    def _init_index(self, train_vectors: Optional[np.ndarray] = None):
+        """
+        Initialize FAISS index based on type
+        
+        Args:
+            train_vectors: Sample used to size the IVF/PQ parameters; indexes that
+                           need training are created untrained
+        """
+        params = self.index_params
+        metric = faiss.METRIC_INNER_PRODUCT if self.metric == 'cosine' else faiss.METRIC_L2
+        n_train = len(train_vectors) if train_vectors is not None else None
+        transform = None
+        dimension = self.dimension
+        if self.reduction is not None:
+            if train_vectors is None:
+                raise ValueError("A dimensionality reduction needs training vectors")
+            transform = self._fit_reduction(train_vectors)
+            dimension = transform.d_out
+        
+        if self.index_type in ('ivf_flat', 'ivf_pq'):
+            nlist = params['nlist']
+            if n_train is not None and n_train < 39 * nlist:
+                # FAISS wants ~39 training points per centroid
+                nlist = max(1, n_train // 39)
+                print(f"Only {n_train} training vectors; using nlist={nlist}")
+            if self.index_type == 'ivf_flat':
+                codec = {None: 'Flat', 'fp16': 'SQfp16', 'sq8': 'SQ8'}[self.quantization]
+                description = f"IVF{nlist},{codec}"
+            else:
+                m = max(d for d in range(1, min(params['pq_m'], dimension) + 1)
+                        if dimension % d == 0)
+                nbits = params['pq_nbits']
+                if n_train is not None:
+                    # Each of the 2^nbits codebook centroids needs ~39 training points
+                    nbits = max(1, min(nbits, int(np.floor(np.log2(max(n_train / 39, 2))))))
+                description = f"IVF{nlist},PQ{m}x{nbits}"
+            base = faiss.index_factory(dimension, description, metric)
+            faiss.extract_index_ivf(base).nprobe = min(params['nprobe'], nlist)
+        elif self.index_type == 'hnsw':
+            if self.quantization is not None:
+                base = faiss.IndexHNSWSQ(dimension, self.QUANTIZERS[self.quantization],
+                                         params['hnsw_m'], metric)
+            else:
+                base = faiss.IndexHNSWFlat(dimension, params['hnsw_m'], metric)
+            base.hnsw.efConstruction = params['ef_construction']
+            base.hnsw.efSearch = params['ef_search']
+        elif self.quantization is not None:
+            base = faiss.IndexScalarQuantizer(dimension, self.QUANTIZERS[self.quantization],
+                                              metric)
+        elif metric == faiss.METRIC_INNER_PRODUCT:
+            base = faiss.IndexFlatIP(dimension)  # Inner product for cosine similarity
+        else:
+            base = faiss.IndexFlatL2(dimension)  # L2 distance
+        if transform is not None:
+            # The projection is applied to stored and query vectors alike and is saved with the index
+            base = faiss.IndexPreTransform(transform, base)
+        # Vectors are stored under explicit 64-bit slot ids so slots never get renumbered
+        self.index = faiss.IndexIDMap2(base)
+    
+    def _fit_reduction(self, sample: np.ndarray) -> faiss.LinearTransform:
+        """
+        Fit the orthonormal projection of `reduction` on a training sample
+        
+        Cosine indexes are projected without centering, so inner products
+        between projected vectors still approximate the original ones; L2
+        distances do not depend on the mean.
+        
+        Args:
+            sample: (n, d) prepared training vectors
+            
+        Returns:
+            Trained faiss.LinearTransform from d to the chosen dimension
+        """
+        sample = sample.astype(np.float64)
+        centered = sample - sample.mean(axis=0) if self.metric == 'l2' else sample
+        scatter = centered.T @ centered / len(sample)
+        if self.reduction == 'pca':
+            variances, basis = np.linalg.eigh(scatter)
+        else:
+            rng = np.random.default_rng(0)
+            basis, _ = np.linalg.qr(rng.standard_normal((self.dimension, self.dimension)))
+            variances = ((scatter @ basis) * basis).sum(axis=0)
+        # Components by decreasing variance, so truncation keeps the strongest
+        order = np.argsort(-variances, kind='stable')
+        basis, variances = basis[:, order], np.maximum(variances[order], 0)
+        
+        dimension = self._reduced_dimension(sample, basis, variances)
+        transform = faiss.LinearTransform(self.dimension, dimension, False)
+        faiss.copy_array_to_vector(
+            np.ascontiguousarray(basis[:, :dimension].T, dtype=np.float32).ravel(), transform.A)
+        transform.is_orthonormal = True
+        transform.is_trained = True
+        return transform
+    
+    def _reduced_dimension(self, sample: np.ndarray, basis: np.ndarray,
+                           variances: np.ndarray) -> int:
+        """
+        Number of components to keep, rounded up to a multiple of 8 so that
+        PQ sub-quantizers divide it
+        """
+        params = self.index_params
+        if params['reduced_dimension']:
+            return min(int(params['reduced_dimension']), self.dimension)
+        
+        def rounded(dimension: int) -> int:
+            return min(self.dimension, max(8, int(np.ceil(dimension / 8)) * 8))
+        
+        if params['target_recall'] is None:
+            explained = np.cumsum(variances) / max(variances.sum(), 1e-12)
+            needed = int(np.searchsorted(explained, params['explained_variance'])) + 1
+            return rounded(needed)
+        
+        # Smallest dimension whose projected top-10 neighbours of held-out
+        # sample vectors match the exact ones at the target recall
+        rng = np.random.default_rng(0)
+        picked = rng.permutation(len(sample))[:10200]
+        queries, base = sample[picked[:200]], sample[picked[200:]]
+        if len(base) < 10:
+            return rounded(self.dimension)
+        
+        def top10(q: np.ndarray, x: np.ndarray) -> np.ndarray:
+            if self.metric == 'cosine':
+                scores = q @ x.T
+            else:
+                scores = 2 * q @ x.T - (x ** 2).sum(axis=1)[None, :]
+            return np.argpartition(-scores, 9, axis=1)[:, :10]
+        
+        truth = top10(queries, base)
+        low, high = 1, int(np.ceil(self.dimension / 8))
+        while low < high:
+            middle = (low + high) // 2
+            projection = basis[:, :middle * 8]
+            found = top10(queries @ projection, base @ projection)
+            recall = np.mean([len(np.intersect1d(a, b)) / 10 for a, b in zip(found, truth)])
+            if recall >= params['target_recall']:
+                high = middle
+            else:
+                low = middle + 1
+        return rounded(low * 8)
+    
+    @property
+    def index_dimension(self) -> int:
+        """Dimension of the vectors actually stored in the index, after any reduction"""
+        if self.index is None:
+            return self.dimension
+        return self._base_index().d
+    
+    def _base_index(self) -> faiss.Index:
+        """Underlying FAISS index, below the id map and any reduction; caller holds the lock"""
+        base = faiss.downcast_index(self.index.index)
+        if isinstance(base, faiss.IndexPreTransform):
+            base = faiss.downcast_index(base.index)
+        return base
+    
+    def _min_train_size(self) -> int:
+        """Vectors to buffer before the index is trained (0 if it needs no training)"""
+        params = self.index_params
+        ivf = self.index_type in ('ivf_flat', 'ivf_pq')
+        if not (ivf or self.quantization == 'sq8' or self.reduction is not None):
+            return 0
+        needed = params['min_train_size']
+        if ivf:
+            needed = max(needed, 39 * params['nlist'])
+        if self.reduction is not None:
+            needed = max(needed, self.dimension)
+        return min(needed, params['train_size'])
+    
+    def train(self, vectors: np.ndarray) -> None:
+        """
+        Train the index on a sample of vectors instead of waiting for
+        `min_train_size` of them to be added
+        
+        Vectors buffered so far are moved into the trained index. An index
+        that is already trained (or needs no training) is left as it is.
+        
+        Args:
+            vectors: (n, d) training sample
+        """
+        matrix = self._prepare_vectors(vectors, copy=True)
+        with self._index_lock.write():
+            if self._staging:
+                self._train_staged(matrix)
+            else:
+                self._train(matrix)
+    
+    def _train(self, matrix: np.ndarray) -> None:
+        """Create the index if needed and train it on `matrix`; caller holds the lock"""
+        if len(matrix) > self.index_params['train_size']:
+            rng = np.random.default_rng(0)
+            matrix = matrix[rng.choice(len(matrix), self.index_params['train_size'], replace=False)]
+        if self.index is None or (not self.index.is_trained and self.index.ntotal == 0):
+            self._init_index(matrix)
+        if not self.index.is_trained:
+            self.index.train(matrix)
+        self._enable_reconstruct()
+    
+    def _init_staging(self) -> None:
+        """Create the exact index buffering vectors until training; caller holds the lock"""
+        if self.metric == 'cosine':
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+        else:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dimension))
+        self._staging = True
+    
+    def _train_staged(self, sample: Optional[np.ndarray] = None) -> None:
+        """
+        Replace the staging index by one trained on `sample` (default: the
+        buffered vectors) holding the buffered vectors under their slots;
+        caller holds the lock
+        """
+        staged = self.index
+        slots = faiss.vector_to_array(staged.id_map)
+        vectors = faiss.downcast_index(staged.index).reconstruct_n(0, staged.ntotal)
+        live = self._slot_ids[slots] >= 0
+        slots, vectors = slots[live], vectors[live]
+        
         self.index = None
-        self.id_map = {}  # Maps FAISS ids to original data ids
-        self._index_lock = threading.Lock()
+        try:
+            self._train(vectors if sample is None else sample)
+        except Exception:
+            self.index = staged
+            raise
+        if len(slots):
+            self.index.add_with_ids(vectors, slots)
+        self._staging = False
+        self._search_selector = None
+    
+    def _enable_reconstruct(self) -> None:
+        """Keep an IVF direct map so stored vectors can be reconstructed by slot; caller holds the lock"""
+        base = self._base_index()
+        if isinstance(base, faiss.IndexIVF) and base.direct_map.type == faiss.DirectMap.NoMap:
+            base.make_direct_map()
+    
+    @property
+    def id_map(self) -> Dict[int, int]:
+        """Maps live FAISS slot ids to original data ids"""
+        return {slot: item_id for item_id, slot in self._slot_of.items()}
+    
+    @property
+    def size(self) -> int:
+        """Number of live items in the index"""
+        return len(self._slot_of)
+    
+    def _prepare_vectors(self, vectors: np.ndarray, copy: bool) -> np.ndarray:
+        """Convert to a contiguous float32 matrix, normalized for cosine indexes"""
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[1] != self.dimension:
+            raise ValueError(f"Expected vectors of shape (n, {self.dimension}), got {matrix.shape}")
         
-    def _init_index(self):
-        """Initialize FAISS index based on type"""
-        if self.index_type == 'cosine':
-            self.index = faiss.IndexFlatIP(self.dimension)  # Inner product for cosine similarity
+        if self.metric == 'cosine':
+            if not matrix.flags.writeable or (
+                    copy and isinstance(vectors, np.ndarray) and np.may_share_memory(matrix, vectors)):
+                matrix = matrix.copy()
+            faiss.normalize_L2(matrix)
+        return matrix
+    
+    def _retire(self, ids: List[int]) -> int:
+        """Tombstone the current slots of the given ids; caller holds the lock"""
+        retired = 0
+        for item_id in ids:
+            slot = self._slot_of.pop(item_id, None)
+            if slot is not None:
+                self._slot_ids[slot] = -1
+                self._dead_slots.append(slot)
+                retired += 1
+        if retired:
+            self._search_selector = None
+        return retired
+    
+    def _search_params(self, nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None,
+                       allowed_slots: Optional[np.ndarray] = None) -> Optional[faiss.SearchParameters]:
+        """
+        Per-query search parameters, excluding tombstoned slots or, with
+        `allowed_slots`, everything but those live slots; caller holds the lock
+        """
+        selector, selector_refs = None, None
+        if allowed_slots is not None:
+            allowed = faiss.IDSelectorBatch(allowed_slots)
+            selector_refs = (allowed,)
+            selector = allowed
+            # A selective filter leaves fewer hits per probed list or graph
+            # neighbourhood; widen the search to see as many candidates as unfiltered
+            widen = max(1.0, self.index.ntotal / len(allowed_slots))
+        elif self._dead_slots:
+            if self._search_selector is None:
+                dead = faiss.IDSelectorBatch(np.array(self._dead_slots, dtype=np.int64))
+                # Keep the inner selector alive as long as the wrapper uses it
+                self._search_selector = (faiss.IDSelectorNot(dead), dead)
+            selector_refs = self._search_selector
+            selector = selector_refs[0]
+        
+        base = self._base_index()
+        if isinstance(base, faiss.IndexIVF):
+            nprobe = nprobe or base.nprobe
+            if allowed_slots is not None:
+                nprobe = int(min(base.nlist, np.ceil(nprobe * widen)))
+            params = faiss.SearchParametersIVF(nprobe=nprobe)
+        elif isinstance(base, faiss.IndexHNSW):
+            ef_search = ef_search or base.hnsw.efSearch
+            if allowed_slots is not None:
+                ef_search = int(min(max(self.index.ntotal, 1), np.ceil(ef_search * widen)))
+            params = faiss.SearchParametersHNSW(efSearch=ef_search)
+        elif selector is None:
+            return None
         else:
-            self.index = faiss.IndexFlatL2(self.dimension)  # L2 distance
+            params = faiss.SearchParameters()
+        if selector is not None:
+            params.sel = selector
+            # Concurrent readers may replace the cached selector; pin this one
+            params.selector_refs = selector_refs
+        return params
+    
+    def upsert(self, ids, vectors: np.ndarray, batch_size: int = 100000,
+               copy: bool = True, replaces=None) -> None:
+        """
+        Insert or replace precomputed vectors under stable external ids
+        
+        Replacing an id tombstones its previous vector, so the cost is
+        proportional to the batch, not to the index size. If an id repeats
+        within the batch the last vector wins.
+        
+        Args:
+            ids: Sequence or array of n non-negative 64-bit item ids
+            vectors: (n, d) array of embeddings
+            batch_size: Number of vectors passed to FAISS at once
+            copy: Copy float32 input before normalizing it (set False to let
+                  cosine indexes normalize the caller's array in place)
+            replaces: Other ids to delete in the same index update, so no
+                      search sees them gone before the new vectors are in
+                      (the lexical index is not touched)
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        matrix = self._prepare_vectors(vectors, copy)
+        if len(ids) != len(matrix):
+            raise ValueError(f"Got {len(ids)} ids for {len(matrix)} vectors")
+        replaced = np.asarray(replaces if replaces is not None else [],
+                              dtype=np.int64).reshape(-1).tolist()
+        if len(ids) == 0:
+            if replaced:
+                with self._index_lock.write():
+                    self._retire(replaced)
+            return
+        
+        # Keep only the last occurrence of each id
+        _, last = np.unique(ids[::-1], return_index=True)
+        if len(last) < len(ids):
+            keep = np.sort(len(ids) - 1 - last)
+            ids, matrix = ids[keep], matrix[keep]
+        
+        with self._index_lock.write():
+            if self.index is None and len(matrix) < self._min_train_size():
+                # Too few vectors to fit quantizer ranges, centroids or a projection
+                self._init_staging()
+            elif self.index is None or not self.index.is_trained:
+                self._train(matrix)
+            
+            id_list = ids.tolist()
+            self._retire(replaced + id_list)
+            
+            slots = np.arange(self._next_slot, self._next_slot + len(ids), dtype=np.int64)
+            if self._next_slot + len(ids) > len(self._slot_ids):
+                capacity = max(self._next_slot + len(ids), 2 * len(self._slot_ids), 1024)
+                grown = np.full(capacity, -1, dtype=np.int64)
+                grown[:self._next_slot] = self._slot_ids[:self._next_slot]
+                self._slot_ids = grown
+            self._slot_ids[slots] = ids
             
+            for i in range(0, len(matrix), batch_size):
+                self.index.add_with_ids(matrix[i:i + batch_size], slots[i:i + batch_size])
+            self._slot_of.update(zip(id_list, slots.tolist()))
+            self._next_slot += len(ids)
+            if self._staging and len(self._slot_of) >= self._min_train_size():
+                self._train_staged()
+    
+    def add_vectors(self, ids, vectors: np.ndarray, batch_size: int = 100000,
+                    copy: bool = True) -> None:
+        """
+        Add precomputed vectors to the index without calling the embedder
+        
+        Ids that are already indexed are replaced (see `upsert`).
+        
+        Args:
+            ids: Sequence or array of n item ids
+            vectors: (n, d) array of embeddings
+            batch_size: Number of vectors passed to FAISS at once
+            copy: Copy float32 input before normalizing it (set False to let
+                  cosine indexes normalize the caller's array in place)
+        """
+        self.upsert(ids, vectors, batch_size=batch_size, copy=copy)
+    
+    def delete(self, ids) -> int:
+        """
+        Delete items by id
+        
+        Deleted vectors are tombstoned and excluded from searches; call
+        `compact` to reclaim their space.
+        
+        Args:
+            ids: Item ids to delete
+            
+        Returns:
+            Number of items that were deleted
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1).tolist()
+        if self.lexical_index is not None:
+            self.lexical_index.delete(ids)
+        with self._index_lock.write():
+            return self._retire(ids)
+    
+    def compact(self) -> int:
+        """
+        Rebuild the index without tombstoned vectors
+        
+        Returns:
+            Number of vectors reclaimed
+        """
+        with self._index_lock.write():
+            if self.index is None or not self._dead_slots:
+                return 0
+            
+            slots = faiss.vector_to_array(self.index.id_map)
+            base = faiss.downcast_index(self.index.index)
+            self._enable_reconstruct()
+            vectors = base.reconstruct_n(0, self.index.ntotal)
+            item_ids = self._slot_ids[slots]
+            live = item_ids >= 0
+            vectors, item_ids = vectors[live], item_ids[live]
+            reclaimed = len(slots) - len(item_ids)
+            
+            # reset() keeps IVF centroids and PQ codebooks, so no retraining is needed
+            self.index.reset()
+            new_slots = np.arange(len(item_ids), dtype=np.int64)
+            if len(item_ids):
+                self.index.add_with_ids(vectors, new_slots)
+            self._slot_ids = item_ids.copy()
+            self._slot_of = dict(zip(item_ids.tolist(), new_slots.tolist()))
+            self._next_slot = len(item_ids)
+            self._dead_slots = []
+            self._search_selector = None
+            return reclaimed
+    
+    def save(self, path: str) -> None:
+        """
+        Save the index to `{path}.index` and the slot id map to `{path}.map`
+        
+        Both files are written to temporary files first and renamed into
+        place, so a crash never leaves a half-written snapshot behind.
+        
+        Args:
+            path: Path prefix of the index files
+        """
+        # Snapshot in memory under the lock; the slow disk writes happen after
+        # releasing it, so a waiting writer does not stall searches meanwhile
+        with self._index_lock.read():
+            if self.index is None:
+                return
+            serialized = faiss.serialize_index(self.index)
+            slot_ids = self._slot_ids[:self._next_slot].copy()
+        with open(f"{path}.index.tmp", 'wb') as f:
+            f.write(serialized.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(f"{path}.map.tmp", 'wb') as f:
+            np.save(f, slot_ids)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.map.tmp", f"{path}.map")
+        os.replace(f"{path}.index.tmp", f"{path}.index")
+    
+    def load(self, path: str) -> None:
+        """
+        Load an index written by `save`
+        
+        Args:
+            path: Path prefix of the index files
+        """
+        index = faiss.read_index(f"{path}.index")
+        with open(f"{path}.map", 'rb') as f:
+            slot_ids = np.load(f)
+        
+        with self._index_lock.write():
+            self.index = index
+            self._staging = (self._min_train_size() > 0
+                             and isinstance(faiss.downcast_index(index.index), faiss.IndexFlat))
+            self._slot_ids = slot_ids.astype(np.int64)
+            self._next_slot = len(slot_ids)
+            live = np.flatnonzero(slot_ids >= 0)
+            self._slot_of = dict(zip(slot_ids[live].tolist(), live.tolist()))
+            self._dead_slots = np.flatnonzero(slot_ids < 0).tolist()
+            self._search_selector = None
+            self._enable_reconstruct()
+    
     def add_items(self, items: List[dict], batch_size: int = 1000) -> None:
         """
         Add items to the index
         
+        Items carrying an 'embedding' field are indexed with that vector;
+        the others are embedded first. Each item is indexed under its 'id'
+        field, or under its position among all items added so far if it
+        has none.
+        
         Args:
             items: List of items to index
             batch_size: Number of items to process at once
         """
-        with self._index_lock:
-            if self.index is None:
-                self._init_index()
-            
+        # Items without an id are numbered after everything added so far
+        with self._index_lock.write():
+            base = self._next_auto_id
+            self._next_auto_id += len(items)
+        item_ids = [
+            item.get('id', base + idx) if isinstance(item, dict) else base + idx
+            for idx, item in enumerate(items)
+        ]
+        precomputed = [
+            idx for idx, item in enumerate(items)
+            if isinstance(item, dict) and item.get('embedding') is not None
+        ]
+        precomputed_set = set(precomputed)
+        to_embed = [idx for idx in range(len(items)) if idx not in precomputed_set]
+        
+        ids, vectors = [], []
+        if precomputed:
+            ids.extend(item_ids[idx] for idx in precomputed)
+            vectors.append(np.stack([np.asarray(items[idx]['embedding']) for idx in precomputed]))
+        
+        if to_embed:
             # Generate embeddings in batches
-            embeddings = self.embedder.batch_embed(items)
+            embeddings = self.embedder.batch_embed([items[idx] for idx in to_embed])
+            if embeddings:
+                ids.extend(item_ids[to_embed[pos]] for pos in embeddings)
+                vectors.append(np.stack(list(embeddings.values())))
+        
+        if ids:
+            self.add_vectors(ids, np.concatenate(vectors).astype(np.float32), batch_size=batch_size,
+                             copy=False)
+        if self.lexical_index is not None:
+            self.lexical_index.add(item_ids, items)
+    
+    def _allowed_slots(self, allowed_ids) -> np.ndarray:
+        """Live slots of the allowed ids; caller holds the lock"""
+        slot_of = self._slot_of
+        slots = [slot_of[item_id] for item_id in allowed_ids if item_id in slot_of]
+        return np.unique(np.array(slots, dtype=np.int64))
+    
+    def _exact_search(self, matrix: np.ndarray, slots: np.ndarray,
+                      k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Brute-force the queries against a few slots, FAISS-style; caller holds the lock"""
+        vectors = self.index.reconstruct_batch(slots)
+        if self.metric == 'cosine':
+            distances = matrix @ vectors.T
+            order = np.argsort(-distances, axis=1, kind='stable')[:, :k]
+        else:
+            distances = ((matrix ** 2).sum(axis=1)[:, None] - 2 * matrix @ vectors.T
+                         + (vectors ** 2).sum(axis=1)[None, :])
+            order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        indices = slots[order]
+        if order.shape[1] < k:
+            # Pad like FAISS does when fewer than k vectors are available
+            pad = k - order.shape[1]
+            distances = np.pad(distances, ((0, 0), (0, pad)))
+            indices = np.pad(indices, ((0, 0), (0, pad)), constant_values=-1)
+        return distances.astype(np.float32), indices
+    
+    def search_vectors(self, query_vectors: np.ndarray, k: int = 10, threshold: float = None,
+                       nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None,
+                       allowed_ids=None) -> List[List[Tuple[int, float]]]:
+        """
+        Search with precomputed query embeddings in a single FAISS call
+        
+        With `rescore_vectors` set on a quantized, PQ or reduced index, k x
+        rescore_factor candidates are fetched from the compressed index and
+        reranked by their exact similarity to the query.
+        
+        Args:
+            query_vectors: (q, d) array of query embeddings
+            k: Number of results per query
+            threshold: Optional similarity threshold
+            nprobe: IVF lists to scan per query
+            ef_search: HNSW candidate list size per query
+            allowed_ids: Optional ids to restrict the search to (e.g. from a
+                         metadata filter); small candidate sets are scored exactly
+            
+        Returns:
+            List of (item_id, similarity_score) lists, one per query
+        """
+        matrix = self._prepare_vectors(query_vectors, copy=True)
+        if len(matrix) == 0:
+            return []
+        compressed = self.rescore_vectors is not None and (
+            self.quantization is not None or self.index_type == 'ivf_pq'
+            or self.reduction is not None)
+        
+        with self._index_lock.read():
+            if self.index is None or not self._slot_of:
+                return [[] for _ in range(len(matrix))]
+            # The staging index holds exact vectors already
+            rescoring = compressed and not self._staging
+            fetch = k * self.index_params['rescore_factor'] if rescoring else k
             
-            # Convert embeddings to numpy array and normalize if using cosine similarity
-            vectors = []
-            for idx, emb in embeddings.items():
-                if emb is not None:
-                    self.id_map[len(vectors)] = idx
-                    vectors.append(emb)
+            allowed_slots = None
+            if allowed_ids is not None:
+                allowed_slots = self._allowed_slots(allowed_ids)
+                if len(allowed_slots) == 0:
+                    return [[] for _ in range(len(matrix))]
             
-            vectors = np.array(vectors).astype('float32')
-            if self.index_type == 'cosine':
-                faiss.normalize_L2(vectors)
+            if allowed_slots is not None and len(allowed_slots) <= self.index_params['exact_filter_size']:
+                distances, indices = self._exact_search(matrix, allowed_slots, fetch)
+            else:
+                # Search, skipping tombstoned (or filtered out) slots
+                params = self._search_params(nprobe, ef_search, allowed_slots)
+                if params is None:
+                    distances, indices = self.index.search(matrix, fetch)
+                else:
+                    distances, indices = self.index.search(matrix, fetch, params=params)
             
-            # Add to index in batches
-            for i in range(0, len(vectors), batch_size):
-                batch = vectors[i:i + batch_size]
-                self.index.add(batch)
+            # Convert FAISS slot ids to original ids and apply threshold
+            valid = indices != -1
+            item_ids = self._slot_ids[np.where(valid, indices, 0)]
+        
+        if rescoring:
+            distances, item_ids, valid = self._rescore(matrix, distances, item_ids, valid, k)
+        scores = 1 - distances / 2 if self.metric == 'l2' else distances
+        if threshold is not None:
+            valid &= scores >= threshold
+        
+        return [
+            list(zip(row_ids[row_valid].tolist(), row_scores[row_valid].tolist()))
+            for row_ids, row_scores, row_valid in zip(item_ids, scores, valid)
+        ]
+    
+    def _rescore(self, matrix: np.ndarray, distances: np.ndarray, item_ids: np.ndarray,
+                 valid: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Rerank over-fetched candidates by exact distance to their full-precision vectors
+        
+        Candidates missing from `rescore_vectors` keep their compressed distance.
+        
+        Returns:
+            (distances, item_ids, valid) for the best k candidates of each query
+        """
+        unique = np.unique(item_ids[valid])
+        if len(unique):
+            vectors, found = self.rescore_vectors.get_batch(unique)
+            vectors = self._prepare_vectors(vectors, copy=False)
+            position = np.minimum(np.searchsorted(unique, item_ids), len(unique) - 1)
+            candidates = vectors[position]
+            dots = np.einsum('qd,qcd->qc', matrix, candidates)
+            if self.metric == 'cosine':
+                exact = dots
+            else:
+                exact = ((matrix ** 2).sum(axis=1)[:, None] - 2 * dots
+                         + (candidates ** 2).sum(axis=2))
+            distances = np.where(valid & found[position], exact, distances).astype(np.float32)
+        
+        # Best first; padding slots sort last
+        key = -distances if self.metric == 'cosine' else distances
+        order = np.argsort(np.where(valid, key, np.inf), axis=1, kind='stable')[:, :k]
+        return (np.take_along_axis(distances, order, axis=1),
+                np.take_along_axis(item_ids, order, axis=1),
+                np.take_along_axis(valid, order, axis=1))
     
-    def search(self, query: str, k: int = 10, threshold: float = None) -> List[Tuple[int, float]]:
+    def search(self, query: str, k: int = 10, threshold: float = None,
+               nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+               allowed_ids=None, mode: str = 'semantic',
+               lexical_query: Optional[str] = None) -> List[Tuple[int, float]]:
         """
         Search for similar items
         
         Args:
             query: Search query
             k: Number of results to return
-            threshold: Optional similarity threshold
+            threshold: Optional similarity threshold (semantic scores only)
+            nprobe: IVF lists to scan for this query (higher = better recall, slower)
+            ef_search: HNSW candidate list size for this query (higher = better recall, slower)
+            allowed_ids: Optional ids to restrict the search to
+            mode: 'semantic' (vector search), 'lexical' (BM25 only, no embedding
+                  call) or 'hybrid' (both, fused with reciprocal rank fusion);
+                  the last two need a `lexical_index`
+            lexical_query: Text scored by BM25 instead of `query` (e.g. with
+                           clauses already applied as filters removed)
             
         Returns:
-            List of (item_id, similarity_score) tuples
+            List of (item_id, score) tuples: similarity, BM25 or fused scores
         """
-        with self._index_lock:
-            if self.index is None or self.index.ntotal == 0:
-                return []
+        if mode not in ('semantic', 'lexical', 'hybrid'):
+            raise ValueError(f"Unknown search mode: {mode}")
+        if mode != 'semantic':
+            if self.lexical_index is None:
+                raise ValueError(f"Search mode '{mode}' needs a lexical_index")
+            if lexical_query is None:
+                lexical_query = query
+            if mode == 'lexical':
+                return self.lexical_index.search(lexical_query, k, allowed_ids=allowed_ids)
             
-            # Generate query embedding
+            # Fuse deeper rankings than requested so items ranked well by one side can surface
+            depth = max(k * 4, 50)
+            semantic = self.search(query, depth, threshold, nprobe, ef_search, allowed_ids)
+            lexical = self.lexical_index.search(lexical_query, depth, allowed_ids=allowed_ids)
+            return reciprocal_rank_fusion([semantic, lexical], k)
+        
+        if self.index is None or not self._slot_of:
+            return []
+        
+        # Generate query embedding, sharing in-flight requests for repeated queries
+        if self.query_cache is not None and isinstance(query, str):
+            query_embedding = self.query_cache.get_or_compute(
+                query, lambda: self.embedder.embed_single(query)
+            )
+        else:
             query_embedding = self.embedder.embed_single(query)
-            if query_embedding is None:
-                return []
-            
-            # Reshape and convert type
-            query_vector = np.array([query_embedding]).astype('float32')
-            if self.index_type == 'cosine':
-                faiss.normalize_L2(query_vector)
-            
-            # Search
-            distances, indices = self.index.search(query_vector, k)
-            
-            # Convert FAISS ids to original ids and apply threshold
-            results = []
-            for dist, idx in zip(distances[0], indices[0]):
-                if idx != -1:  # Valid index
-                    score = 1 - dist/2 if self.index_type == 'l2' else dist
-                    if threshold is None or score >= threshold:
-                        original_id = self.id_map.get(idx, idx)
-                        results.append((original_id, float(score)))
-            
-            return results
+        if query_embedding is None:
+            return []
+        
+        return self.search_vectors(np.array([query_embedding]), k, threshold,
+                                   nprobe=nprobe, ef_search=ef_search,
+                                   allowed_ids=allowed_ids)[0]
     
     def batch_search(self, queries: List[str], k: int = 10, 
-                    threshold: float = None, max_workers: int = 4) -> List[List[Tuple[int, float]]]:
+                    threshold: float = None, max_workers: int = 4,
+                    nprobe: Optional[int] = None,
+                    ef_search: Optional[int] = None,
+                    allowed_ids=None) -> List[List[Tuple[int, float]]]:
         """
-        Search for multiple queries in parallel
+        Search for multiple queries at once
+        
+        Queries missing from the query cache are embedded with multi-input
+        requests, and all of them are searched with one FAISS call, which
+        FAISS parallelizes internally.
         
         Args:
             queries: List of search queries
             k: Number of results per query
             threshold: Optional similarity threshold
-            max_workers: Maximum number of parallel workers
+            max_workers: Unused, kept for backward compatibility
+            nprobe: IVF lists to scan per query
+            ef_search: HNSW candidate list size per query
+            allowed_ids: Optional ids to restrict every query to
             
         Returns:
             List of results for each query
         """
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            results = list(executor.map(
-                lambda q: self.search(q, k, threshold),
-                queries
-            ))
+        results: List[List[Tuple[int, float]]] = [[] for _ in queries]
+        if self.index is None or not self._slot_of:
+            return results
+        
+        embedded, positions, texts = [], [], []
+        for position, query in enumerate(queries):
+            cached = None
+            if self.query_cache is not None and isinstance(query, str):
+                cached = self.query_cache.get(query)
+            if cached is not None:
+                embedded.append((position, cached))
+                continue
+            text = self.embedder.extract_text(query)
+            if text is not None and text.strip():
+                positions.append(position)
+                texts.append(text)
+        
+        for position, embedding in zip(positions, self.embedder.generate_embeddings(texts)):
+            if embedding is None:
+                continue
+            embedded.append((position, embedding))
+            if self.query_cache is not None and isinstance(queries[position], str):
+                self.query_cache.put(queries[position], embedding)
+        if not embedded:
+            return results
+        
+        matrix = np.stack([embedding for _, embedding in embedded])
+        hits = self.search_vectors(matrix, k, threshold, nprobe=nprobe, ef_search=ef_search,
+                                   allowed_ids=allowed_ids)
+        for (position, _), query_hits in zip(embedded, hits):
+            results[position] = query_hits
         return results
     
     def update_item(self, item_id: int, new_item: dict) -> bool:
@@ -133,14 +939,7 @@ class SemanticRetriever:
         Returns:
             True if update successful
         """
-        # Find the FAISS id
-        faiss_id = None
-        for fid, oid in self.id_map.items():
-            if oid == item_id:
-                faiss_id = fid
-                break
-        
-        if faiss_id is None:
+        if item_id not in self._slot_of:
             return False
             
         # Generate new embedding
@@ -148,21 +947,17 @@ class SemanticRetriever:
         if new_embedding is None:
             return False
             
-        # Update the index
-        with self._index_lock:
-            vector = np.array([new_embedding]).astype('float32')
-            if self.index_type == 'cosine':
-                faiss.normalize_L2(vector)
-            self.index.remove_ids(np.array([faiss_id]))
-            self.index.add(vector)
-            
+        # Replace the vector; the old slot is tombstoned
+        self.upsert([item_id], np.array([new_embedding]))
+        if self.lexical_index is not None:
+            self.lexical_index.add([item_id], [new_item])
         return True
 
 # For backward compatibility
 def retrieve_emails(query: str, email_embeddings: Dict[int, np.ndarray], 
-                   k: int = 10) -> List[Tuple[int, float]]:
+                   k: int = 10, embedder: Optional[DataEmbedder] = None) -> List[Tuple[int, float]]:
     """Legacy function for backward compatibility"""
-    retriever = SemanticRetriever()
+    retriever = SemanticRetriever(embedder=embedder)
     
     # Convert email_embeddings to list format
     items = [{'id': idx, 'embedding': emb} for idx, emb in email_embeddings.items()]
@@ -170,7 +965,7 @@ def retrieve_emails(query: str, email_embeddings: Dict[int, np.ndarray],
     
     return retriever.search(query, k)
 
-def retrieve_emails(query, email_embeddings, top_k=3):
+def retrieve_emails(query, email_embeddings, top_k=3, embedder=None):
     """
     Retrieve top-k most relevant emails for the given query.
     
@@ -178,11 +973,12 @@ def retrieve_emails(query, email_embeddings, top_k=3):
         query: Query string
         email_embeddings: Dictionary mapping thread_id to numpy array of embeddings
         top_k: Number of results to return
+        embedder: Optional DataEmbedder used to embed the query
     
     Returns:
         List of thread_ids sorted by relevance
     """
-    retriever = SemanticRetriever()
+    retriever = SemanticRetriever(embedder=embedder)
     
     # Convert email_embeddings to list format
     items = [{'id': idx, 'embedding': emb} for idx, emb in email_embeddings.items()]
@@ -0,0 +1,37 @@
+import os
+import shutil
+import pandas as pd
+from column_cache import cache_manifest, load_email_csv
+
+def copy_fixture(tmp_path):
+    path = tmp_path / 'emails.csv'
+    shutil.copy('selected_emails.csv', path)
+    return str(path)
+
+def test_cached_load_matches_csv(tmp_path):
+    path = copy_fixture(tmp_path)
+    parsed = load_email_csv(path, use_cache=False)
+    load_email_csv(path)  # Builds the cache
+    assert cache_manifest(path)['rows'] == len(parsed)
+    cached = load_email_csv(path)
+    pd.testing.assert_frame_equal(cached, parsed, check_dtype=False)
+
+    # Timestamps are parsed and recipients decoded
+    assert pd.api.types.is_datetime64_any_dtype(cached['timestamp'])
+    assert isinstance(cached['to'].iloc[0], list)
+
+    # Projection loads only the requested columns, in file order
+    projected = load_email_csv(path, columns=['timestamp', 'thread_id'])
+    assert list(projected.columns) == ['thread_id', 'timestamp']
+
+def test_cache_rebuilt_when_csv_changes(tmp_path):
+    path = copy_fixture(tmp_path)
+    load_email_csv(path)
+    assert cache_manifest(path) is not None
+
+    df = pd.read_csv(path)
+    df.iloc[:3].to_csv(path, index=False)
+    os.utime(path, ns=(0, 0))
+    assert cache_manifest(path) is None
+    assert len(load_email_csv(path)) == 3
+    assert cache_manifest(path)['rows'] == 3
@@ -0,0 +1,115 @@
+from dedup import NearDuplicateIndex
+from test_email_store import make_store
+from test_optimized_store import make_store as make_optimized_store
+
+REPLY = ("Please find attached the revised schedule for the Wolf pipeline expansion. "
+         "Let me know if the volumes for March look right to you before Friday.")
+
+def test_near_duplicates_alias_the_first_copy(tmp_path):
+    index = NearDuplicateIndex()
+    duplicates = index.assign([1, 2, 3], [REPLY, REPLY + " Thanks", "Lunch on Tuesday at noon?"])
+    assert duplicates == {2: 1}
+    assert index.aliases_of(1) == [2]
+
+    index.save(str(tmp_path / "dedup.npz"))
+    reopened = NearDuplicateIndex()
+    reopened.load(str(tmp_path / "dedup.npz"))
+    assert reopened.assign([4], [REPLY.replace("Friday", "Monday")]) == {4: 1}
+    assert reopened.remove([1]) == {2: 1}
+    assert sorted(reopened.aliases.items()) == [(4, 2)]
+
+def test_email_store_shares_canonical_vector(tmp_path):
+    store, _ = make_store(tmp_path / "emails")
+    emails = [{'id': 1, 'content': REPLY}, {'id': 2, 'content': REPLY + " Thanks"},
+              {'id': 3, 'content': "Lunch on Tuesday at noon?"}]
+    assert store.sync(emails)['added'] == [1, 2, 3]
+    assert sorted(store.email_embeddings) == [1, 3]
+    assert store.retriever.size == 2
+    assert store.duplicates_of(1) == [2]
+
+    # Deleting the canonical copy hands its vector to the alias
+    summary = store.sync(emails[1:])
+    assert summary['deleted'] == [1]
+    assert summary['unchanged'] == [2, 3]
+    assert sorted(store.email_embeddings) == [2, 3]
+
+    reopened, client = make_store(tmp_path / "emails")
+    assert reopened.sync(emails[1:])['unchanged'] == [2, 3]
+    assert client.calls == 0
+
+def test_optimized_store_persists_aliases(tmp_path):
+    store = make_optimized_store(tmp_path)
+    store._process_batch([{'id': 1, 'content': REPLY}, {'id': 2, 'content': "Lunch on Tuesday?"}])
+    store._process_batch([{'id': 3, 'content': REPLY + " Thanks"}])
+    stats = store.get_processing_stats()
+    assert stats['total_emails'] == 2
+    assert stats['duplicate_emails'] == 1
+    store.close()
+
+    reopened = make_optimized_store(tmp_path)
+    assert reopened.retriever.size == 2
+    assert reopened.duplicates_of(1) == [3]
+    reopened.close()
+
+def test_saves_append_only_the_changes(tmp_path):
+    path = str(tmp_path / "dedup.npz")
+    index = NearDuplicateIndex()
+    index.assign(range(100), [f"note {i} about the {i * 7} contract" for i in range(100)])
+    index.save(path)
+    snapshot = (tmp_path / "dedup.npz").stat().st_size
+
+    index.assign([100, 101], [REPLY, REPLY + " Thanks"])
+    index.remove([5])
+    index.save(path)
+    # Three changed emails were appended, the snapshot was left alone
+    assert (tmp_path / "dedup.npz").stat().st_size == snapshot
+    assert (tmp_path / "dedup.npz.log").stat().st_size == 8 + 3 * (index.num_perm + 2) * 8
+
+    reopened = NearDuplicateIndex()
+    reopened.load(path)
+    assert len(reopened) == 100 and 5 not in reopened
+    assert reopened.aliases == {101: 100}
+    assert reopened.assign([102], [REPLY]) == {102: 100}
+
+def test_failed_batch_leaves_no_stale_aliases(tmp_path):
+    store = make_optimized_store(tmp_path)
+    store._process_batch([{'id': 1, 'content': REPLY}])
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("embedding service down")
+    embed = store.embedder.batch_embed
+    store.embedder.batch_embed = fail
+    batch = [{'id': 2, 'content': "Lunch on Tuesday?"}, {'id': 3, 'content': REPLY + " Thanks"}]
+    try:
+        store._process_batch(batch)
+    except RuntimeError:
+        pass
+    assert store.duplicates_of(1) == [] and 2 not in store.dedup
+
+    store.embedder.batch_embed = embed
+    store._process_batch(batch)
+    assert store.duplicates_of(1) == [3]
+    assert store.get_processing_stats()['total_emails'] == 2
+    store.close()
+
+def test_rewritten_canonical_hands_its_aliases_over(tmp_path):
+    index = NearDuplicateIndex()
+    index.assign([1, 2, 3], [REPLY, REPLY + " Thanks", REPLY + " Cheers"])
+    duplicates, promoted = index.assign([1], ["Lunch on Tuesday at noon?"], return_promoted=True)
+    assert duplicates == {} and promoted == {2: 1}
+    assert index.aliases == {3: 2}
+
+    store = make_optimized_store(tmp_path)
+    store._process_batch([{'id': 1, 'content': REPLY}, {'id': 2, 'content': REPLY + " Thanks"}])
+    vector = store._read_vectors([1])[1]
+    store._process_batch([{'id': 1, 'content': "Lunch on Tuesday at noon?"}])
+    # The alias keeps the vector of the text it duplicated
+    assert store.duplicates_of(1) == [] and 2 in store.dedup
+    assert store.get_processing_stats()['total_emails'] == 2
+    assert store.retriever.size == 2
+    store.close()
+
+    reopened = make_optimized_store(tmp_path)
+    assert reopened.duplicates_of(2) == [] and 2 in reopened.dedup
+    assert (reopened._read_vectors([2])[2] == vector).all()
+    reopened.close()
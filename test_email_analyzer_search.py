@@ -0,0 +1,29 @@
+import shutil
+import pytest
+from email_analyzer import EmailAnalyzer
+
+@pytest.fixture(scope='module')
+def analyzer(tmp_path_factory):
+    path = tmp_path_factory.mktemp('emails') / 'selected_emails.csv'
+    shutil.copy('selected_emails.csv', path)
+    return EmailAnalyzer(str(path))
+
+def full_scan(analyzer, query):
+    """Reference result: the unindexed scan over every column"""
+    df = analyzer.df
+    mask = df.apply(lambda x: analyzer._as_text(x).str.contains(query, case=False, na=False))
+    return df[mask.any(axis=1)]
+
+def test_indexed_search_matches_full_scan(analyzer):
+    queries = ["Thailand", "Astros Tickets", "Wolf -Reply", "wolf", "THAILAND",
+               "1003", "zz", "no such phrase anywhere", "Re: .*Wolf", "a", "'Doug Leach"]
+    for query in queries:
+        expected = full_scan(analyzer, query)
+        results = analyzer.search(query)
+        assert results.index.tolist() == expected.index.tolist(), query
+
+def test_candidates_narrow_plain_queries(analyzer):
+    candidates = analyzer._candidate_rows("Astros Tickets")
+    assert candidates is not None
+    assert len(candidates) < len(analyzer.df)
+    assert analyzer._candidate_rows("Re: .*Wolf") is None
@@ -0,0 +1,92 @@
+import pickle
+import threading
+import numpy as np
+from embeddings import DataEmbedder, LocalEmbeddingClient, OpenAIProvider
+from email_store import EmailStore
+from vector_storage import VectorSegmentStore
+
+def make_store(path, client=None):
+    client = client or LocalEmbeddingClient(dimension=16)
+    embedder = DataEmbedder(provider=OpenAIProvider(client=client, dimension=16), cache_path=None)
+    return EmailStore(str(path), embedder=embedder), client
+
+def test_reopening_store_loads_vectors_without_embedding(tmp_path):
+    store, _ = make_store(tmp_path / "emails")
+    emails = [{'id': 10 + i, 'content': f"message number {i}"} for i in range(5)]
+    store.create_embeddings(emails[:3])
+    store.create_embeddings(emails[3:])
+
+    reopened, client = make_store(tmp_path / "emails")
+    assert client.calls == 0
+    assert reopened.retriever.size == 5
+    assert set(reopened.email_embeddings) == {10, 11, 12, 13, 14}
+    assert reopened.email_embeddings[12].dtype == np.float32
+    assert reopened.update_embeddings(emails) == []
+    assert client.calls == 0
+
+def test_legacy_pickle_is_migrated(tmp_path):
+    legacy = {1: np.ones(16), 2: np.full(16, 2.0)}
+    with open(tmp_path / "emails.pkl", 'wb') as f:
+        pickle.dump(legacy, f)
+
+    store, client = make_store(tmp_path / "emails.pkl")
+    assert client.calls == 0
+    assert np.allclose(store.email_embeddings[2], 2.0)
+    assert store.retriever.size == 2
+
+def test_segments_compact_to_latest_vectors(tmp_path):
+    storage = VectorSegmentStore(str(tmp_path / "segments"), dimension=4,
+                                 segment_rows=2, auto_compact=False)
+    for i in range(5):
+        storage.append([i % 3], np.full((1, 4), i, dtype=np.float32))
+
+    assert storage.compact() == 2
+    reopened = VectorSegmentStore(str(tmp_path / "segments"))
+    assert len(list(reopened.segments())) == 1
+    assert {i: float(v[0]) for i, v in reopened.as_dict().items()} == {0: 3.0, 1: 4.0, 2: 2.0}
+
+def test_reads_stay_consistent_during_compaction(tmp_path):
+    storage = VectorSegmentStore(str(tmp_path / "segments"), dimension=4,
+                                 segment_rows=2, auto_compact=False)
+    storage.append(range(8), np.ones((8, 4), dtype=np.float32))
+    done = threading.Event()
+
+    def churn():
+        for i in range(30):
+            storage.append([i % 8], np.ones((1, 4), dtype=np.float32))
+            storage.compact()
+        done.set()
+    thread = threading.Thread(target=churn)
+    thread.start()
+    while not done.is_set():
+        assert all(storage.get(i) is not None for i in range(8))
+        assert storage.get_batch(range(8))[1].all()
+    thread.join()
+
+def test_sync_reembeds_only_changes_and_deletes_missing(tmp_path):
+    store, client = make_store(tmp_path / "emails")
+    emails = [{'id': i, 'content': f"message number {i}"} for i in range(4)]
+    summary = store.sync(emails)
+    assert sorted(summary['added']) == [0, 1, 2, 3]
+    calls = client.calls
+
+    snapshot = [emails[0], {'id': 1, 'content': "edited message"}, emails[2],
+                {'id': 7, 'content': "brand new message"}]
+    summary = store.sync(snapshot)
+    assert summary['added'] == [7]
+    assert summary['changed'] == [1]
+    assert sorted(summary['unchanged']) == [0, 2]
+    assert summary['deleted'] == [3]
+    assert client.calls == calls + 1
+    assert store.retriever.size == 4
+
+    # A partial snapshot only deletes ids within its scope
+    summary = store.sync([emails[0]], full_snapshot=False, scope_ids=[0, 2])
+    assert summary['deleted'] == [2]
+
+    reopened, client = make_store(tmp_path / "emails")
+    assert set(reopened.email_embeddings) == {0, 1, 7}
+    assert reopened.update_embeddings(snapshot[:2]) == []
+    assert client.calls == 0
+    assert reopened.storage.compact() > 0
+    assert set(VectorSegmentStore(str(tmp_path / "emails")).ids()) == {0, 1, 7}
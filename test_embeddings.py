@@ -0,0 +1,133 @@
+import asyncio
+import numpy as np
+import pytest
+from embeddings import DataEmbedder, EmbeddingProvider, LocalEmbeddingClient, LocalHashingProvider
+from embedding_cache import EmbeddingCache
+from embedding_pipeline import TokenBucket
+from evaluation import EmailEvaluator
+
+def test_batch_embed_sends_one_request_per_batch():
+    client = LocalEmbeddingClient(dimension=8)
+    embedder = DataEmbedder(batch_size=4, client=client, cache_path=None)
+    items = [{'content': f"email number {i}"} for i in range(10)]
+    items[3] = {'content': '   '}
+
+    embeddings = embedder.batch_embed(items)
+
+    assert client.calls == 3
+    assert sorted(embeddings) == [i for i in range(10) if i != 3]
+    # Vectors are mapped back to the item they were computed from
+    for idx, vector in embeddings.items():
+        expected = embedder.embed_single(items[idx])
+        assert np.allclose(vector, expected)
+
+def test_cache_serves_repeated_texts_across_embedders(tmp_path):
+    cache_path = str(tmp_path / "cache.db")
+    client = LocalEmbeddingClient(dimension=8)
+    items = ["quoted reply", "quoted reply", "fresh message"]
+
+    first = DataEmbedder(client=client, cache_path=cache_path).batch_embed(items)
+    assert client.calls == 1
+
+    second_embedder = DataEmbedder(client=client, cache_path=cache_path)
+    second = second_embedder.batch_embed(items)
+    assert second_embedder.embed_single("fresh message") is not None
+    assert client.calls == 1
+    assert second_embedder.cache.stats()['hits'] == 4
+    for idx in first:
+        assert np.allclose(first[idx], second[idx])
+
+def test_cache_buffers_recency_of_hits(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), touch_batch_size=3)
+    cache.put_many({key: np.ones(4) for key in 'abc'})
+    writes = cache._conn.total_changes
+    cache.get_many(['a', 'b'])
+    assert cache._conn.total_changes == writes
+    cache.get('c')
+    assert cache._conn.total_changes == writes + 3
+    cache.close()
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_entries=2)
+    cache.put('a', np.ones(4))
+    cache.put('b', np.ones(4))
+    cache.get('a')
+    cache.put('c', np.ones(4))
+
+    assert set(cache.get_many(['a', 'b', 'c'])) == {'a', 'c'}
+    assert cache.stats()['entries'] == 2
+
+def test_batch_embed_retries_transient_errors_concurrently():
+    client = LocalEmbeddingClient(dimension=8, latency=0.05, failure_rate=0.3, seed=1)
+    embedder = DataEmbedder(batch_size=2, client=client, cache_path=None,
+                            max_in_flight=8, max_retries=10)
+    embedder.engine.backoff_base = 0.01
+    items = [f"message {i}" for i in range(16)]
+
+    embeddings, dead_letters = embedder.batch_embed(items, return_dead_letters=True)
+
+    assert sorted(embeddings) == list(range(16))
+    assert dead_letters == []
+    assert client.calls > 8
+
+def test_batch_embed_reports_dead_letters():
+    client = LocalEmbeddingClient(dimension=8, fail_texts={"poison"})
+    embedder = DataEmbedder(batch_size=4, client=client, cache_path=None)
+    items = ["first", "poison", "third"]
+
+    embeddings, dead_letters = embedder.batch_embed(items, return_dead_letters=True)
+
+    assert sorted(embeddings) == [0, 2]
+    assert [(d['index'], d['item'], d['transient']) for d in dead_letters] == [(1, "poison", False)]
+    assert embedder.dead_letters == dead_letters
+
+def test_single_embeds_share_the_engine_retries_and_rate_limits():
+    client = LocalEmbeddingClient(dimension=8, failure_rate=0.5, seed=2)
+    embedder = DataEmbedder(client=client, cache_path=None, max_retries=10)
+    embedder.engine.backoff_base = 0.01
+    # Large burst, negligible refill: the bucket counts the requests
+    embedder.engine.request_bucket = TokenBucket(1, capacity=1000)
+    texts = [f"query {i}" for i in range(8)]
+
+    assert all(embedder.embed_single(text) is not None for text in texts)
+    embedder.batch_embed(["one more", "and another"])
+    # Transient failures were retried, and every request drew from one bucket
+    assert client.calls > 9
+    assert round(1000 - embedder.engine.request_bucket.tokens) == client.calls
+
+def test_local_provider_is_deterministic_and_semantic_enough():
+    embedder = DataEmbedder(provider=LocalHashingProvider(dimension=64), cache_path=None)
+    vectors = embedder.batch_embed([
+        "lunch plans for friday",
+        "friday lunch plans at noon",
+        "quarterly gas trading report"
+    ])
+
+    assert embedder.dimension == 64
+    assert all(v.shape == (64,) and v.dtype == np.float32 for v in vectors.values())
+    assert np.allclose(vectors[0], embedder.embed_single("lunch plans for friday"))
+    assert vectors[0] @ vectors[1] > vectors[0] @ vectors[2]
+
+def test_evaluator_runs_offline_by_default(monkeypatch):
+    monkeypatch.delenv('EMBEDDING_PROVIDER', raising=False)
+    assert isinstance(EmailEvaluator([]).embedder.provider, LocalHashingProvider)
+    with pytest.raises(TypeError):
+        EmbeddingProvider()
+
+def test_engine_reuses_one_event_loop():
+    embedder = DataEmbedder(provider=LocalHashingProvider(dimension=16), cache_path=None)
+    embedder.batch_embed(["first batch"])
+    loop = embedder.engine._loop
+    embedder.batch_embed(["second batch"])
+    assert embedder.engine._loop is loop and loop.is_running()
+
+    async def from_a_coroutine():
+        return embedder.embed_single("inside a running loop")
+    assert asyncio.run(from_a_coroutine()) is not None
+
+    embedder.engine.close()
+    assert loop.is_closed()
+    assert embedder.embed_single("after close") is not None
+
+if __name__ == '__main__':
+    test_batch_embed_sends_one_request_per_batch()
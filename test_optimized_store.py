@@ -0,0 +1,156 @@
+import time
+import json
+import queue
+import pytest
+import sqlite3
+import threading
+import numpy as np
+from embeddings import DataEmbedder, LocalEmbeddingClient, OpenAIProvider
+from optimized_store import OptimizedEmailStore
+
+def make_store(tmp_path, **kwargs):
+    client = LocalEmbeddingClient(dimension=16)
+    embedder = DataEmbedder(provider=OpenAIProvider(client=client, dimension=16), cache_path=None)
+    return OptimizedEmailStore(db_path=str(tmp_path / "store.db"),
+                               index_path=str(tmp_path / "index" / "faiss"),
+                               embedder=embedder, **kwargs)
+
+def test_processing_stats_follow_bulk_writes(tmp_path):
+    store = make_store(tmp_path)
+    store._process_batch([{'id': i, 'content': f"email {i}"} for i in range(5)])
+    store._process_batch([{'id': i, 'content': f"edited email {i}"} for i in range(3, 8)])
+
+    stats = store.get_processing_stats()
+    assert stats['total_emails'] == 8
+    assert stats['processed_emails'] == 8
+    # Replaced rows give back their embedded length: 3 x 'email i' + 5 x 'edited email i'
+    assert stats['avg_text_length'] == (3 * 7 + 5 * 14) / 8
+    store.close()
+
+    with sqlite3.connect(tmp_path / "store.db") as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0] == 8
+
+    reopened = make_store(tmp_path)
+    assert reopened.get_processing_stats()['total_emails'] == 8
+    assert reopened.get_processing_stats()['avg_text_length'] == (3 * 7 + 5 * 14) / 8
+    assert reopened.retriever.size == 8
+    reopened.close()
+
+def test_queued_emails_flush_on_deadline_and_on_close(tmp_path):
+    store = make_store(tmp_path, batch_size=100, processing_interval=0.2)
+    store.queue_emails([{'id': i, 'content': f"email {i}"} for i in range(5)])
+    deadline = time.monotonic() + 5
+    while store.retriever.size < 5 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert store.retriever.size == 5
+
+    store.queue_emails([{'id': i, 'content': f"burst email {i}"} for i in range(5, 2000)])
+    store.close()
+    assert store.get_processing_stats()['total_emails'] == 2000
+    assert store.get_queue_size() == 0
+
+    reopened = make_store(tmp_path)
+    assert reopened.retriever.size == 2000
+    reopened.close()
+
+def test_pending_emails_survive_restart_and_respect_high_water_mark(tmp_path):
+    crashed = make_store(tmp_path, num_workers=0, queue_high_water_mark=10,
+                         block_when_full=False)
+    crashed.queue_emails([{'id': i, 'content': f"email {i}"} for i in range(8)])
+    with pytest.raises(queue.Full):
+        crashed.queue_emails([{'id': i, 'content': f"email {i}"} for i in range(8, 11)])
+    assert crashed.get_queue_size() == 8
+    assert crashed.get_processing_stats()['queue_oldest_age'] >= 0
+
+    # Never closed: a new store on the same files picks the pending emails up
+    restarted = make_store(tmp_path)
+    assert restarted.flush(timeout=10)
+    assert restarted.get_queue_size() == 0
+    assert restarted.get_processing_stats()['total_emails'] == 8
+    restarted.close()
+
+def test_warm_start_indexes_only_the_missing_tail(tmp_path):
+    store = make_store(tmp_path, index_save_interval=3600)
+    store._process_batch([{'id': i, 'content': f"email {i}"} for i in range(5)])
+    assert store.flush(timeout=10)
+    store._process_batch([{'id': i, 'content': f"email {i}"} for i in range(5, 8)])
+    with open(tmp_path / "index" / "faiss.state.json") as f:
+        assert json.load(f) == {'write_seq': 1, 'rows': 5}
+
+    # Not closed: the snapshot misses the second batch
+    reopened = make_store(tmp_path)
+    assert reopened.retriever.size == 8
+    with open(tmp_path / "index" / "faiss.state.json") as f:
+        assert json.load(f) == {'write_seq': 2, 'rows': 8}
+
+    # A corrupt snapshot is rebuilt from the database
+    with open(tmp_path / "index" / "faiss.index", 'wb') as f:
+        f.write(b"garbage")
+    rebuilt = make_store(tmp_path)
+    assert rebuilt.retriever.size == 8
+    assert rebuilt.search("email 3", k=1)[0][0] == 3
+    rebuilt.close()
+
+def test_quantized_index_reranks_with_database_vectors(tmp_path):
+    store = make_store(tmp_path, quantization='sq8')
+    store._process_batch([{'id': i, 'content': f"message about topic {i}"} for i in range(40)])
+    query = store.embedder.embed_single("message about topic 7")
+    hits = store.retriever.search_vectors(np.array([query]), k=3)[0]
+    assert hits[0][0] == 7
+    assert hits[0][1] > 0.999
+
+    # Training on demand swaps in an sq8 index holding every stored vector
+    store.train()
+    assert store.retriever.size == 40
+    assert store.retriever.search_vectors(np.array([query]), k=1)[0][0][0] == 7
+    store.close()
+
+def test_flush_waits_for_indexing_and_gives_up_on_failing_emails(tmp_path):
+    store = make_store(tmp_path, processing_interval=0.05)
+    store.queue_emails([{'id': i, 'content': f"email {i}"} for i in range(300)])
+    assert store.flush()
+    # Acknowledged batches are searchable once flush returns
+    assert store.retriever.size == 300
+    store.close()
+
+    # Every request times out: retried max_attempts times, then dead-lettered
+    client = LocalEmbeddingClient(dimension=16, failure_rate=1.0)
+    embedder = DataEmbedder(provider=OpenAIProvider(client=client, dimension=16),
+                            cache_path=None, max_retries=0)
+    failing = OptimizedEmailStore(db_path=str(tmp_path / "failing.db"),
+                                  index_path=str(tmp_path / "failing" / "faiss"),
+                                  embedder=embedder, processing_interval=0.05, max_attempts=3)
+    failing.queue_emails([{'id': 1, 'content': "first"}, {'id': 2, 'content': "second"}])
+    assert failing.flush(timeout=None)
+    dead = failing.processing_queue.dead_letters()
+    assert [(attempts, item['id']) for _, attempts, item in dead] == [(3, 1), (3, 2)]
+    assert failing.get_queue_size() == 0
+    failing.close()
+
+def test_index_updates_apply_in_commit_order(tmp_path):
+    store = make_store(tmp_path, num_workers=0)
+    write = store._write_embeddings
+    second_committed = threading.Event()
+
+    def delayed_write(*args, **kwargs):
+        seq = write(*args, **kwargs)
+        if seq == 1:
+            # The first batch reaches the index only after the second one committed
+            second_committed.wait(5)
+        else:
+            second_committed.set()
+        return seq
+    store._write_embeddings = delayed_write
+
+    first = threading.Thread(target=store._process_batch, args=([{'id': 1, 'content': "old draft"}],))
+    first.start()
+    while not store._unindexed_seqs:
+        time.sleep(0.01)
+    store._process_batch([{'id': 1, 'content': "final version"}])
+    first.join()
+
+    query = store.embedder.embed_single("final version")
+    hits = store.retriever.search_vectors(np.array([query]), k=1)[0]
+    assert hits[0][0] == 1 and hits[0][1] > 0.999
+    store.close()
@@ -0,0 +1,71 @@
+import numpy as np
+from embeddings import DataEmbedder, LocalHashingProvider
+from passages import PassageRetriever, chunk_spans
+from preprocessing import EmailPreprocessor
+from retrieval import SemanticRetriever
+
+def make_passages(**kwargs):
+    embedder = DataEmbedder(provider=LocalHashingProvider(dimension=256), cache_path=None)
+    retriever = SemanticRetriever(index_type='cosine', embedder=embedder, query_cache_size=0)
+    return PassageRetriever(retriever, **kwargs)
+
+def test_chunk_spans_overlap_and_cover_the_text():
+    text = " ".join(f"w{i}" for i in range(25))
+    spans = chunk_spans(text, window=10, overlap=3)
+    words = [text[start:end].split() for start, end in spans]
+    assert words[0][0] == "w0" and words[-1][-1] == "w24"
+    assert all(len(chunk) <= 10 for chunk in words)
+    for previous, current in zip(words, words[1:]):
+        assert previous[-3:] == current[:3]
+    assert chunk_spans("   ") == []
+
+def test_long_documents_are_found_by_their_best_passage():
+    rng = np.random.default_rng(0)
+    filler = lambda n: " ".join(f"filler{i}" for i in rng.integers(0, 500, n))
+    thread = filler(400) + " the astros tickets for the box on may 18th " + filler(400)
+    emails = [
+        {'id': 7, 'content': thread},
+        {'id': 8, 'content': "quarterly gas trading report " + filler(50)},
+        {'id': 9, 'content': "lunch plans for friday"},
+    ]
+    passages = make_passages(window=40, overlap=10)
+    assert passages.add_items(emails) > 3
+    assert passages.size == 3
+
+    for aggregation in ('max', 'sum'):
+        results = passages.search("astros tickets box", k=2, aggregation=aggregation)
+        assert [item_id for item_id, _, _ in results][:1] == [7]
+        assert len({item_id for item_id, _, _ in results}) == len(results)
+    _, _, offsets = passages.search("astros tickets box", k=1)[0]
+    assert "astros tickets" in passages.passage(emails[0], offsets)
+
+    assert passages.search("astros tickets box", k=3, allowed_ids=[8, 9])[0][0] in (8, 9)
+
+    # Replacing a document drops its old passages; deleting removes it
+    passages.add_items([{'id': 7, 'content': "lunch plans moved to monday"}])
+    assert passages.retriever.size == len(passages._chunks_of[7]) + sum(
+        len(passages._chunks_of[i]) for i in (8, 9))
+    assert passages.delete([7, 99]) == 1
+    assert 7 not in [item_id for item_id, _, _ in passages.search("lunch plans", k=3)]
+
+def test_passages_use_the_embedder_preprocessing_and_replace_atomically():
+    embedder = DataEmbedder(provider=LocalHashingProvider(dimension=256), cache_path=None,
+                            preprocessor=EmailPreprocessor())
+    retriever = SemanticRetriever(index_type='cosine', embedder=embedder, query_cache_size=0)
+    passages = PassageRetriever(retriever, window=20, overlap=5)
+    email = {'id': 1, 'subject': "Tickets", 'content': "Box seats are booked for Friday.\n\n"
+                                                       "> On Monday Sally wrote:\n> astros parking pass"}
+    passages.add_items([email])
+    text = passages._text(email)
+    assert text == embedder.extract_text(email) and "parking" not in text
+
+    # Retiring the old passages and adding the new ones is a single index write
+    writes = []
+    upsert = retriever.upsert
+    retriever.upsert = lambda *args, **kwargs: (writes.append(kwargs.get('replaces')),
+                                                upsert(*args, **kwargs))
+    retriever.delete = None
+    passages.add_items([dict(email, content="Box seats moved to Saturday.")])
+    assert len(writes) == 1 and len(writes[0]) == 1
+    assert retriever.size == 1
+    assert passages.search("box seats saturday", k=1)[0][0] == 1
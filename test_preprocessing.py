@@ -0,0 +1,55 @@
+from embeddings import DataEmbedder, LocalHashingProvider
+from preprocessing import EmailPreprocessor, strip_quoted
+
+OUTLOOK_REPLY = (
+    "Yes, I am very busy today.\n\n"
+    " -----Original Message-----\n"
+    "From: \tDarrin Presto\n"
+    "Sent:\tWednesday, June 20, 2001 11:26 AM\n"
+    "To:\tPresto, Kevin M.\n"
+    "Subject:\tRE: Wolf -Reply\n\n"
+    "let me know if you got anything.\n"
+)
+
+NOTES_FORWARD = (
+    "---------------------- Forwarded by Judy Hernandez/HOU/ECT on 02/01/2000 \n"
+    "02:45 PM ---------------------------\n\n"
+    "\tFrom:  Maria Sandoval                           01/25/2000 01:32 PM\n\n"
+    "To: Andrea R Guillen/HOU/ECT@ECT, Phenicia \n"
+    "Olivier/HOU/ECT@ECT\n"
+    "cc:  \n"
+    "Subject: Fwd: So Very True...\n\n"
+    "This is sooooo very true.\n"
+    "---------------------- Forwarded by Maria Sandoval/HOU/ECT on 01/25/2000 \n"
+    "01:32 PM ---------------------------\n\n"
+    "Older forwarded text\n"
+)
+
+def test_strip_quoted_keeps_only_new_content():
+    assert strip_quoted(OUTLOOK_REPLY) == "Yes, I am very busy today."
+    assert strip_quoted("Sounds good.\n\n> Are we on for lunch?\n> Bob\n--\nAlice\nVP Sales") == "Sounds good."
+    notes_reply = ("I'd blow it off.\n\n\n\tKaren Denne\n\t05/29/2001 01:07 PM\n\t\t\n"
+                   "\t\t To: Jeff Dasovich/NA/Enron@Enron\n\t\t Subject: Re: SF Gate\n\nQuoted text")
+    assert strip_quoted(notes_reply) == "I'd blow it off."
+    # A bare forward is represented by the message it forwards
+    assert strip_quoted(NOTES_FORWARD) == "This is sooooo very true."
+    assert strip_quoted("No quotes at all") == "No quotes at all"
+
+def test_preprocessor_header_and_stats():
+    preprocessor = EmailPreprocessor(max_recipients=1)
+    email = {'subject': 'RE: Wolf -Reply', 'from': 'Kevin Presto',
+             'to': "['Darrin Presto', 'Greg Wolfe']", 'body': OUTLOOK_REPLY}
+    text = preprocessor.prepare(email, content_field='body')
+    assert text == ("Subject: RE: Wolf -Reply\nFrom: Kevin Presto\n"
+                    "To: Darrin Presto (+1 more)\n\nYes, I am very busy today.")
+    stats = preprocessor.stats()
+    assert stats['emails'] == 1
+    assert stats['output_chars'] == len("Yes, I am very busy today.")
+    assert stats['kept_ratio'] < 0.2
+
+def test_embedder_uses_preprocessor_for_dicts():
+    embedder = DataEmbedder(provider=LocalHashingProvider(dimension=16), cache_path=None,
+                            preprocessor=EmailPreprocessor())
+    assert embedder.extract_text({'content': OUTLOOK_REPLY}) == "Yes, I am very busy today."
+    # Plain strings (queries) are embedded as given
+    assert embedder.extract_text(OUTLOOK_REPLY) == OUTLOOK_REPLY
@@ -0,0 +1,254 @@
+import threading
+import faiss
+import numpy as np
+from embeddings import DataEmbedder, LocalEmbeddingClient
+from lexical import BM25Index
+from retrieval import SemanticRetriever
+from vector_storage import VectorSegmentStore
+
+def make_retriever(dimension=16, **kwargs):
+    client = LocalEmbeddingClient(dimension=dimension)
+    embedder = DataEmbedder(client=client, cache_path=None)
+    # Tests swap the query embedding per call, so query caching is opt-in here
+    kwargs.setdefault('query_cache_size', 0)
+    return SemanticRetriever(dimension=dimension, embedder=embedder, **kwargs), client
+
+def test_precomputed_vectors_are_indexed_without_embedding():
+    retriever, client = make_retriever(index_type='cosine')
+    vectors = np.random.default_rng(0).standard_normal((5, 16)).astype(np.float32)
+    original = vectors.copy()
+
+    retriever.add_items([{'id': 100 + i, 'embedding': v} for i, v in enumerate(vectors[:3])])
+    retriever.add_vectors([103, 104], vectors[3:])
+
+    assert client.calls == 0
+    assert np.array_equal(vectors, original)
+    assert retriever.index.ntotal == 5
+    assert sorted(retriever.id_map.values()) == [100, 101, 102, 103, 104]
+
+    # Searching with one of the stored vectors finds it first
+    retriever.embedder.embed_single = lambda _: vectors[4]
+    assert retriever.search('anything', k=1)[0][0] == 104
+
+def test_upsert_delete_and_compact_keep_external_ids_stable():
+    retriever, _ = make_retriever(index_type='cosine')
+    vectors = np.eye(16, dtype=np.float32)
+
+    retriever.add_vectors([10, 11, 12, 13], vectors[:4])
+    retriever.upsert([11], vectors[5:6])
+    assert retriever.delete([12, 99]) == 1
+    assert retriever.size == 3
+
+    def top_hit(vector):
+        retriever.embedder.embed_single = lambda _: vector
+        return retriever.search('q', k=1)[0][0]
+
+    assert top_hit(vectors[5]) == 11
+    assert top_hit(vectors[3]) == 13
+    assert 12 not in [item_id for item_id, _ in retriever.search('q', k=10)]
+
+    assert retriever.compact() == 2
+    assert retriever.index.ntotal == 3
+    assert top_hit(vectors[5]) == 11
+    assert top_hit(vectors[0]) == 10
+
+def test_items_without_ids_are_numbered_across_calls():
+    retriever, _ = make_retriever()
+    retriever.add_items(["first", "second"])
+    retriever.add_items(["third"])
+    assert sorted(retriever.id_map.values()) == [0, 1, 2]
+
+def test_approximate_indexes_train_search_and_persist(tmp_path):
+    vectors = np.random.default_rng(1).standard_normal((2000, 16)).astype(np.float32)
+    for index_type in ('ivf_flat', 'hnsw'):
+        retriever, _ = make_retriever(index_type=index_type, metric='cosine',
+                                      index_params={'nlist': 16})
+        retriever.add_vectors(np.arange(2000), vectors)
+        assert retriever.index.is_trained
+
+        retriever.embedder.embed_single = lambda _: vectors[42]
+        assert retriever.search('q', k=1, nprobe=16, ef_search=128)[0][0] == 42
+
+        retriever.save(str(tmp_path / index_type))
+        reloaded, _ = make_retriever(index_type=index_type, metric='cosine')
+        reloaded.load(str(tmp_path / index_type))
+        reloaded.embedder.embed_single = lambda _: vectors[42]
+        assert reloaded.search('q', k=1)[0][0] == 42
+
+def test_batch_search_embeds_all_queries_in_one_request():
+    retriever, client = make_retriever(index_type='cosine')
+    documents = [f"document about topic {i}" for i in range(20)]
+    retriever.add_items(documents)
+    calls_before = client.calls
+
+    results = retriever.batch_search(documents[:5] + [""], k=3)
+
+    assert client.calls == calls_before + 1
+    assert [hits[0][0] for hits in results[:5]] == [0, 1, 2, 3, 4]
+    assert results[5] == []
+    assert results[0] == retriever.search(documents[0], k=3)
+
+def test_search_is_not_blocked_by_ingest_embedding():
+    client = LocalEmbeddingClient(dimension=16)
+    embedder = DataEmbedder(client=client, cache_path=None)
+    retriever = SemanticRetriever(dimension=16, embedder=embedder, query_cache_size=0)
+    vectors = np.eye(16, dtype=np.float32)
+    retriever.add_vectors(range(100, 116), vectors)
+    retriever.embedder.embed_single = lambda _: vectors[3]
+
+    # Hold the ingest inside its embedding request until the search is done
+    embedding, release = threading.Event(), threading.Event()
+    create = client.create
+    def blocking_create(**kwargs):
+        embedding.set()
+        release.wait(10)
+        return create(**kwargs)
+    client.create = blocking_create
+
+    writer = threading.Thread(target=retriever.add_items, args=(["slow to embed"] * 4,))
+    writer.start()
+    assert embedding.wait(10)
+    assert retriever.search('q', k=1)[0][0] == 103
+    assert writer.is_alive()
+    release.set()
+    writer.join()
+    assert retriever.size == 20
+
+def test_query_cache_coalesces_concurrent_identical_queries():
+    retriever, client = make_retriever(query_cache_size=8)
+    retriever.add_items([f"email {i}" for i in range(8)])
+    client.latency = 0.2
+    calls_before = client.calls
+
+    threads = [
+        threading.Thread(target=retriever.search, args=(query,))
+        for query in ["Lunch plans", "lunch   PLANS", " lunch plans "]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    retriever.search("LUNCH plans")
+    retriever.batch_search(["lunch plans", "astros tickets"])
+
+    assert client.calls == calls_before + 2
+    stats = retriever.query_cache.stats()
+    assert stats['misses'] == 2 and stats['hits'] + stats['coalesced'] == 4
+
+def test_filtered_search_returns_only_allowed_ids():
+    vectors = np.random.default_rng(3).standard_normal((2000, 16)).astype(np.float32)
+    allowed = set(range(0, 2000, 7))
+    for index_type, params in (('l2', {}), ('ivf_flat', {'nlist': 16, 'nprobe': 1}),
+                               ('hnsw', {'ef_search': 8})):
+        retriever, _ = make_retriever(index_type=index_type, index_params=params)
+        retriever.add_vectors(np.arange(2000), vectors)
+        query = vectors[14:15] + 0.01
+
+        # Small candidate sets are scored exactly
+        exact = retriever.search_vectors(query, k=5, allowed_ids=allowed)[0]
+        assert exact[0][0] == 14
+        assert len(exact) == 5 and {item_id for item_id, _ in exact} <= allowed
+
+        # Larger ones go through a FAISS selector
+        retriever.index_params['exact_filter_size'] = 0
+        filtered = retriever.search_vectors(query, k=5, allowed_ids=allowed)[0]
+        assert filtered[0][0] == 14
+        assert {item_id for item_id, _ in filtered} <= allowed
+        assert retriever.search_vectors(query, k=5, allowed_ids=[])[0] == []
+
+def test_lexical_and_hybrid_modes():
+    retriever, client = make_retriever(lexical_index=BM25Index())
+    emails = [
+        {'id': 1, 'subject': "Astros Tickets", 'from': "sally@enron.com", 'content': "Two seats for Friday"},
+        {'id': 2, 'subject': "Deal 96023451", 'from': "mark@enron.com", 'content': "Volumes confirmed"},
+        {'id': 3, 'subject': "Lunch", 'from': "emily@enron.com", 'content': "Sandwiches at noon"},
+    ]
+    retriever.add_items(emails)
+    calls = client.calls
+
+    assert retriever.search("astros tickets", k=2, mode='lexical')[0][0] == 1
+    assert retriever.search("96023451", k=2, mode='lexical')[0][0] == 2
+    assert client.calls == calls
+
+    assert retriever.search("deal 96023451 volumes", k=3, mode='hybrid')[0][0] == 2
+    # BM25 can score a query with its filter clauses stripped
+    assert retriever.search("from sally", k=2, mode='lexical', lexical_query="96023451")[0][0] == 2
+    retriever.delete([2])
+    assert retriever.search("96023451", k=2, mode='lexical') == []
+
+def test_quantized_index_rescores_against_full_vectors(tmp_path):
+    rng = np.random.default_rng(2)
+    vectors = rng.standard_normal((3000, 16)).astype(np.float32)
+    queries = vectors[:50] + 0.1 * rng.standard_normal((50, 16)).astype(np.float32)
+    storage = VectorSegmentStore(str(tmp_path / "vectors"), dimension=16)
+    storage.append(np.arange(3000), vectors)
+
+    exact, _ = make_retriever()
+    exact.add_vectors(np.arange(3000), vectors)
+    truth = exact.search_vectors(queries, k=10)
+    for quantization in ('fp16', 'sq8'):
+        retriever, _ = make_retriever(quantization=quantization, rescore_vectors=storage)
+        retriever.add_vectors(np.arange(3000), vectors)
+        hits = retriever.search_vectors(queries, k=10)
+        # Reranked candidates come back with their exact scores
+        for found, expected in zip(hits, truth):
+            assert [item_id for item_id, _ in found] == [item_id for item_id, _ in expected]
+            assert np.allclose([s for _, s in found], [s for _, s in expected], atol=1e-4)
+
+def test_quantizer_is_trained_once_enough_vectors_arrived():
+    rng = np.random.default_rng(4)
+    vectors = rng.standard_normal((3000, 16)).astype(np.float32)
+    retriever, _ = make_retriever(quantization='sq8')
+    # A tiny first batch is searched exactly instead of fixing the int8 ranges
+    retriever.add_vectors(np.arange(3), vectors[:3])
+    assert isinstance(retriever._base_index(), faiss.IndexFlat)
+    assert retriever.search_vectors(vectors[1:2], k=1)[0][0][0] == 1
+
+    retriever.add_vectors(np.arange(3, 3000), vectors[3:])
+    assert isinstance(retriever._base_index(), faiss.IndexScalarQuantizer)
+    assert retriever.size == 3000
+    exact, _ = make_retriever()
+    exact.add_vectors(np.arange(3000), vectors)
+    truth = exact.search_vectors(vectors[:50], k=10)
+    hits = retriever.search_vectors(vectors[:50], k=10)
+    recall = np.mean([len({i for i, _ in a} & {i for i, _ in b}) / 10 for a, b in zip(hits, truth)])
+    assert recall > 0.9
+
+def test_pca_reduction_is_fitted_persisted_and_rescored(tmp_path):
+    rng = np.random.default_rng(3)
+    # 64-d vectors whose variance lives in 8 directions
+    basis, _ = np.linalg.qr(rng.standard_normal((64, 64)))
+    scales = np.r_[np.ones(8), np.full(56, 0.01)]
+    vectors = ((rng.standard_normal((2000, 64)) * scales) @ basis.T).astype(np.float32)
+    storage = VectorSegmentStore(str(tmp_path / "vectors"), dimension=64)
+    storage.append(np.arange(2000), vectors)
+
+    retriever, _ = make_retriever(dimension=64, reduction='pca', rescore_vectors=storage,
+                                  index_params={'explained_variance': 0.95})
+    retriever.add_vectors(np.arange(2000), vectors)
+    assert retriever.index_dimension == 8
+    hits = retriever.search_vectors(vectors[:20], k=1)
+    assert [row[0][0] for row in hits] == list(range(20))
+
+    retriever.save(str(tmp_path / "reduced"))
+    reloaded, _ = make_retriever(dimension=64)
+    reloaded.load(str(tmp_path / "reduced"))
+    assert reloaded.index_dimension == 8
+    assert reloaded.search_vectors(vectors[5:6], k=1)[0][0][0] == 5
+
+    # A tiny first batch does not fix the projection
+    incremental, _ = make_retriever(dimension=64, reduction='pca', rescore_vectors=storage)
+    incremental.add_vectors(np.arange(3), vectors[:3])
+    assert incremental.index_dimension == 64
+    incremental.add_vectors(np.arange(3, 2000), vectors[3:])
+    assert incremental.index_dimension == 8
+    hits = incremental.search_vectors(vectors[:20], k=1)
+    assert [row[0][0] for row in hits] == list(range(20))
+
+    budgeted, _ = make_retriever(dimension=64, reduction='rotation',
+                                 index_params={'target_recall': 0.9})
+    budgeted.add_vectors(np.arange(2000), vectors)
+    assert budgeted.index_dimension < 64
+
+if __name__ == '__main__':
+    test_precomputed_vectors_are_indexed_without_embedding()
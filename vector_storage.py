@@ -0,0 +1,390 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Content hashes always have their lowest bit set, leaving even values free as markers
+TOMBSTONE_HASH = 0
+UNKNOWN_HASH = 2
+
+def content_hash(text: str) -> int:
+    """64-bit content hash of a text, as stored next to its vector"""
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True) | 1
+
+def atomic_write(path: str, data: bytes) -> None:
+    """Write a file via a temporary file and an atomic rename"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class VectorSegmentStore:
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory: str, dimension: Optional[int] = None,
+                 segment_rows: int = 1000000, max_segments: int = 8,
+                 auto_compact: bool = True):
+        """
+        Append-only float32 vector storage made of segment files
+
+        Each segment is a raw float32 matrix file plus parallel int64 id and
+        content-hash files. A small JSON manifest, replaced atomically,
+        records the segments and how many rows of each are committed, so a
+        torn append is simply ignored on the next open. Deletions are
+        appended as tombstone rows.
+
+        Args:
+            directory: Directory holding the segments and the manifest
+            dimension: Vector dimension (taken from the manifest or the first append)
+            segment_rows: Rows after which appends roll over to a new segment
+            max_segments: Segment count above which a background compaction starts
+            auto_compact: Start background compactions automatically
+        """
+        self.directory = directory
+        self.segment_rows = segment_rows
+        self.max_segments = max_segments
+        self.auto_compact = auto_compact
+        self._lock = threading.Lock()
+        self._compaction: Optional[threading.Thread] = None
+
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, self.MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'version': 2, 'dimension': dimension, 'segments': [], 'next_segment': 1}
+        if self.manifest['dimension'] is None:
+            self.manifest['dimension'] = dimension
+
+        self._mapped: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        self._locations: Dict[int, Tuple[str, int]] = {}
+        for segment, live in self._live_masks(self.manifest['segments']):
+            ids = self._open_segment(segment)[0]
+            rows = np.flatnonzero(live)
+            self._locations.update(
+                zip(ids[rows].tolist(), ((segment['name'], row) for row in rows.tolist()))
+            )
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return self.manifest['dimension']
+
+    def _path(self, name: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{name}.{suffix}")
+
+    def _write_manifest(self) -> None:
+        """Persist the manifest atomically; caller holds the lock"""
+        atomic_write(os.path.join(self.directory, self.MANIFEST),
+                     json.dumps(self.manifest).encode('utf-8'))
+
+    def _open_segment(self, segment: dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Memory-map the committed rows of a segment as (ids, vectors, hashes)"""
+        name, rows = segment['name'], segment['rows']
+        cached = self._mapped.get(name)
+        if cached is not None and len(cached[0]) == rows:
+            return cached
+        if rows == 0:
+            mapped = (np.empty(0, dtype=np.int64),
+                      np.empty((0, self.dimension), dtype=np.float32),
+                      np.empty(0, dtype=np.int64))
+        else:
+            if segment.get('hashes'):
+                hashes = np.memmap(self._path(name, 'hash'), dtype=np.int64, mode='r', shape=(rows,))
+            else:
+                # Segments written before content hashes were tracked
+                hashes = np.full(rows, UNKNOWN_HASH, dtype=np.int64)
+            mapped = (
+                np.memmap(self._path(name, 'ids'), dtype=np.int64, mode='r', shape=(rows,)),
+                np.memmap(self._path(name, 'f32'), dtype=np.float32, mode='r',
+                          shape=(rows, self.dimension)),
+                hashes
+            )
+        self._mapped[name] = mapped
+        return mapped
+
+    def _live_masks(self, segments: List[dict]) -> List[Tuple[dict, np.ndarray]]:
+        """For each segment, flag the rows holding the latest, non-deleted vector of their id"""
+        opened = [self._open_segment(segment) for segment in segments]
+        if not opened:
+            return []
+        all_ids = np.concatenate([ids for ids, _, _ in opened])
+        all_hashes = np.concatenate([hashes for _, _, hashes in opened])
+
+        # Last occurrence of each id wins; a winning tombstone means deleted
+        _, last = np.unique(all_ids[::-1], return_index=True)
+        live = np.zeros(len(all_ids), dtype=bool)
+        live[len(all_ids) - 1 - last] = True
+        live &= all_hashes != TOMBSTONE_HASH
+
+        offsets = np.cumsum([0] + [len(ids) for ids, _, _ in opened])
+        return [(segment, live[start:end])
+                for segment, start, end in zip(segments, offsets[:-1], offsets[1:])]
+
+    def _allocate_name(self) -> str:
+        """Reserve a new segment name; caller holds the lock"""
+        name = f"seg-{self.manifest['next_segment']:06d}"
+        self.manifest['next_segment'] += 1
+        return name
+
+    def _new_segment(self) -> dict:
+        """Register an empty segment; caller holds the lock"""
+        segment = {'name': self._allocate_name(), 'rows': 0, 'hashes': True}
+        self.manifest['segments'].append(segment)
+        return segment
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self._locations
+
+    def ids(self) -> List[int]:
+        """Ids with a live vector"""
+        with self._lock:
+            return list(self._locations)
+
+    def _append_rows(self, ids: np.ndarray, matrix: np.ndarray, hashes: np.ndarray) -> None:
+        """Append rows to the active segment and commit them; caller holds the lock"""
+        segments = self.manifest['segments']
+        segment = segments[-1] if segments and not segments[-1].get('sealed') else None
+        if segment is None or segment['rows'] >= self.segment_rows or not segment.get('hashes'):
+            if segment is not None:
+                segment['sealed'] = True
+            segment = self._new_segment()
+
+        row_bytes = self.dimension * 4
+        for suffix, data, width in (('f32', matrix, row_bytes), ('ids', ids, 8), ('hash', hashes, 8)):
+            with open(self._path(segment['name'], suffix), 'ab') as f:
+                # Drop any rows a crashed append left past the committed end
+                f.truncate(segment['rows'] * width)
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        start = segment['rows']
+        segment['rows'] += len(ids)
+        self._write_manifest()
+
+        for row, (item_id, item_hash) in enumerate(zip(ids.tolist(), hashes.tolist()), start):
+            if item_hash == TOMBSTONE_HASH:
+                self._locations.pop(item_id, None)
+            else:
+                self._locations[item_id] = (segment['name'], row)
+
+    def append(self, ids, vectors: np.ndarray, hashes=None) -> None:
+        """
+        Append vectors; a later append of the same id supersedes earlier ones
+
+        Args:
+            ids: Sequence or array of n item ids
+            vectors: (n, d) array of embeddings
+            hashes: Optional content hashes (see `content_hash`) of the embedded texts
+        """
+        ids = np.ascontiguousarray(ids, dtype=np.int64).reshape(-1)
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(ids) == 0:
+            return
+        if self.dimension is None:
+            self.manifest['dimension'] = int(matrix.shape[1])
+        if matrix.ndim != 2 or matrix.shape[1] != self.dimension or len(matrix) != len(ids):
+            raise ValueError(f"Expected {len(ids)} vectors of dimension {self.dimension}, "
+                             f"got {matrix.shape}")
+        if hashes is None:
+            hashes = np.full(len(ids), UNKNOWN_HASH, dtype=np.int64)
+        hashes = np.ascontiguousarray(hashes, dtype=np.int64).reshape(-1)
+        if np.any(hashes == TOMBSTONE_HASH):
+            raise ValueError("Use delete() to remove ids")
+
+        with self._lock:
+            self._append_rows(ids, matrix, hashes)
+            needs_compaction = len(self.manifest['segments']) > self.max_segments
+
+        if needs_compaction and self.auto_compact:
+            self.compact_async()
+
+    def delete(self, ids) -> int:
+        """
+        Delete ids by appending tombstones; compaction drops them for good
+
+        Args:
+            ids: Item ids to delete
+
+        Returns:
+            Number of ids that were deleted
+        """
+        with self._lock:
+            present = np.array([item_id for item_id in dict.fromkeys(np.asarray(ids).tolist())
+                                if item_id in self._locations], dtype=np.int64)
+            if len(present) == 0 or self.dimension is None:
+                return 0
+            self._append_rows(present,
+                              np.zeros((len(present), self.dimension), dtype=np.float32),
+                              np.full(len(present), TOMBSTONE_HASH, dtype=np.int64))
+            return len(present)
+
+    def _segment(self, name: str) -> Optional[dict]:
+        """Manifest entry of a segment, or None; caller holds the lock"""
+        return next((s for s in self.manifest['segments'] if s['name'] == name), None)
+
+    def _rows(self, ids: List[int]) -> Dict[str, Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray],
+                                                       List[int], List[int]]]:
+        """
+        Group the ids by the segment holding their latest row
+
+        The locations and the manifest are read together under the lock, so a
+        compaction swapping segments in between cannot leave a location
+        pointing to a segment that is gone.
+
+        Returns:
+            Segment name -> (mapped segment, positions in `ids`, rows)
+        """
+        grouped = {}
+        with self._lock:
+            for position, item_id in enumerate(ids):
+                location = self._locations.get(item_id)
+                if location is None:
+                    continue
+                name, row = location
+                if name not in grouped:
+                    segment = self._segment(name)
+                    if segment is None:
+                        continue
+                    grouped[name] = (self._open_segment(segment), [], [])
+                grouped[name][1].append(position)
+                grouped[name][2].append(row)
+        return grouped
+
+    def get(self, item_id: int) -> Optional[np.ndarray]:
+        """Return the stored vector of an id (a read-only view) or None"""
+        for mapped, _, rows in self._rows([item_id]).values():
+            return mapped[1][rows[0]]
+        return None
+
+    def get_batch(self, ids) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gather the stored vectors of many ids, reading each segment once
+
+        Args:
+            ids: Item ids
+
+        Returns:
+            (n, d) float32 matrix (zero rows for unknown ids) and a mask of
+            the ids that were found
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1).tolist()
+        matrix = np.zeros((len(ids), self.dimension or 0), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        for mapped, positions, rows in self._rows(ids).values():
+            # Fancy indexing copies only the requested rows out of the mapping
+            matrix[positions] = mapped[1][rows]
+            found[positions] = True
+        return matrix, found
+
+    def get_hash(self, item_id: int) -> Optional[int]:
+        """Return the content hash stored with an id, or None if it has no vector"""
+        for mapped, _, rows in self._rows([item_id]).values():
+            return int(mapped[2][rows[0]])
+        return None
+
+    def segments(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Iterate over the live rows of the committed segments in append order
+
+        Returns:
+            Iterator of (ids, vectors) arrays, memory-mapped (zero-copy) when
+            every row of a segment is live; superseded and deleted rows are
+            skipped
+        """
+        with self._lock:
+            snapshot = [dict(segment) for segment in self.manifest['segments']]
+        for segment, live in self._live_masks(snapshot):
+            ids, vectors, _ = self._open_segment(segment)
+            if live.all():
+                if len(ids):
+                    yield ids, vectors
+            elif live.any():
+                yield ids[live], vectors[live]
+
+    def as_dict(self) -> Dict[int, np.ndarray]:
+        """Map every id to its latest vector (zero-copy views)"""
+        vectors = {item_id: self.get(item_id) for item_id in self.ids()}
+        # Ids deleted while iterating are left out
+        return {item_id: vector for item_id, vector in vectors.items() if vector is not None}
+
+    def compact(self) -> int:
+        """
+        Merge all sealed segments into one, keeping the latest vector per id
+        and dropping deleted ids
+
+        Returns:
+            Number of superseded or deleted rows dropped
+        """
+        with self._lock:
+            segments = self.manifest['segments']
+            if segments and not segments[-1].get('sealed'):
+                # Seal the active segment so appends can continue during the merge
+                segments[-1]['sealed'] = True
+            merging = [dict(segment) for segment in segments if segment['rows']]
+            if not merging or (len(merging) == 1 and self._live_masks(merging)[0][1].all()):
+                return 0
+            merged = {'name': self._allocate_name(), 'rows': 0, 'sealed': True, 'hashes': True}
+            self._write_manifest()
+
+        masks = self._live_masks(merging)
+        total = sum(segment['rows'] for segment in merging)
+        merged_ids = np.concatenate([self._open_segment(s)[0][live] for s, live in masks])
+        merged_hashes = np.concatenate([self._open_segment(s)[2][live] for s, live in masks])
+        with open(self._path(merged['name'], 'f32'), 'wb') as f:
+            for segment, live in masks:
+                f.write(np.ascontiguousarray(self._open_segment(segment)[1][live]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        for suffix, data in (('ids', merged_ids), ('hash', merged_hashes)):
+            with open(self._path(merged['name'], suffix), 'wb') as f:
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        merged['rows'] = len(merged_ids)
+
+        with self._lock:
+            merged_names = {s['name'] for s in merging}
+            remaining = [s for s in self.manifest['segments'] if s['name'] not in merged_names]
+            self.manifest['segments'] = [merged] + remaining
+            self._write_manifest()
+
+            # Ids re-appended or deleted during the merge keep their newer state
+            for row, item_id in enumerate(merged_ids.tolist()):
+                location = self._locations.get(item_id)
+                if location is not None and location[0] in merged_names:
+                    self._locations[item_id] = (merged['name'], row)
+            for name in merged_names:
+                self._mapped.pop(name, None)
+
+        for name in merged_names:
+            for suffix in ('f32', 'ids', 'hash'):
+                try:
+                    os.remove(self._path(name, suffix))
+                except OSError:
+                    pass
+        return total - len(merged_ids)
+
+    def compact_async(self) -> threading.Thread:
+        """Run `compact` on a background thread unless one is already running"""
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return self._compaction
+            self._compaction = threading.Thread(target=self.compact, daemon=True)
+            self._compaction.start()
+            return self._compaction
+
+    def wait_for_compaction(self) -> None:
+        """Block until a running background compaction finishes"""
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.join()